@@ -1,16 +1,55 @@
 import streamlit as st
-import requests
-from bs4 import BeautifulSoup
 import pandas as pd
 import time
-import re  # ★ 新增：強大的正則表達式套件，用來抓年份
+import functools
 import gspread
+from gspread.utils import rowcol_to_a1
 from oauth2client.service_account import ServiceAccountCredentials
 import plotly.express as px
+from etf_core import (
+    SHEET_COLUMNS, LEDGER_TYPES, normalize_code, parse_sheet_values, plan_sheet_sync, sheet_sync_batches, build_positions,
+    fetch_etf_performance, fetch_etf_details, fetch_etf_codes, get_etf_registry, stream_market_ranking,
+    value_holdings, portfolio_summary, ranking_view, holdings_view, get_market_refresher, get_scrape_cache,
+    record_portfolio_snapshot, load_portfolio_history, portfolio_trend,
+    quote_rev, sheet_rev, invalidate_quotes, invalidate_dividends, invalidate_sheet,
+    get_metrics, metrics_text, fetch_stats, log_run,
+)
 
 # --- 網頁設定 ---
 st.set_page_config(page_title="台股 ETF 資產管家 (領息強化版)", layout="wide")
 
+# --- 效能監測：每次頁面執行各階段花多少時間、快取命中率 ---
+metrics = get_metrics()
+metrics.begin_run()
+
+class _Uncached(Exception):
+    """函式本體回傳 None 時拋出：Streamlit 不快取拋出例外的呼叫，外層再換回 None"""
+
+def st_cached(name, shared=False, **cache_kwargs):
+    """st.cache_data 再包一層計數：每次呼叫記一次 request，真的執行函式本體才記 miss (兩者相減就是命中數)。
+
+    shared=True 改用 st.cache_resource：整個行程共用同一個物件，讀取時不必反序列化複製一份，
+    適合所有使用者都一樣的行情資料；拿到的結果不可原地修改。
+    回傳 None 代表這次抓不到 (上游出錯)，不會被快取，下一次呼叫會重新執行，不必等 TTL 過期。"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def compute(*args, **kwargs):
+            metrics.inc("st_cache_events", cache=name, event="miss")
+            with metrics.timer(name): result = fn(*args, **kwargs)
+            if result is None: raise _Uncached()
+            return result
+        cached = (st.cache_resource if shared else st.cache_data)(**cache_kwargs)(compute)
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            metrics.inc("st_cache_events", cache=name, event="request")
+            try: return cached(*args, **kwargs)
+            except _Uncached:
+                metrics.inc("st_cache_events", cache=name, event="uncached")
+                return None
+        call.clear = cached.clear
+        return call
+    return decorator
+
 # --- 連線 Google Sheets 設定 ---
 SCOPE = ['https://www.googleapis.com/auth/spreadsheets', 'https://www.googleapis.com/auth/drive']
 
@@ -26,235 +65,158 @@ def init_connection():
         return None, ""
 
 client, bot_email = init_connection()
-headers = {"User-Agent": "Mozilla/5.0"}
-
-# --- 工具函式 ---
-def normalize_code(code):
-    code_str = str(code).strip().replace("'", "")
-    if code_str.isdigit() and not code_str.startswith("0"):
-        return "00" + code_str
-    if code_str.isdigit() and len(code_str) < 4:
-        return code_str.zfill(4)
-    return code_str
-
-def style_pl_color(val):
-    if isinstance(val, (int, float)):
-        color = '#d63031' if val > 0 else '#00b894' if val < 0 else 'black'
-        return f'color: {color}; font-weight: bold;'
-    return ''
+
+# --- Google Sheets 連線快取 ---
+USERS_INDEX_TTL = 60  # 會員索引多久重新讀一次 users 工作表 (秒)
+
+@st.cache_resource
+def get_users_worksheet():
+    return client.open("ETF_Database").worksheet("users")
+
+@st.cache_resource
+def get_sheet_handles():
+    return {}  # 試算表網址 -> 第一個工作表，每個行程只 open_by_url 一次
+
+def open_personal_sheet(sheet_url):
+    handles = get_sheet_handles()
+    if sheet_url not in handles:
+        handles[sheet_url] = client.open_by_url(sheet_url).sheet1
+    return handles[sheet_url]
+
+def users_rev():
+    return get_scrape_cache().revisions("users")[0]
+
+@st_cached("users_index", ttl=USERS_INDEX_TTL, show_spinner=False)
+def load_users_index(rev=0):
+    """username -> 會員資料；同名帳號以工作表上第一筆為準 (跟以前逐筆比對的結果一樣)"""
+    index = {}
+    for u in get_users_worksheet().get_all_records():
+        index.setdefault(str(u.get('username')), u)
+    return index
+
+def invalidate_users():
+    get_scrape_cache().bump("users")
 
 # --- 會員系統 ---
 def login_user(username, password):
     try:
-        sheet = client.open("ETF_Database").worksheet("users")
-        users = sheet.get_all_records()
-        for u in users:
-            if str(u.get('username')) == username and str(u.get('password')) == password:
-                return {"success": True, "sheet_url": str(u.get('sheet_url'))}
+        u = load_users_index(users_rev()).get(username)
+        if u and str(u.get('password')) == password:
+            return {"success": True, "sheet_url": str(u.get('sheet_url'))}
         return {"success": False, "msg": "帳號或密碼錯誤"}
     except Exception as e:
+        get_users_worksheet.clear()  # 連線可能失效了，下次重新開
         return {"success": False, "msg": f"資料庫讀取失敗: {e}"}
 
 def register_user(username, password, sheet_url):
     try:
-        sheet = client.open("ETF_Database").worksheet("users")
-        users = sheet.get_all_records()
-        if any(str(u.get('username')) == username for u in users):
+        if username in load_users_index(users_rev()):
             return "exists"
         try:
-            test_open = client.open_by_url(sheet_url)
+            open_personal_sheet(sheet_url)
         except gspread.exceptions.APIError:
             return "no_permission"
         except Exception:
             return "invalid_url"
-        sheet.append_row([username, password, sheet_url])
+        get_users_worksheet().append_row([username, password, sheet_url])
+        invalidate_users()
         return "success"
     except Exception as e:
+        get_users_worksheet.clear()
         return f"error: {e}"
 
 # --- 讀寫個人專屬資料庫 ---
-def get_personal_sheet_data(sheet_url):
-    try:
-        sheet = client.open_by_url(sheet_url).sheet1
-        data = sheet.get_all_records()
-        df = pd.DataFrame(data)
-        if not df.empty and '代號' in df.columns:
-            df['代號'] = df['代號'].apply(normalize_code)
-        return df
-    except:
-        return pd.DataFrame(columns=["代號", "成交均價", "股數"])
+@st.cache_resource
+def get_sheet_layouts():
+    return {}  # 試算表網址 -> {"header": 第一列, "rows": 資料列數}，寫入前不必再讀一次工作表
+
+def read_personal_sheet(sheet_url):
+    df, layout = parse_sheet_values(open_personal_sheet(sheet_url).get_all_values())
+    get_sheet_layouts()[sheet_url] = layout
+    return df
+
+@st_cached("sheet", ttl=600, show_spinner=False)
+def get_personal_sheet_data(sheet_url, rev=0):
+    """讀不到就回傳 None (不快取，下次重新讀)，不要當成空的持股"""
+    try: return read_personal_sheet(sheet_url)
+    except Exception:
+        get_sheet_handles().pop(sheet_url, None)  # 連線可能失效了，下次重新開
+        return None
 
-def save_to_personal_sheet(sheet_url, code, cost, qty):
+def save_to_personal_sheet(sheet_url, code, cost, qty, kind="買進", date=""):
     try:
-        sheet = client.open_by_url(sheet_url).sheet1
-        if not sheet.get_all_values():
-            sheet.append_row(['代號', '成交均價', '股數'])
-        sheet.append_row([code, cost, qty])
+        sheet = open_personal_sheet(sheet_url)
+        layout = get_sheet_layouts().get(sheet_url)
+        header = layout["header"] if layout else sheet.row_values(1)
+        row = [code, cost, qty, kind, date]
+        if header and header[:len(SHEET_COLUMNS)] != SHEET_COLUMNS:
+            # 舊的三欄表頭：先補上 類型 / 日期 欄名，否則新加的欄位讀不回來
+            sheet.batch_update([{"range": f"A1:{rowcol_to_a1(1, len(SHEET_COLUMNS))}", "values": [SHEET_COLUMNS]}])
+        # 空白試算表：表頭跟第一筆資料一次寫入
+        sheet.append_rows([row] if header else [SHEET_COLUMNS, row])
+        get_sheet_layouts().pop(sheet_url, None)  # 已知列數改變，等重新載入時再記
         return True
-    except: return False
+    except:
+        get_sheet_handles().pop(sheet_url, None)
+        return False
 
-def update_personal_sheet_batch(sheet_url, new_df):
+def update_personal_sheet_batch(sheet_url, new_df, original_df):
+    """只把有變動的列寫回去，所有新增 / 修改 / 刪除合併成一次 batch_update"""
     try:
-        sheet = client.open_by_url(sheet_url).sheet1
-        final_df = new_df[['代號', '成交均價', '股數']].copy()
-        final_df['代號'] = final_df['代號'].astype(str).apply(normalize_code)
-        
-        sheet.clear()
-        sheet.append_row(['代號', '成交均價', '股數'])
-        if not final_df.empty:
-            sheet.append_rows(final_df.values.tolist())
+        sheet = open_personal_sheet(sheet_url)
+        layout = get_sheet_layouts().get(sheet_url)
+        if layout is None:
+            # 這個行程不知道工作表目前的樣子 (例如剛新增過一筆)，只好先讀一次
+            original_df = read_personal_sheet(sheet_url)
+            layout = get_sheet_layouts()[sheet_url]
+        changes = plan_sheet_sync(layout, original_df, new_df)
+        batches = sheet_sync_batches(changes)
+        if batches: sheet.batch_update(batches)
+        get_sheet_layouts().pop(sheet_url, None)
         return True
     except Exception as e:
+        get_sheet_handles().pop(sheet_url, None)
         st.error(f"更新失敗: {e}")
         return False
 
-# --- ★ 爬蟲核心 1：排行榜專用 ★ ---
-@st.cache_data(ttl=3600)
-def get_etf_performance(stock_code):
-    url = f"https://histock.tw/stock/{stock_code}"
-    try:
-        response = requests.get(url, headers=headers)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        data = {'代號': stock_code, '名稱': "未知", '市場別': "未知", '現價': 0.0, '一季%': 0.0, '半年%': 0.0, '一年%': 0.0, '綜合平均%': 0.0}
-        
-        name_tag = soup.find('h3') 
-        if name_tag: data['名稱'] = name_tag.text.split('(')[0].strip()
-            
-        for tag in soup.find_all(['li', 'td']):
-            text = tag.text.strip()
-            if '市場' in text:
-                if '上市' in text: data['市場別'] = '上市'; break
-                elif '上櫃' in text: data['市場別'] = '上櫃'; break
-        if data['市場別'] == "未知":
-            if soup.find(string="上市"): data['市場別'] = '上市'
-            elif soup.find(string="上櫃"): data['市場別'] = '上櫃'
-
-        price_span = soup.find('span', id='Price1_lbTPrice') or soup.find('span', class_='price')
-        if price_span:
-            try: data['現價'] = float(price_span.text.replace(',', ''))
-            except: pass
-
-        table = soup.find('table', class_='tbPerform')
-        if table:
-            target_periods = {'一季': '一季%', '半年': '半年%', '一年': '一年%'}
-            periods_data = {}
-            for row in table.find_all('tr'):
-                th, td = row.find('th'), row.find('td')
-                if th and td and th.text.strip() in target_periods:
-                    val_span = td.find('span')
-                    if val_span:
-                        try: periods_data[th.text.strip()] = float(val_span.text.replace('%', '').replace('+', '').replace(',', '').strip())
-                        except: pass
-            
-            data['一季%'] = periods_data.get('一季', 0)
-            data['半年%'] = periods_data.get('半年', 0)
-            data['一年%'] = periods_data.get('一年', 0)
-            valid_values = [v for k, v in periods_data.items() if v is not None]
-            if valid_values: data['綜合平均%'] = round(sum(valid_values) / len(valid_values), 2)
-        return data
-    except: return None
-
-# --- ★ 爬蟲核心 2：持股明細專用 (暴力防呆版) ★ ---
-@st.cache_data(ttl=3600)
-def get_etf_details(stock_code):
-    data = get_etf_performance(stock_code)
-    if not data: return None
-    
-    data['一年配息'] = 0.0
-    div_url = f"https://histock.tw/stock/{stock_code}/%E9%99%A4%E6%AC%8A%E9%99%A4%E6%81%AF"
-    try:
-        div_resp = requests.get(div_url, headers=headers)
-        div_soup = BeautifulSoup(div_resp.text, 'html.parser')
-        
-        # 尋找所有可能的表格
-        div_tables = div_soup.find_all('table', class_='tb-stock')
-        for div_table in div_tables:
-            rows = div_table.find_all('tr')
-            if len(rows) > 1:
-                ths = [th.text.strip() for th in rows[0].find_all(['th', 'td'])]
-                
-                cash_idx = -1
-                year_idx = -1
-                
-                # 精準定位欄位
-                for i, text in enumerate(ths):
-                    # 必須是現金股利
-                    if '現金' in text or '除息' in text: 
-                        if cash_idx == -1: cash_idx = i
-                    # 找發放年度
-                    if '發放年度' in text:
-                        year_idx = i
-                
-                # 如果找不到發放年度，隨便找有「年度」或「日期」的
-                if year_idx == -1:
-                    for i, text in enumerate(ths):
-                        if '年度' in text or '除權息日' in text or '除息日' in text:
-                            year_idx = i
-                            break
-                            
-                if cash_idx != -1 and year_idx != -1:
-                    year_divs = {}
-                    for row in rows[1:]:
-                        tds = row.find_all('td')
-                        if len(tds) > max(cash_idx, year_idx):
-                            y_raw = tds[year_idx].text.strip()
-                            c_str = tds[cash_idx].text.strip()
-                            
-                            # ★ 終極武器：正則表達式，強制從字串中抓出 20XX 的數字 ★
-                            match = re.search(r'(20\d{2})', y_raw)
-                            if match and c_str:
-                                y_str = match.group(1) # 取出 2024、2023 這樣的純數字
-                                try:
-                                    val = float(c_str)
-                                    year_divs[y_str] = year_divs.get(y_str, 0.0) + val
-                                except: pass
-                    
-                    if year_divs:
-                        sorted_years = sorted(year_divs.keys(), reverse=True)
-                        recent_years = sorted_years[:3] # 取近三年
-                        if recent_years:
-                            # 找出這三年裡面總配息最高的數字
-                            data['一年配息'] = round(max([year_divs[y] for y in recent_years]), 3)
-                        break # 找到了就跳出迴圈
-    except: pass
-    
-    return data
+# --- 行情快取 (爬蟲與計算都在 etf_core，這裡只多包一層 st.cache_data) ---
+@st_cached("perf", shared=True, ttl=3600, show_spinner=False)  # 會在掃描 worker 執行緒中被呼叫，不顯示 spinner
+def get_etf_performance(stock_code, rev=(0, 0)):
+    return fetch_etf_performance(stock_code)
+
+@st_cached("details", shared=True, ttl=3600, max_entries=2000)
+def get_etf_details(stock_code, rev=(0, 0)):
+    return fetch_etf_details(stock_code)
 
-@st.cache_data(ttl=86400)
+@st_cached("etf_list", shared=True, ttl=86400)
 def get_fast_etf_list():
-    url = "https://histock.tw/stock/etf.aspx"
-    try:
-        response = requests.get(url, headers=headers)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        etf_options = []
-        china_keywords = ['中國', '上證', '滬', '深', '恒生', 'A50', '香港', '港股']
-        for row in soup.find_all('tr'):
-            link = row.find('a', href=True)
-            if not link or '/stock/' not in link['href']: continue
-            href_code = link['href'].split('/')[-1]
-            row_text = row.text.strip()
-            if not href_code[0].isdigit() or href_code.upper().endswith(('L', 'R')) or any(kw in row_text for kw in china_keywords): continue
-            name_text = link.text.strip()
-            option_str = f"{href_code} {name_text}"
-            if option_str not in etf_options: etf_options.append(option_str)
-        return etf_options
-    except: return []
-
-@st.cache_data(ttl=3600, show_spinner="正在掃描全台 ETF 績效中，請稍候 (約 1-2 分鐘)...")
-def fetch_all_etf_data():
-    options = get_fast_etf_list()
-    results = []
+    return fetch_etf_codes()  # 名稱等資料直接查 ETF 名冊
+
+@st_cached("portfolio_history", ttl=86400, max_entries=1000, show_spinner=False)
+def get_portfolio_history(user, today):
+    """昨天以前的資產走勢，每位使用者每天只讀一次 Parquet；today 換日就自然換一份快取"""
+    return load_portfolio_history(user, today)
+
+def render_ranking(df_final, container):
+    if df_final.empty: return
+    with metrics.timer("render"): _render_ranking(df_final, container)
+
+def _render_ranking(df_final, container):
+    container.dataframe(ranking_view(df_final), use_container_width=True, height=600)
+
+def stream_all_etf_data(container):
+    """冷啟動用：邊掃邊畫，每收到一批就重新排序整張表，不必等全部掃完才看到東西"""
+    codes = get_fast_etf_list()
     progress_bar = st.progress(0)
     status_text = st.empty()
-    for i, opt in enumerate(options):
-        code = opt.split(" ")[0]
-        status_text.text(f"🚀 正在分析 [{i+1}/{len(options)}]: {code} ...")
-        progress_bar.progress((i + 1) / len(options))
-        data = get_etf_performance(code)
-        if data: results.append(data)
-        time.sleep(0.05)
+    df_final = pd.DataFrame()
+    # 每一張都依原本清單順序組表，最後一張的結果與逐檔掃描相同
+    for df_final in stream_market_ranking(codes, lambda code: get_etf_performance(code, quote_rev(code))):
+        status_text.text(f"🚀 已分析 {len(df_final)}/{len(codes)} 檔，排行會隨結果陸續更新...")
+        progress_bar.progress(len(df_final) / len(codes))
+        render_ranking(df_final, container)
     status_text.empty(); progress_bar.empty()
-    return pd.DataFrame(results)
+    return df_final
 
 # --- 自動登入處理 ---
 if "logged_in" not in st.session_state:
@@ -263,14 +225,12 @@ if "logged_in" not in st.session_state:
 if not st.session_state["logged_in"] and "user" in st.query_params:
     auto_user = st.query_params["user"]
     try:
-        users_records = client.open("ETF_Database").worksheet("users").get_all_records()
-        for u in users_records:
-            if str(u.get('username')) == auto_user:
-                st.session_state["logged_in"] = True
-                st.session_state["current_user"] = auto_user
-                st.session_state["sheet_url"] = str(u.get('sheet_url'))
-                break
-    except: pass
+        u = load_users_index(users_rev()).get(auto_user)
+        if u:
+            st.session_state["logged_in"] = True
+            st.session_state["current_user"] = auto_user
+            st.session_state["sheet_url"] = str(u.get('sheet_url'))
+    except: get_users_worksheet.clear()
 
 # --- 側邊欄：會員登入/註冊/導覽 ---
 with st.sidebar:
@@ -341,77 +301,73 @@ st.title("💰 台股 ETF 資產管家 (領息強化版)")
 if page == "📊 市場排行榜":
     st.subheader("🏆 全台 ETF 績效排行")
     st.info("💡 這裡會抓取全台灣的 ETF 並計算績效，載入時間較長。")
-    if st.button('🔄 強制更新行情'): st.cache_data.clear(); st.rerun()
-        
-    df_final = fetch_all_etf_data()
-    if not df_final.empty:
-        market_cols = ['代號', '名稱', '市場別', '現價', '一季%', '半年%', '一年%', '綜合平均%']
-        existing_cols = [c for c in market_cols if c in df_final.columns]
-        df_show = df_final[existing_cols].sort_values(by='綜合平均%', ascending=False).reset_index(drop=True)
-        df_show.index += 1
+    refresher = get_market_refresher()
+    if st.button('🔄 強制更新行情'):
+        refresher.trigger()
+        st.toast("已在背景重新整理行情，完成後重新整理頁面即可看到最新排行。")
         
-        styler = df_show.style.map(style_pl_color, subset=['一季%', '半年%', '一年%', '綜合平均%']) \
-                              .format("{:.2f}", subset=['現價', '一季%', '半年%', '一年%', '綜合平均%'])
-        st.dataframe(styler, use_container_width=True, height=600)
+    caption = st.empty()
+    table = st.empty()
+    snapshot = refresher.snapshot()
+    if snapshot is None:
+        # 冷啟動：還沒有任何快照，前景邊掃邊顯示，完整結果交給背景更新器接手
+        with metrics.timer("scan"): df_final = stream_all_etf_data(table)
+        if not df_final.empty: refresher.publish(df_final)
+        as_of = time.time()
+    else: df_final, as_of = snapshot
+    caption.caption(f"🕒 資料時間：{time.strftime('%Y-%m-%d %H:%M', time.localtime(as_of))}" + (" (背景更新中...)" if refresher.busy else ""))
+    render_ranking(df_final, table)
 
 elif page == "💼 我的持股":
     if st.session_state["logged_in"]:
         current_user = st.session_state["current_user"]
         my_sheet_url = st.session_state["sheet_url"]
         
+        registry = get_etf_registry()  # 先載入名冊，讀試算表時代號才能對照名冊正規化
+        user_df = get_personal_sheet_data(my_sheet_url, sheet_rev(my_sheet_url))
+        sheet_failed = user_df is None
+        if sheet_failed:
+            st.error("⚠️ 讀取持股試算表失敗，請稍後重新整理，或確認試算表仍有共用給機器人帳號。")
+            user_df = pd.DataFrame(columns=[*SHEET_COLUMNS, "列號"])
+        
         col_title, col_btn = st.columns([8, 2])
         with col_title: pass
         with col_btn:
             if st.button("🔄 更新報價與配息", use_container_width=True):
-                st.cache_data.clear()
+                # 只重抓這位使用者持有的 ETF (報價與配息) 與他的試算表
+                if not user_df.empty:
+                    codes = user_df['代號'].unique().tolist()
+                    invalidate_quotes(codes)
+                    invalidate_dividends(codes)
+                invalidate_sheet(my_sheet_url)
                 st.rerun()
-
-        user_df = get_personal_sheet_data(my_sheet_url)
         
+        positions = None
         if not user_df.empty:
-            unique_codes = user_df['代號'].unique()
-            my_holdings_data = []
-            
+            # 同一檔買很多次也只算一個部位；成本用移動平均法，跟券商對帳單一致
+            try:
+                with metrics.timer("positions"): positions = build_positions(user_df)
+            except ValueError as e: st.error(f"交易紀錄有誤：{e}")
+        
+        if positions is not None:
             with st.spinner("⚡ 正在計算最新行情與配息資訊..."):
-                for code in unique_codes:
-                    data = get_etf_details(code)
-                    if data: my_holdings_data.append(data)
+                merged_df = value_holdings(positions, lambda code: get_etf_details(code, quote_rev(code)))
             
-            if my_holdings_data:
-                current_prices_df = pd.DataFrame(my_holdings_data)
-                merged_df = pd.merge(user_df, current_prices_df, on='代號', how='left')
-                
-                merged_df['現價'] = pd.to_numeric(merged_df['現價'], errors='coerce').fillna(0)
-                merged_df['股數'] = pd.to_numeric(merged_df['股數'], errors='coerce').fillna(0)
-                merged_df['現值'] = merged_df['現價'] * merged_df['股數']
-                merged_df['總成本'] = merged_df['成交均價'] * merged_df['股數']
-                merged_df['預估損益'] = merged_df['現值'] - merged_df['總成本']
-                merged_df['報酬率%'] = 0.0
-                mask = merged_df['總成本'] > 0
-                merged_df.loc[mask, '報酬率%'] = (merged_df.loc[mask, '預估損益'] / merged_df.loc[mask, '總成本']) * 100
-                
-                merged_df['年領息'] = merged_df['一年配息'] * merged_df['股數']
-                merged_df['成本殖利率%'] = 0.0
-                mask_cost = merged_df['成交均價'] > 0
-                merged_df.loc[mask_cost, '成本殖利率%'] = (merged_df.loc[mask_cost, '一年配息'] / merged_df.loc[mask_cost, '成交均價']) * 100
-                
-                merged_df = merged_df.sort_values(by='代號', ascending=True).reset_index(drop=True)
+            if merged_df is not None:
+                record_portfolio_snapshot(current_user, merged_df)
                 
                 dash_col1, dash_col2 = st.columns([1, 1.5])
                 
                 with dash_col1:
                     st.write("### 📊 資產與配息總覽")
-                    total_value = merged_df['現值'].sum()
-                    total_pnl = merged_df['預估損益'].sum()
-                    total_cost = merged_df['總成本'].sum()
-                    total_roi = (total_pnl / total_cost * 100) if total_cost > 0 else 0
-                    total_div = merged_df['年領息'].sum()
-                    monthly_div = total_div / 12
+                    summary = portfolio_summary(merged_df, positions)
                     
-                    st.metric("總市值", f"${total_value:,.0f}")
-                    st.metric("預估年領息", f"${total_div:,.0f}", help="根據該檔ETF近三年最高配息年度計算")
-                    st.metric("每月被動收入", f"${monthly_div:,.0f}", help="等於年領息除以12個月")
-                    st.metric("總損益", f"${total_pnl:,.0f}", delta=f"{total_pnl:,.0f}")
+                    st.metric("總市值", f"${summary['總市值']:,.0f}")
+                    st.metric("預估年領息", f"${summary['預估年領息']:,.0f}", help="根據該檔ETF近三年最高配息年度計算")
+                    st.metric("每月被動收入", f"${summary['每月被動收入']:,.0f}", help="等於年領息除以12個月")
+                    st.metric("總損益", f"${summary['總損益']:,.0f}", delta=f"{summary['總損益']:,.0f}", help="目前持有部位的未實現損益")
+                    st.metric("已實現損益", f"${summary['已實現損益']:,.0f}", delta=f"{summary['已實現損益']:,.0f}", help="賣出部位按平均成本結算")
+                    st.metric("已領股息", f"${summary['已領股息']:,.0f}", help="交易紀錄中類型為「配息」的金額合計")
 
                 with dash_col2:
                     st.write("### 🍩 資產配置")
@@ -435,62 +391,110 @@ elif page == "💼 我的持股":
                 st.divider()
                 
                 st.write("### 📄 持股明細")
-                view_cols = ['代號', '名稱', '股數', '成交均價', '現價', '現值', '預估損益', '一年配息', '年領息', '成本殖利率%']
-                view_styler = merged_df[view_cols].style.format({
-                    '成交均價': "{:.2f}", '現價': "{:.2f}", '現值': "{:,.0f}",
-                    '預估損益': "{:,.0f}", '一年配息': "{:.2f}", '年領息': "{:,.0f}", '成本殖利率%': "{:.2f}%"
-                }).map(style_pl_color, subset=['預估損益', '成本殖利率%'])
+                with metrics.timer("render"): st.dataframe(holdings_view(merged_df), use_container_width=True)
                 
-                st.dataframe(view_styler, use_container_width=True)
+                trend_df = portfolio_trend(get_portfolio_history(current_user, time.strftime('%Y-%m-%d')), summary)
+                if len(trend_df) >= 2:
+                    st.write("### 📈 資產走勢")
+                    fig = px.line(trend_df, x='日期', y=['總市值', '總成本'], markers=True)
+                    fig.update_layout(margin=dict(t=10, b=10, l=10, r=10), legend_title_text="", yaxis_title="", xaxis_title="")
+                    st.plotly_chart(fig, use_container_width=True)
                 
             else: st.info("目前無有效報價資料。")
-        else: 
+        elif user_df.empty and not sheet_failed:
             st.info("您目前尚未建立任何持股。可以從下方管理區新增！")
 
         st.divider()
         st.write("### ⚙️ 持股管理")
         fast_etf_options = get_fast_etf_list()
         
-        with st.expander("➕ 新增持股", expanded=False):
-            c1, c2, c3, c4 = st.columns([2, 2, 2, 1])
-            selected_etf = c1.selectbox("選擇 ETF", options=fast_etf_options, index=None, placeholder="請搜尋...")
-            new_cost = c2.number_input("成交均價", min_value=0.0)
-            new_qty = c3.number_input("股數", min_value=1, step=1)
+        with st.expander("➕ 新增交易紀錄", expanded=False):
+            search_text = st.text_input("🔍 搜尋 ETF", placeholder="輸入代號或名稱，例如 878、高股息")
+            c1, c2, c3 = st.columns([3, 1, 2])
+            etf_choices = registry.search(search_text) if search_text else fast_etf_options
+            selected_etf = c1.selectbox("選擇 ETF", options=etf_choices, index=0 if search_text and etf_choices else None,
+                                        format_func=registry.label, placeholder="請搜尋...")
+            new_kind = c2.selectbox("類型", options=LEDGER_TYPES)
+            new_date = c3.date_input("日期")
+            c4, c5, c6 = st.columns([3, 2, 1])
+            new_cost = c4.number_input("成交價 (配息填每股配息)", min_value=0.0)
+            new_qty = c5.number_input("股數", min_value=1, step=1)
             
-            if c4.button("儲存新持股"):
+            if c6.button("儲存紀錄"):
                 if selected_etf and new_qty > 0:
-                    code_to_save = selected_etf.split(" ")[0]
-                    if save_to_personal_sheet(my_sheet_url, code_to_save, new_cost, new_qty):
+                    code_to_save = selected_etf
+                    if save_to_personal_sheet(my_sheet_url, code_to_save, new_cost, new_qty, new_kind, new_date.strftime('%Y-%m-%d')):
                         st.success(f"已新增 {code_to_save}！")
-                        st.cache_data.clear()
+                        invalidate_sheet(my_sheet_url)
                         time.sleep(1); st.rerun()
                     else: st.error("儲存失敗，請檢查權限。")
                 else: st.warning("資料不完整")
 
-        if not user_df.empty and 'merged_df' in locals():
-            with st.expander("🛠️ 編輯 / 刪除現有持股", expanded=False):
-                merged_df['刪除'] = False
-                edit_df = merged_df[['刪除', '代號', '名稱', '股數', '成交均價']].copy()
+        if not user_df.empty:
+            with st.expander("🛠️ 編輯 / 刪除交易紀錄", expanded=False):
+                edit_df = user_df.copy()
+                edit_df['刪除'] = False
+                edit_df['名稱'] = edit_df['代號'].map(lambda code: (registry.get(code) or {}).get('name'))
+                edit_df['類型'] = edit_df['類型'].replace("", "買進")
+                edit_df['日期'] = edit_df['日期'].astype(str)  # 工作表讀回來可能被轉成數字
+                edit_df = edit_df[['刪除', '日期', '類型', '代號', '名稱', '股數', '成交均價', '列號']]
                 
                 edited_df = st.data_editor(
                     edit_df,
                     column_config={
                         "刪除": st.column_config.CheckboxColumn("刪除?", default=False),
+                        "日期": st.column_config.TextColumn("日期", help="YYYY-MM-DD"),
+                        "類型": st.column_config.SelectboxColumn("類型", options=LEDGER_TYPES, required=True),
                         "代號": st.column_config.TextColumn("代號", disabled=True),
                         "名稱": st.column_config.TextColumn("名稱", disabled=True),
                         "股數": st.column_config.NumberColumn("股數", min_value=1, step=1, format="%d"),
-                        "成交均價": st.column_config.NumberColumn("成交均價", min_value=0.0, format="%.2f"),
+                        "成交均價": st.column_config.NumberColumn("成交價", min_value=0.0, format="%.2f", help="配息時是每股配息"),
+                        "列號": None,  # 隱藏欄位：對應回工作表上的列，只寫回有變動的列
                     },
                     hide_index=True, use_container_width=True
                 )
                 
                 if st.button("💾 儲存變更", type="primary"):
                     rows_to_save = edited_df[edited_df['刪除'] == False]
-                    df_to_save = rows_to_save[['代號', '成交均價', '股數']].copy()
-                    if update_personal_sheet_batch(my_sheet_url, df_to_save):
+                    df_to_save = rows_to_save[[*SHEET_COLUMNS, '列號']].copy()
+                    if update_personal_sheet_batch(my_sheet_url, df_to_save, user_df):
                         st.success("✅ 更新成功！")
-                        st.cache_data.clear()
+                        invalidate_sheet(my_sheet_url)
                         time.sleep(1); st.rerun()
                     else: st.error("存檔失敗。")
 
     else: st.warning("請先從左側選單登入系統。")
+
+# --- 管理員效能面板 (帳號列在 secrets 的 admin_users) 與每次執行的 JSON 紀錄 ---
+run = metrics.end_run()
+log_run(run, page=page, user=st.session_state.get("current_user"))
+if st.session_state["logged_in"] and st.session_state["current_user"] in st.secrets.get("admin_users", []):
+    with st.sidebar.expander("⏱️ 效能監測", expanded=False):
+        st.caption(f"本次執行 {run['total_ms']:,.0f} ms")
+        if run["stages"]: st.dataframe(pd.Series(run["stages"], name="ms").sort_values(ascending=False), use_container_width=True)
+        
+        snap = metrics.snapshot()
+        stage_rows = [{"階段": labels.get("stage"), "標籤": ", ".join(f"{k}={v}" for k, v in labels.items() if k != "stage"),
+                       "次數": count, "平均ms": total / count * 1000, "p95ms": q[95] * 1000}
+                      for name, labels, count, total, q in snap["timers"] if name == "stage_seconds"]
+        if stage_rows:
+            st.write("**各階段累計 (本行程)**")
+            st.dataframe(pd.DataFrame(stage_rows).round(1), hide_index=True, use_container_width=True)
+        
+        events = pd.DataFrame([{"種類": name, "快取": labels.get("cache"), "事件": labels.get("event"), "次數": n}
+                               for name, labels, n in snap["counters"] if name in ("cache_events", "st_cache_events")])
+        if not events.empty:
+            st.write("**快取事件**")
+            st.dataframe(events.pivot_table(index=["種類", "快取"], columns="事件", values="次數", aggfunc="sum", fill_value=0),
+                         use_container_width=True)
+        
+        failures = {labels.get("reason"): n for name, labels, n in snap["counters"] if name == "refresh_failures"}
+        last_error = get_market_refresher().last_error
+        if failures or last_error:
+            st.write("**背景排行榜更新失敗**")
+            if failures: st.dataframe(pd.Series(failures, name="次數").rename_axis("原因"), use_container_width=True)
+            if last_error: st.caption(f"最後一次：{time.strftime('%Y-%m-%d %H:%M', time.localtime(last_error[0]))} {last_error[1]}")
+        
+        st.write("**上游請求**")
+        st.json(fetch_stats(), expanded=False)
+        st.download_button("下載 Prometheus 格式", metrics_text(), file_name="etf_metrics.prom", mime="text/plain", use_container_width=True)
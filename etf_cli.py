@@ -0,0 +1,271 @@
+"""排程批次用的命令列工具：不啟動 Streamlit、不需要 Google 憑證。
+
+    python etf_cli.py ranking -o ranking.csv --publish   # 預先算好排行榜並交給網頁直接使用
+    python etf_cli.py portfolio holdings.csv -o valuation.json
+    python etf_cli.py history 0050 --since 2025-01-01       # 從歷史快照查單一 ETF 的走勢
+    python etf_cli.py ingest                                # 收盤後記一次全市場收盤價 (排程每天跑，任何 ETF_QUOTE_SOURCE 都適用)
+    python etf_cli.py ingest --market 上市 STOCK_DAY_ALL_20250103.csv ...   # 用下載好的舊檔補歷史
+    python etf_cli.py bench-ledger -n 50000                 # 交易帳本計算的基準測試
+    python etf_cli.py bench-memory --sessions 100           # 排行榜經過 st.cache_data vs st.cache_resource 的讀取時間與記憶體
+    python etf_cli.py bench-parse tests/fixtures/histock     # 每頁解析時間與記憶體高峰：完整建樹 vs 只建需要的節點
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import etf_core
+
+def write_output(df, path):
+    if path == "-":
+        df.to_csv(sys.stdout, index=False)
+    elif path.endswith(".json"):
+        df.to_json(path, orient="records", force_ascii=False, indent=2)
+    elif path.endswith(".csv"):
+        df.to_csv(path, index=False, encoding="utf-8-sig")  # 加 BOM，Excel 開中文才不會亂碼
+    else:
+        raise SystemExit(f"不支援的輸出格式：{path} (請用 .csv 或 .json)")
+
+def print_progress(done, total, code):
+    print(f"\r🚀 正在分析 [{done}/{total}]: {code} ...", end="" if done < total else "\n", file=sys.stderr)
+
+def cmd_ranking(args):
+    start = time.perf_counter()
+    df = etf_core.build_market_ranking(None if args.quiet else print_progress)
+    if df.empty: raise SystemExit("掃描失敗：沒有取得任何 ETF 資料")
+    df = df.sort_values(by='綜合平均%', ascending=False).reset_index(drop=True)
+    write_output(df, args.output)
+    if args.publish: etf_core.save_ranking_snapshot(df)
+    print(f"完成：{len(df)} 檔 ETF，耗時 {time.perf_counter() - start:.1f} 秒", file=sys.stderr)
+
+def cmd_portfolio(args):
+    start = time.perf_counter()
+    etf_core.get_etf_registry()  # 讀檔前先載入名冊，代號才能對照名冊正規化
+    try: positions = etf_core.build_positions(etf_core.load_holdings_file(args.holdings), args.method)
+    except ValueError as e: raise SystemExit(f"交易紀錄有誤：{e}")
+    holdings = positions[positions['股數'] > 0]
+    codes = list(holdings['代號'])
+    details = [data for data in etf_core.scan_market(codes, etf_core.fetch_etf_details, None if args.quiet else print_progress) if data]
+    if not details: raise SystemExit("沒有任何有效報價資料")
+    merged_df = etf_core.value_portfolio(holdings[['代號', '成交均價', '股數']], details)
+    write_output(merged_df, args.output)
+    for key, value in etf_core.portfolio_summary(merged_df, positions).items():
+        print(f"{key}: {value:,.2f}", file=sys.stderr)
+    print(f"耗時 {time.perf_counter() - start:.1f} 秒", file=sys.stderr)
+
+def cmd_history(args):
+    store = etf_core.get_history_store()
+    if args.code: df = store.code_history(etf_core.normalize_code(args.code), args.since, args.until)
+    else: df = store.ranking_history(args.since, args.until)
+    if df.empty: raise SystemExit("這段期間沒有任何歷史快照")
+    write_output(df, args.output)
+
+def cmd_ingest(args):
+    if not args.files:
+        # 不給檔案：每個市場抓今天的行情檔
+        for market, result in etf_core.ingest_all_markets(args.date).items():
+            if isinstance(result, Exception): print(f"{market}：失敗 {result}", file=sys.stderr)
+            else: print(f"{market}：{result} 筆" + ("" if result else " (跟前一個交易日相同，視為還沒更新，略過)"), file=sys.stderr)
+        return
+    if not args.market: raise SystemExit("補匯檔案時要用 --market 指定 上市 或 上櫃")
+    total = 0
+    for path in args.files:
+        # 檔案本身沒有日期時，用 --date 或檔名裡的日期 (例如 STOCK_DAY_ALL_20250103.csv)，不用現在的時間去猜
+        trade_date = args.date or etf_core.parse_quote_date(os.path.basename(path))
+        try: count = etf_core.ingest_daily_quotes(path, args.market, trade_date, guess_date=False)
+        except (OSError, ValueError) as e: raise SystemExit(f"{path}：{e}")
+        print(f"{path}：{count} 筆", file=sys.stderr)
+        total += count
+    print(f"完成：{len(args.files)} 個檔、共 {total} 筆，價格歷史最新到 {etf_core.get_price_store().latest_date()}", file=sys.stderr)
+
+def random_ledger(n, codes, seed=0):
+    """產生 n 筆看起來像真的交易紀錄：約六成買進、三成賣出 (不會賣超過持有)、一成配息"""
+    rng = np.random.default_rng(seed)
+    code = rng.choice(codes, size=n)
+    kind = rng.choice(etf_core.LEDGER_TYPES, size=n, p=[0.6, 0.3, 0.1])
+    qty = rng.integers(1, 20, size=n) * 100
+    buys = pd.Series(np.where(kind == "買進", qty, 0)).groupby(code).cumsum()
+    sells = pd.Series(np.where(kind == "賣出", qty, 0)).groupby(code).cumsum()
+    kind[(kind == "賣出") & (sells > buys).to_numpy()] = "買進"  # 會賣超的改成買進，保證帳本合法
+    return pd.DataFrame({
+        '代號': code, '成交均價': np.round(rng.uniform(10, 150, size=n), 2), '股數': qty, '類型': kind,
+        '日期': (pd.Timestamp("2015-01-01") + pd.to_timedelta(np.sort(rng.integers(0, 3650, size=n)), unit="D")).strftime('%Y-%m-%d'),
+    })
+
+def cmd_bench_ledger(args):
+    ledger = random_ledger(args.transactions, [f"00{900 + i}" for i in range(args.codes)])
+    print(f"帳本：{len(ledger):,} 筆交易、{args.codes} 檔 ETF", file=sys.stderr)
+    for method in ("average", "fifo"):
+        etf_core.build_positions(ledger, method)  # 暖身
+        runs = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            positions = etf_core.build_positions(ledger, method)
+            runs.append(time.perf_counter() - start)
+        print(f"{method:>7}: 最佳 {min(runs) * 1000:.1f} ms、中位數 {sorted(runs)[len(runs) // 2] * 1000:.1f} ms "
+              f"({len(ledger) / min(runs):,.0f} 筆/秒)，持有 {int((positions['股數'] > 0).sum())} 檔", file=sys.stderr)
+
+def random_ranking(n, seed=0):
+    """跟 fetch_etf_performance 結果同樣欄位的假排行榜 (文字欄是 object、數字是 float64，跟以前 st.cache_data 存的一樣)"""
+    rng = np.random.default_rng(seed)
+    issuers = ["元大", "國泰", "富邦", "群益", "復華", "中信", "永豐", "統一", "凱基", "大華"]
+    themes = ["台灣50", "高股息", "科技優息", "美國20年債", "半導體", "ESG永續", "特選Nasdaq", "投資級公司債", "臺灣中小", "5G通訊"]
+    df = pd.DataFrame({
+        '代號': [f"00{600 + i}" for i in range(n)],
+        '名稱': [f"{rng.choice(issuers)}{rng.choice(themes)}" for _ in range(n)],
+        '市場別': rng.choice(["上市", "上櫃"], size=n, p=[0.7, 0.3]),
+        '現價': np.round(rng.uniform(8, 200, size=n), 2),
+        **{col: np.round(rng.normal(5, 15, size=n), 2) for col in ['一季%', '半年%', '一年%', '綜合平均%']},
+    })
+    return df.astype({'代號': object, '名稱': object, '市場別': object})
+
+def measure_sessions(load, sessions):
+    """模擬 sessions 個 session 各自讀一次 (結果在頁面執行期間都還被拿著)：回傳 (每次讀取秒數的中位數, 多佔的記憶體 bytes)"""
+    load()  # 第一次是算出結果並放進快取，不算
+    runs = []
+    for _ in range(sessions):
+        start = time.perf_counter()
+        load()
+        runs.append(time.perf_counter() - start)
+    tracemalloc.start()  # 記憶體另外量，tracemalloc 會拖慢上面的計時
+    held = [load() for _ in range(sessions)]
+    retained = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del held
+    return sorted(runs)[len(runs) // 2], retained
+
+def cmd_bench_memory(args):
+    import streamlit as st
+    import streamlit.logger
+    streamlit.logger.set_log_level("error")  # 沒有 streamlit run 時快取照樣可用，只是會警告沒有 runtime
+    if args.from_cache:
+        entry = etf_core.get_scrape_cache().get("ranking", "all")
+        if entry is None: raise SystemExit("快取裡還沒有排行榜，先跑一次 ranking --publish")
+        df = pd.DataFrame(entry["value"]["rows"]).astype({'代號': object, '名稱': object, '市場別': object})
+    else: df = random_ranking(args.etfs)
+    
+    # 跟頁面一樣經過真正的 Streamlit 快取：cache_data 每次讀取都從 pickle 還原一份新的表，cache_resource 回傳同一個物件
+    variants = {
+        "以前：st.cache_data，原始型別": st.cache_data(lambda: df.copy()),
+        "st.cache_data，精簡型別": st.cache_data(lambda: etf_core.compact_market_frame(df)),
+        "現在：st.cache_resource，精簡型別": st.cache_resource(lambda: etf_core.compact_market_frame(df)),
+    }
+    mb = lambda n: f"{n / 1024 / 1024:,.2f} MB" if n >= 1024 * 1024 else f"{n / 1024:,.1f} KB"
+    print(f"排行榜：{len(df)} 檔 (原始 {mb(df.memory_usage(deep=True).sum())}、精簡 "
+          f"{mb(etf_core.compact_market_frame(df).memory_usage(deep=True).sum())})，{args.sessions} 個 session 同時讀取", file=sys.stderr)
+    results = {label: measure_sessions(load, args.sessions) for label, load in variants.items()}
+    baseline = results["以前：st.cache_data，原始型別"][1]
+    for label, (per_access, retained) in results.items():
+        print(f"  {label}", file=sys.stderr)
+        print(f"    每次讀取 {per_access * 1000:.3f} ms，{args.sessions} 個 session 多佔 {mb(retained)}"
+              + (f" (省下 {1 - retained / baseline:.1%})" if retained != baseline else ""), file=sys.stderr)
+
+PAGE_PARSERS = {  # 頁面種類 -> (解析函式, 對應的 SoupStrainer 名稱)
+    "perf": (lambda html, code: etf_core.parse_etf_performance(html, code), "PERF_STRAINER"),
+    "dividend": (lambda html, code: etf_core.parse_dividend_records(html), "DIV_STRAINER"),
+    "list": (lambda html, code: etf_core.parse_etf_universe(html), "LIST_STRAINER"),
+}
+
+def load_pages(root):
+    """目錄裡的 .html (路徑就是網址路徑，跟 etf_loadtest 的 fixtures 一樣)，依頁面種類分組：{種類: [(代號, html)]}"""
+    pages = {kind: [] for kind in PAGE_PARSERS}
+    for folder, _, files in os.walk(root):
+        for name in sorted(files):
+            if not name.endswith(".html"): continue
+            with open(os.path.join(folder, name), encoding="utf-8") as f: html = f.read()
+            if name == "etf.aspx.html": pages["list"].append(("", html))
+            elif name == f"{etf_core.DIVIDEND_PAGE_NAME}.html": pages["dividend"].append((os.path.basename(folder), html))
+            else: pages["perf"].append((name[:-len(".html")], html))
+    return pages
+
+def measure_parse(parse, pages, repeat):
+    """每頁取 repeat 次裡最快的一次，回傳 (平均每頁毫秒, 平均每頁記憶體高峰 bytes)"""
+    best, peaks = [], []
+    for code, html in pages:
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            parse(html, code)
+            runs.append(time.perf_counter() - start)
+        best.append(min(runs))
+        tracemalloc.start()
+        parse(html, code)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return sum(best) / len(best) * 1000, sum(peaks) / len(peaks)
+
+def cmd_bench_parse(args):
+    pages = load_pages(args.pages)
+    if not any(pages.values()): raise SystemExit(f"{args.pages} 裡沒有任何 .html 頁面")
+    print(f"{'頁面':<8}{'頁數':>5}{'平均大小':>10}{'完整建樹':>12}{'只建需要的':>12}{'加速':>7}{'記憶體 (完整)':>14}{'記憶體 (精簡)':>14}", file=sys.stderr)
+    for kind, (parse, strainer) in PAGE_PARSERS.items():
+        if not pages[kind]: continue
+        strained = measure_parse(parse, pages[kind], args.repeat)
+        original = getattr(etf_core, strainer)
+        setattr(etf_core, strainer, None)  # parse_only=None 就是原本的完整解析，其他邏輯完全相同
+        try: full = measure_parse(parse, pages[kind], args.repeat)
+        finally: setattr(etf_core, strainer, original)
+        size = sum(len(html.encode("utf-8")) for _, html in pages[kind]) / len(pages[kind])
+        print(f"{kind:<8}{len(pages[kind]):>5}{size / 1024:>8.1f}KB{full[0]:>10.2f}ms{strained[0]:>10.2f}ms{full[0] / strained[0]:>6.1f}x"
+              f"{full[1] / 1024:>12.0f}KB{strained[1] / 1024:>12.0f}KB", file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="台股 ETF 資產管家 - 批次工具")
+    parser.add_argument("--workers", type=int, help="同時連線數上限 (預設 ETF_SCAN_WORKERS)")
+    parser.add_argument("-q", "--quiet", action="store_true", help="不顯示進度")
+    parser.add_argument("--metrics", help="結束時把效能統計以 Prometheus 文字格式寫到這個檔 (- 代表 stderr)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    
+    p = sub.add_parser("ranking", help="掃描全市場 ETF 績效排行")
+    p.add_argument("-o", "--output", default="-", help="輸出檔 (.csv / .json，預設印到 stdout)")
+    p.add_argument("--publish", action="store_true", help="同時寫入共用快取，網頁直接讀這一份")
+    p.set_defaults(func=cmd_ranking)
+    
+    p = sub.add_parser("portfolio", help="計算一份持股 CSV 的估值與配息")
+    p.add_argument("holdings", help="持股 CSV (欄位：代號、成交均價 或 成本、股數，可再加 類型、日期)")
+    p.add_argument("-o", "--output", default="-", help="輸出檔 (.csv / .json，預設印到 stdout)")
+    p.add_argument("--method", choices=["average", "fifo"], default="average", help="成本計算方式 (預設移動平均)")
+    p.set_defaults(func=cmd_portfolio)
+    
+    p = sub.add_parser("history", help="查詢排行榜歷史快照")
+    p.add_argument("code", nargs="?", help="ETF 代號；不填就輸出期間內的所有快照")
+    p.add_argument("--since", help="起始日 (YYYY-MM-DD)")
+    p.add_argument("--until", help="結束日 (YYYY-MM-DD，含當天)")
+    p.add_argument("-o", "--output", default="-", help="輸出檔 (.csv / .json，預設印到 stdout)")
+    p.set_defaults(func=cmd_history)
+    
+    p = sub.add_parser("ingest", help="把交易所的每日收盤行情存進價格歷史 (整批行情模式的資料來源)")
+    p.add_argument("files", nargs="*", help="下載好的行情 CSV，用來補歷史；不給就抓今天的 (ETF_TWSE_QUOTES / ETF_TPEX_QUOTES)")
+    p.add_argument("--market", choices=list(etf_core.BULK_QUOTE_SOURCES), help="補匯檔案所屬的市場")
+    p.add_argument("--date", help="交易日 (YYYY-MM-DD)；檔案本身有日期時以檔案為準")
+    p.set_defaults(func=cmd_ingest)
+    
+    p = sub.add_parser("bench-ledger", help="交易帳本部位計算的基準測試")
+    p.add_argument("-n", "--transactions", type=int, default=50000, help="交易筆數 (預設 50000)")
+    p.add_argument("--codes", type=int, default=30, help="ETF 檔數 (預設 30)")
+    p.add_argument("--repeat", type=int, default=5, help="重複次數 (預設 5)")
+    p.set_defaults(func=cmd_bench_ledger)
+    
+    p = sub.add_parser("bench-memory", help="排行榜記憶體基準測試：每個 session 一份 vs 行程共用一份")
+    p.add_argument("--etfs", type=int, default=300, help="假排行榜的 ETF 檔數 (預設 300)")
+    p.add_argument("--sessions", type=int, default=100, help="同時在線的 session 數 (預設 100)")
+    p.add_argument("--from-cache", action="store_true", help="改用快取裡真正的排行榜")
+    p.set_defaults(func=cmd_bench_memory)
+    
+    p = sub.add_parser("bench-parse", help="HTML 解析基準測試：每頁耗時與記憶體高峰，完整建樹 vs 只建需要的節點")
+    p.add_argument("pages", help="存好的頁面目錄 (例如 tests/fixtures/histock，或 etf_loadtest.py record 錄的目錄)")
+    p.add_argument("--repeat", type=int, default=20, help="每頁重複次數，取最快的一次 (預設 20)")
+    p.set_defaults(func=cmd_bench_parse)
+    
+    args = parser.parse_args(argv)
+    if args.workers: etf_core.SCAN_WORKERS = args.workers
+    try: args.func(args)
+    finally:
+        if args.metrics == "-": print(etf_core.metrics_text(), end="", file=sys.stderr)
+        elif args.metrics:
+            with open(args.metrics, "w", encoding="utf-8") as f: f.write(etf_core.metrics_text())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1662 @@
+"""台股 ETF 資產管家的核心邏輯：爬蟲、快取、排行榜與持股估值。
+
+這個模組不依賴 Streamlit，也不需要 Google 憑證，import 時不會有任何副作用，
+可以直接給 etf_cli.py 的排程批次、基準測試或其他程式使用。
+"""
+import requests
+from bs4 import BeautifulSoup, SoupStrainer
+import pandas as pd
+import numpy as np
+import time
+import os
+import io
+import sys
+import json
+import sqlite3
+import threading
+import copy
+import random
+import shutil
+import hashlib
+import numbers
+from collections import deque
+from urllib.parse import urlsplit, quote
+import re  # ★ 新增：強大的正則表達式套件，用來抓年份
+import bisect
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from gspread.utils import numericise_all
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+headers = {"User-Agent": "Mozilla/5.0"}
+HISTOCK_BASE = os.environ.get("ETF_HISTOCK_BASE", "https://histock.tw")  # 壓力測試時指向本機的重播伺服器
+
+# --- 掃描引擎設定 (可用環境變數調整) ---
+SCAN_WORKERS = int(os.environ.get("ETF_SCAN_WORKERS", "8"))         # 同時連線數上限
+SCAN_INTERVAL = float(os.environ.get("ETF_SCAN_INTERVAL", "0.05"))  # 兩個請求之間的最小間隔 (秒)，對 histock 客氣一點
+
+HTTP_TIMEOUT = (float(os.environ.get("ETF_CONNECT_TIMEOUT", "3.05")),  # 連線逾時 (秒)
+                float(os.environ.get("ETF_READ_TIMEOUT", "10")))       # 讀取逾時 (秒)
+HTTP_RETRIES = int(os.environ.get("ETF_HTTP_RETRIES", "3"))  # 逾時、連線失敗、429/5xx 最多重試幾次
+HTTP_BACKOFF = 0.5          # 重試等待的基準秒數，每次加倍並隨機抖動
+BREAKER_THRESHOLD = 5       # 同一個主機連續失敗幾次就斷路
+BREAKER_COOLDOWN = 30       # 斷路後多久放一個試探請求過去 (秒)
+
+# --- ★ 效能監測：各階段耗時與快取事件，可匯出 Prometheus 文字格式或每次執行一行 JSON ★ ---
+METRICS_LOG = os.environ.get("ETF_METRICS_LOG", "")  # 每次頁面執行寫一行 JSON："-" = stderr、其他 = 檔案路徑、空白 = 不寫
+
+class Metrics:
+    """整個行程共用的計數器與計時器 (名稱 + 標籤)。
+
+    另外用 thread-local 記下「這一次頁面執行」在主執行緒上的各階段耗時與事件，
+    掃描 worker 執行緒裡發生的只進行程總計。"""
+    def __init__(self, window=1024):
+        self.window = window
+        self._lock = threading.Lock()
+        self._counters = {}  # (名稱, 標籤) -> 次數
+        self._timers = {}    # (名稱, 標籤) -> {"count", "sum", "samples"}
+        self._local = threading.local()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, n=1, **labels):
+        key = self._key(name, labels)
+        with self._lock: self._counters[key] = self._counters.get(key, 0) + n
+        run = getattr(self._local, "run", None)
+        if run is not None:
+            label = ",".join(f"{k}={v}" for k, v in key[1])
+            run["counts"][f"{name}{{{label}}}"] = run["counts"].get(f"{name}{{{label}}}", 0) + n
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            timer = self._timers.get(key)
+            if timer is None: timer = self._timers[key] = {"count": 0, "sum": 0.0, "samples": deque(maxlen=self.window)}
+            timer["count"] += 1
+            timer["sum"] += seconds
+            timer["samples"].append(seconds)
+        run = getattr(self._local, "run", None)
+        if run is not None and "stage" in labels:
+            run["stages"][labels["stage"]] = run["stages"].get(labels["stage"], 0.0) + seconds
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        start = time.perf_counter()
+        try: yield
+        finally: self.observe("stage_seconds", time.perf_counter() - start, stage=stage, **labels)
+
+    def begin_run(self):
+        self._local.run = {"started": time.perf_counter(), "stages": {}, "counts": {}}
+
+    def end_run(self):
+        """結束這次頁面執行，回傳 {"total_ms", "stages" (毫秒), "counts"}；沒有 begin_run 過就是 None"""
+        run = getattr(self._local, "run", None)
+        self._local.run = None
+        if run is None: return None
+        return {"total_ms": round((time.perf_counter() - run["started"]) * 1000, 1),
+                "stages": {stage: round(seconds * 1000, 1) for stage, seconds in run["stages"].items()},
+                "counts": run["counts"]}
+
+    def snapshot(self):
+        """{"counters": [(名稱, 標籤, 次數)], "timers": [(名稱, 標籤, 次數, 總秒數, {p50/p95/p99 秒})]}"""
+        with self._lock:
+            counters = [(name, dict(labels), n) for (name, labels), n in sorted(self._counters.items())]
+            timers = [(name, dict(labels), t["count"], t["sum"], sorted(t["samples"])) for (name, labels), t in sorted(self._timers.items())]
+        return {"counters": counters,
+                "timers": [(name, labels, count, total, {p: samples[min(len(samples) - 1, int(len(samples) * p / 100))] for p in (50, 95, 99)})
+                           for name, labels, count, total, samples in timers]}
+
+@lru_cache(maxsize=None)
+def get_metrics():
+    return Metrics()
+
+def _prom_labels(labels):
+    if not labels: return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+def metrics_text():
+    """Prometheus 文字格式：各階段耗時、快取事件、上游請求、斷路器與 single-flight 統計"""
+    snap = get_metrics().snapshot()
+    lines = []
+    typed = set()
+    def emit(name, kind, labels, value):
+        if name not in typed:
+            lines.append(f"# TYPE {name} {kind}")
+            typed.add(name)
+        lines.append(f"{name}{_prom_labels(labels)} {value}")
+    
+    for name, labels, count, total, quantiles in snap["timers"]:
+        for p, value in quantiles.items(): emit(f"etf_{name}", "summary", {**labels, "quantile": p / 100}, f"{value:.6f}")
+        lines.append(f"etf_{name}_sum{_prom_labels(labels)} {total:.6f}")
+        lines.append(f"etf_{name}_count{_prom_labels(labels)} {count}")
+    for name, labels, n in snap["counters"]: emit(f"etf_{name}_total", "counter", labels, n)
+    
+    upstream = fetch_stats()
+    for key in ("requests", "retries", "failures", "short_circuited"): emit(f"etf_upstream_{key}_total", "counter", {}, upstream[key])
+    for p in (50, 95, 99): emit("etf_upstream_latency_seconds", "summary", {"quantile": p / 100}, upstream[f"p{p}_ms"] / 1000)
+    emit("etf_upstream_rate_per_second", "gauge", {}, upstream["rate_per_sec"])
+    for host, state in upstream["breakers"].items(): emit("etf_breaker_open", "gauge", {"host": host}, int(state != "closed"))
+    for kind, counts in get_single_flight().stats().items():
+        for outcome, n in counts.items(): emit("etf_singleflight_total", "counter", {"kind": kind, "outcome": outcome}, n)
+    return "\n".join(lines) + "\n"
+
+def log_run(run, **fields):
+    """把 end_run() 的結果寫成一行 JSON (ETF_METRICS_LOG 有設定才寫)"""
+    if not METRICS_LOG or run is None: return
+    line = json.dumps({"ts": round(time.time(), 3), **fields, **run}, ensure_ascii=False)
+    if METRICS_LOG == "-": print(line, file=sys.stderr, flush=True)
+    else:
+        with open(METRICS_LOG, "a", encoding="utf-8") as f: f.write(line + "\n")
+
+class CircuitOpenError(requests.RequestException):
+    """上游已經斷路，直接失敗而不是讓每個 session 都卡在逾時上"""
+
+class RateLimiter:
+    """所有 worker 共用的 token bucket；遇到 429/5xx 速率減半，之後每次成功再慢慢加回上限"""
+    def __init__(self, rate, burst=1):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.max_rate == float("inf"): return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def penalize(self):
+        with self._lock: self.rate = max(self.max_rate / 32, self.rate / 2)
+
+    def reward(self):
+        with self._lock: self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None: return True
+            if time.monotonic() - self.opened_at < self.cooldown: return False
+            self.opened_at = time.monotonic()  # 半開：這次放行當試探，其他請求再等一輪冷卻
+            return True
+
+    def record_success(self):
+        with self._lock: self.failures, self.opened_at = 0, None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold: self.opened_at = time.monotonic()
+
+    @property
+    def state(self):
+        return "closed" if self.opened_at is None else "open"
+
+class FetchStats:
+    """上游請求的次數與延遲分布，只保留最近的樣本"""
+    def __init__(self, window=4096):
+        self._latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.counts = {"requests": 0, "retries": 0, "failures": 0, "short_circuited": 0}
+
+    def add(self, name, n=1):
+        with self._lock: self.counts[name] += n
+
+    def observe(self, seconds):
+        with self._lock:
+            self.counts["requests"] += 1
+            self._latencies.append(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            samples = sorted(self._latencies)
+            result = dict(self.counts)
+        for p in (50, 95, 99):
+            result[f"p{p}_ms"] = round(samples[min(len(samples) - 1, int(len(samples) * p / 100))] * 1000, 1) if samples else 0.0
+        return result
+
+@lru_cache(maxsize=None)
+def get_http_session():
+    # 共用 keep-alive 連線池，避免每檔 ETF 都重新握手
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=SCAN_WORKERS)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update(headers)
+    return session
+
+@lru_cache(maxsize=None)
+def get_rate_limiter():
+    return RateLimiter(1 / SCAN_INTERVAL if SCAN_INTERVAL > 0 else float("inf"))
+
+_breakers = {}  # 主機 -> CircuitBreaker
+_breakers_lock = threading.Lock()
+
+def get_breaker(host):
+    with _breakers_lock:
+        if host not in _breakers: _breakers[host] = CircuitBreaker(BREAKER_THRESHOLD, BREAKER_COOLDOWN)
+        return _breakers[host]
+
+@lru_cache(maxsize=None)
+def get_fetch_stats():
+    return FetchStats()
+
+def _retry_delay(attempt, response):
+    retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+    if retry_after.isdigit(): return min(float(retry_after), 30)
+    return random.uniform(0, HTTP_BACKOFF * 2 ** attempt)  # full jitter，避免所有 worker 同時重試
+
+def http_get(url, extra_headers=None):
+    """所有對外請求的共用入口：速率限制、逾時、有限次數重試，以及每個主機各自的斷路器。
+    
+    4xx (429 以外) 視為上游正常、直接回傳；重試用完仍是 429/5xx 就回傳最後一個回應，
+    由呼叫端 raise_for_status()；連線層面的錯誤則直接拋出。"""
+    stats = get_fetch_stats()
+    breaker = get_breaker(urlsplit(url).netloc)
+    if not breaker.allow():
+        stats.add("short_circuited")
+        raise CircuitOpenError(f"{urlsplit(url).netloc} 暫時斷路中")
+    
+    limiter = get_rate_limiter()
+    response, error = None, None
+    for attempt in range(HTTP_RETRIES + 1):
+        if attempt: stats.add("retries")
+        limiter.acquire()
+        start = time.perf_counter()
+        try:
+            response, error = get_http_session().get(url, headers=extra_headers, timeout=HTTP_TIMEOUT), None
+        except (requests.ConnectionError, requests.Timeout) as e:
+            response, error = None, e
+        stats.observe(time.perf_counter() - start)
+        get_metrics().observe("stage_seconds", time.perf_counter() - start, stage="upstream", host=urlsplit(url).netloc)
+        
+        if response is not None and response.status_code != 429 and response.status_code < 500:
+            limiter.reward()
+            breaker.record_success()
+            return response
+        if response is not None: limiter.penalize()  # 上游喊累了，整體放慢
+        if attempt < HTTP_RETRIES: time.sleep(_retry_delay(attempt, response))
+    
+    stats.add("failures")
+    breaker.record_failure()
+    if error is not None: raise error
+    return response
+
+def fetch_stats():
+    """上游請求統計：次數、重試、失敗、斷路擋下的次數、p50/p95/p99 延遲、目前速率與各主機斷路器狀態"""
+    result = get_fetch_stats().snapshot()
+    result["rate_per_sec"] = round(get_rate_limiter().rate, 2)
+    with _breakers_lock: result["breakers"] = {host: breaker.state for host, breaker in _breakers.items()}
+    return result
+
+# --- 持久化爬蟲快取 (SQLite) ---
+CACHE_PATH = os.environ.get("ETF_CACHE_PATH", "etf_cache.db")
+CACHE_MAX_ENTRIES = int(os.environ.get("ETF_CACHE_MAX_ENTRIES", "5000"))
+CACHE_TTL = {"perf": 3600, "universe": 86400, "ranking": 7 * 86400}  # 各類資料的有效秒數
+CACHE_TOUCH_INTERVAL = 300  # accessed_at 只給淘汰順序用，隔這麼久 (秒) 才更新一次，命中時大多不必寫資料庫
+DIVIDEND_TTL = int(os.environ.get("ETF_DIVIDEND_TTL", str(7 * 86400)))  # 配息紀錄多久跟 histock 重新同步一次 (秒)
+REFRESH_INTERVAL = int(os.environ.get("ETF_REFRESH_INTERVAL", "3000"))  # 背景重建排行榜的週期 (秒)，要比快取 TTL 短
+REFRESH_LEASE_TTL = 120  # 重建租約的有效秒數；重建途中會一直續約，行程掛掉的話其他行程最多等這麼久就能接手
+
+class SQLiteStore:
+    """共用的 SQLite 連線管理：每個執行緒一條連線，WAL 模式讓多個 Streamlit 行程同時讀寫"""
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()  # sqlite 連線不能跨執行緒，每個執行緒各開一條
+        with self._conn() as conn: self._init_schema(conn)
+
+    def _init_schema(self, conn):
+        pass
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")  # 讀寫不互鎖，多個 Streamlit 行程同時存取
+            self._local.conn = conn
+        return conn
+
+class ScrapeCache(SQLiteStore):
+    """以 (資料種類, ETF 代號) 為 key 的磁碟快取，重啟或 st.cache_data.clear() 後仍然有效，多個行程可共用同一個檔案"""
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        super().__init__(path)
+
+    def _init_schema(self, conn):
+        conn.execute("""CREATE TABLE IF NOT EXISTS scrape_cache (
+            kind TEXT NOT NULL, code TEXT NOT NULL, value TEXT NOT NULL,
+            etag TEXT, last_modified TEXT,
+            expires_at REAL NOT NULL, accessed_at REAL NOT NULL,
+            PRIMARY KEY (kind, code))""")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_scrape_cache_accessed ON scrape_cache (accessed_at)")
+        # 版本號：st.cache_data 以它當參數，遞增就等於讓該範圍的快取失效 (跨行程有效)
+        conn.execute("CREATE TABLE IF NOT EXISTS cache_rev (scope TEXT PRIMARY KEY, rev INTEGER NOT NULL)")
+        # 租約：多個行程之間只讓一個去做背景重建
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def get(self, kind, code):
+        with self._conn() as conn:
+            row = conn.execute("SELECT value, etag, last_modified, expires_at, accessed_at FROM scrape_cache WHERE kind=? AND code=?",
+                               (kind, code)).fetchone()
+            if row is None:
+                get_metrics().inc("cache_events", cache=kind, event="miss")
+                return None
+            now = time.time()
+            if now - row[4] > CACHE_TOUCH_INTERVAL:  # 只有讀取沒有寫入時不會開交易，不必排隊等寫入鎖
+                conn.execute("UPDATE scrape_cache SET accessed_at=? WHERE kind=? AND code=?", (now, kind, code))
+        fresh = row[3] > now
+        get_metrics().inc("cache_events", cache=kind, event="hit" if fresh else "stale")
+        return {"value": json.loads(row[0]), "etag": row[1], "last_modified": row[2], "fresh": fresh}
+
+    def fresh_values(self, kind, codes):
+        """一次查出 codes 裡還沒過期的項目 {代號: 內容}，只記命中；沒有或過期的留給之後真的去抓時記 miss / stale"""
+        now = time.time()
+        rows = []
+        with self._conn() as conn:
+            for start in range(0, len(codes), 500):  # SQLite 一個語句的參數個數有上限
+                chunk = list(codes[start:start + 500])
+                rows += conn.execute(f"""SELECT code, value, accessed_at FROM scrape_cache
+                                         WHERE kind=? AND expires_at>? AND code IN ({','.join('?' * len(chunk))})""",
+                                     (kind, now, *chunk)).fetchall()
+            touched = [(now, kind, code) for code, _, accessed in rows if now - accessed > CACHE_TOUCH_INTERVAL]
+            if touched: conn.executemany("UPDATE scrape_cache SET accessed_at=? WHERE kind=? AND code=?", touched)
+        if rows: get_metrics().inc("cache_events", len(rows), cache=kind, event="hit")
+        return {code: json.loads(value) for code, value, _ in rows}
+
+    def put(self, kind, code, value, etag=None, last_modified=None):
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO scrape_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+                         (kind, code, json.dumps(value, ensure_ascii=False), etag, last_modified, now + CACHE_TTL[kind], now))
+            # 超過上限就把最久沒被讀取的項目淘汰掉
+            overflow = conn.execute("SELECT COUNT(*) FROM scrape_cache").fetchone()[0] - self.max_entries
+            if overflow > 0:
+                conn.execute("DELETE FROM scrape_cache WHERE rowid IN (SELECT rowid FROM scrape_cache ORDER BY accessed_at LIMIT ?)", (overflow,))
+                get_metrics().inc("cache_events", overflow, cache="scrape", event="evict")
+
+    def touch(self, kind, code):
+        # 伺服器回 304：內容沒變，只延長有效期限
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("UPDATE scrape_cache SET expires_at=?, accessed_at=? WHERE kind=? AND code=?",
+                         (now + CACHE_TTL[kind], now, kind, code))
+
+    def expire(self, kind, codes=None):
+        # 標記為過期但保留內容與 ETag，下次讀取時走條件式請求；codes 為 None 代表整類
+        with self._conn() as conn:
+            if codes is None:
+                conn.execute("UPDATE scrape_cache SET expires_at=0 WHERE kind=?", (kind,))
+            else:
+                conn.executemany("UPDATE scrape_cache SET expires_at=0 WHERE kind=? AND code=?", [(kind, c) for c in codes])
+
+    def revisions(self, *scopes):
+        with self._conn() as conn:
+            rows = dict(conn.execute(f"SELECT scope, rev FROM cache_rev WHERE scope IN ({','.join('?' * len(scopes))})", scopes).fetchall())
+        return tuple(rows.get(scope, 0) for scope in scopes)
+
+    def bump(self, *scopes):
+        with self._conn() as conn:
+            conn.executemany("INSERT INTO cache_rev VALUES (?, 1) ON CONFLICT(scope) DO UPDATE SET rev = rev + 1", [(scope,) for scope in scopes])
+
+    def acquire_lease(self, name, ttl):
+        now = time.time()
+        with self._conn() as conn:
+            cur = conn.execute("""INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT(name)
+                                  DO UPDATE SET holder=excluded.holder, expires_at=excluded.expires_at WHERE leases.expires_at < ?""",
+                               (name, str(os.getpid()), now + ttl, now))
+            return cur.rowcount > 0
+
+    def renew_lease(self, name, ttl):
+        """延長自己持有的租約；已經不是自己的 (過期後被別人拿走) 就回傳 False"""
+        with self._conn() as conn:
+            cur = conn.execute("UPDATE leases SET expires_at=? WHERE name=? AND holder=?", (time.time() + ttl, name, str(os.getpid())))
+            return cur.rowcount > 0
+
+    def release_lease(self, name):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM leases WHERE name=? AND holder=?", (name, str(os.getpid())))
+
+@lru_cache(maxsize=None)
+def get_scrape_cache():
+    return ScrapeCache(CACHE_PATH, CACHE_MAX_ENTRIES)
+
+class DividendStore(SQLiteStore):
+    """每檔 ETF 的配息紀錄 (發放年度、除息日、現金股利)；一年只變動幾次，跟報價分開存，TTL 也長得多"""
+    def _init_schema(self, conn):
+        # seq 只是讓同一年度、同一除息日的多筆紀錄 key 不重複；merge 會整年重寫，不靠它比對新舊紀錄
+        conn.execute("""CREATE TABLE IF NOT EXISTS dividends (
+            code TEXT NOT NULL, year TEXT NOT NULL, ex_date TEXT NOT NULL, seq INTEGER NOT NULL, cash REAL NOT NULL,
+            PRIMARY KEY (code, year, ex_date, seq))""")
+        conn.execute("""CREATE TABLE IF NOT EXISTS dividend_sync (
+            code TEXT PRIMARY KEY, synced_at REAL NOT NULL, etag TEXT, last_modified TEXT)""")
+
+    def records(self, code):
+        with self._conn() as conn:
+            rows = conn.execute("SELECT year, ex_date, cash FROM dividends WHERE code=? ORDER BY year DESC, rowid", (code,)).fetchall()
+        return [{"year": y, "ex_date": d, "cash": c} for y, d, c in rows]
+
+    def sync_state(self, code):
+        with self._conn() as conn:
+            row = conn.execute("SELECT synced_at, etag, last_modified FROM dividend_sync WHERE code=?", (code,)).fetchone()
+        return None if row is None else {"synced_at": row[0], "etag": row[1], "last_modified": row[2]}
+
+    def merge(self, code, records, etag=None, last_modified=None):
+        """頁面上有出現的年度整年換成這次抓到的內容 (新配息、更正過的金額都會寫進去)，頁面上已經沒有的舊年度保留；
+        回傳新增或改變的筆數。
+
+        沒有除息日欄的頁面，同一年的紀錄只能靠順序區分，頁面又是新的在前，逐筆比對會整排錯位，所以一律整年重寫。"""
+        seen, rows = {}, []
+        for rec in records:
+            key = (rec["year"], rec["ex_date"])
+            seen[key] = seen.get(key, -1) + 1
+            rows.append((code, rec["year"], rec["ex_date"], seen[key], rec["cash"]))
+        years = sorted({row[1] for row in rows})
+        with self._conn() as conn:  # 同一個交易：讀的一方不會看到刪了一半的年度
+            placeholders = ",".join("?" * len(years))
+            old = conn.execute(f"SELECT year, ex_date, cash FROM dividends WHERE code=? AND year IN ({placeholders})",
+                               (code, *years)).fetchall()
+            conn.execute(f"DELETE FROM dividends WHERE code=? AND year IN ({placeholders})", (code, *years))
+            conn.executemany("INSERT INTO dividends VALUES (?, ?, ?, ?, ?)", rows)
+            conn.execute("INSERT OR REPLACE INTO dividend_sync VALUES (?, ?, ?, ?)", (code, time.time(), etag, last_modified))
+        remaining = {}
+        for rec in old: remaining[rec] = remaining.get(rec, 0) + 1
+        changed = 0
+        for _, year, ex_date, _, cash in rows:
+            if remaining.get((year, ex_date, cash)): remaining[(year, ex_date, cash)] -= 1
+            else: changed += 1
+        return changed
+
+    def mark_synced(self, code):
+        with self._conn() as conn:
+            conn.execute("UPDATE dividend_sync SET synced_at=? WHERE code=?", (time.time(), code))
+
+    def expire(self, codes):
+        with self._conn() as conn:
+            conn.executemany("UPDATE dividend_sync SET synced_at=0 WHERE code=?", [(c,) for c in codes])
+
+@lru_cache(maxsize=None)
+def get_dividend_store():
+    return DividendStore(CACHE_PATH)
+
+# --- 請求合併 (single-flight)：多個 session 同時要同一份資料時只抓一次 ---
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """同一個 key 同一時間只執行一次，其他呼叫者等著分享同一份結果 (同一行程內的所有 Streamlit session)"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._stats = {}  # 種類 -> {"executed": 實際執行次數, "coalesced": 搭便車的次數}
+
+    def do(self, key, fn):
+        """key 是 (種類, 識別碼)；跟隨者拿到結果的淺拷貝，改了也不會影響別人"""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader: flight = self._flights[key] = _Flight()
+            counts = self._stats.setdefault(key[0], {"executed": 0, "coalesced": 0})
+            counts["executed" if leader else "coalesced"] += 1
+        
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None: raise flight.error
+            return copy.copy(flight.result)
+        try:
+            flight.result = fn()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock: del self._flights[key]
+            flight.done.set()
+
+    def stats(self):
+        with self._lock: return copy.deepcopy(self._stats)
+
+@lru_cache(maxsize=None)
+def get_single_flight():
+    return SingleFlight()
+
+def cached_fetch(kind, code, url, parse):
+    """先查磁碟快取；過期就帶 ETag / Last-Modified 重新驗證，伺服器回 304 就沿用舊結果"""
+    return get_single_flight().do((kind, code), lambda: _cached_fetch(kind, code, url, parse))
+
+def _cached_fetch(kind, code, url, parse):
+    cache = get_scrape_cache()
+    entry = cache.get(kind, code)
+    if entry and entry["fresh"]: return entry["value"]
+    
+    validators = {}
+    if entry and entry["etag"]: validators["If-None-Match"] = entry["etag"]
+    if entry and entry["last_modified"]: validators["If-Modified-Since"] = entry["last_modified"]
+    response = http_get(url, validators or None)
+    if response.status_code == 304 and entry:
+        get_metrics().inc("cache_events", cache=kind, event="revalidated")
+        cache.touch(kind, code)
+        return entry["value"]
+    response.raise_for_status()  # 錯誤頁面不要解析成一堆 0
+    
+    with get_metrics().timer("parse", kind=kind): value = parse(response.text)
+    cache.put(kind, code, value, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    return value
+
+# --- 精準失效：只丟掉指定範圍的快取，不再整包 st.cache_data.clear() ---
+def quote_rev(code):
+    return get_scrape_cache().revisions("market", f"quote:{code}")
+
+def sheet_rev(sheet_url):
+    return get_scrape_cache().revisions(f"sheet:{sheet_url}")[0]
+
+def invalidate_quotes(codes):
+    """重抓指定 ETF 的報價 (例如某位使用者的持股)，排行榜與其他人的快取不受影響；配息紀錄有自己的同步週期"""
+    cache = get_scrape_cache()
+    cache.expire("perf", codes)
+    if codes: cache.bump(*[f"quote:{code}" for code in codes])
+
+def invalidate_dividends(codes):
+    """下次讀取時重新同步這些 ETF 的配息紀錄"""
+    get_dividend_store().expire(codes)
+    if codes: get_scrape_cache().bump(*[f"quote:{code}" for code in codes])
+
+def invalidate_sheet(sheet_url):
+    """只丟掉這位使用者的試算表資料，市場資料完全不動"""
+    get_scrape_cache().bump(f"sheet:{sheet_url}")
+
+# --- 工具函式 ---
+def normalize_code(code):
+    """使用者輸入的代號 -> 標準代號。行程裡已經載入名冊時，名冊裡有的直接用正確的代號，不用猜要補幾個 0；
+    還沒載入就只照規則補 0，不會為了正規化一個代號去開資料庫"""
+    code_str = str(code).strip().replace("'", "")
+    known = get_etf_registry().resolve(code_str) if get_etf_registry.cache_info().currsize else None
+    if known: return known
+    if code_str.isdigit() and not code_str.startswith("0"):
+        return "00" + code_str
+    if code_str.isdigit() and len(code_str) < 4:
+        return code_str.zfill(4)
+    return code_str
+
+# --- 持股試算表同步 (純計算，實際讀寫由頁面端負責) ---
+# 每一列是一筆交易：類型 = 買進 / 賣出 / 配息，成交均價 = 成交價 (配息時是每股配息)，日期 = YYYY-MM-DD
+# 舊的三欄工作表沒有 類型 / 日期，讀進來一律當成買進，第一次存檔時會補上
+SHEET_COLUMNS = ['代號', '成交均價', '股數', '類型', '日期']
+LEDGER_TYPES = ['買進', '賣出', '配息']
+
+def ledger_kind(value):
+    kind = "" if pd.isna(value) else str(value).strip()
+    if kind == "": return "買進"
+    if kind not in LEDGER_TYPES: raise ValueError(f"不認得的交易類型：{kind}")
+    return kind
+
+def ledger_date(value):
+    if value is None or value == "" or pd.isna(value): return ""
+    return pd.Timestamp(str(value)).strftime('%Y-%m-%d')  # 工作表讀回來可能是 20240105 這種數字
+
+def _ledger_dates(values):
+    """大部分是 YYYY-MM-DD，一次向量化解析；剩下其他寫法的才逐筆處理"""
+    text = values.astype(str)
+    dates = pd.to_datetime(text, format='%Y-%m-%d', errors='coerce')
+    odd = dates.isna() & values.notna() & (text != "")
+    if odd.any(): dates[odd] = pd.to_datetime(values[odd].map(ledger_date), format='%Y-%m-%d')
+    return dates
+
+def _sheet_row(code, cost, qty, kind="", date=""):
+    qty = float(qty)
+    return [normalize_code(str(code)), float(cost), int(qty) if qty.is_integer() else qty, ledger_kind(kind), ledger_date(date)]
+
+def _row_of(r):
+    return _sheet_row(r.代號, r.成交均價, r.股數, getattr(r, '類型', ""), getattr(r, '日期', ""))
+
+def plan_sheet_sync(layout, original_df, new_df):
+    """比對載入時的工作表與編輯後的表格，回傳 {列號: 新的一列}，只包含真的有變動的列。
+    
+    留下的資料盡量待在原本的列；刪除留下的空位由最後面的資料補上，多出來的尾端列清成空白，
+    所以整個同步過程工作表都不會是空的。"""
+    old_rows = {}
+    legacy = layout["header"][:len(SHEET_COLUMNS)] != SHEET_COLUMNS  # 舊表頭的資料列缺 類型 / 日期，整列重寫才會補上
+    if not legacy and not original_df.empty and '列號' in original_df.columns:
+        for r in original_df.itertuples(index=False):
+            try: old_rows[int(r.列號)] = _row_of(r)
+            except (TypeError, ValueError): old_rows[int(r.列號)] = None  # 原本就不是有效數字，一律重寫
+    
+    kept = [(int(r.列號) if '列號' in new_df.columns and pd.notna(r.列號) else None, _row_of(r))
+            for r in new_df.itertuples(index=False)]
+    last_slot = len(kept) + 1
+    final = {row_no: values for row_no, values in kept if row_no is not None and row_no <= last_slot}
+    free_slots = iter(slot for slot in range(2, last_slot + 1) if slot not in final)
+    for row_no, values in kept:
+        if row_no is None or row_no > last_slot: final[next(free_slots)] = values
+    
+    changes = {slot: values for slot, values in final.items() if old_rows.get(slot) != values}
+    for slot in range(last_slot + 1, layout["rows"] + 2):
+        changes[slot] = [''] * len(SHEET_COLUMNS)
+    if legacy: changes[1] = SHEET_COLUMNS
+    return changes
+
+def parse_sheet_values(values):
+    """工作表的 get_all_values() -> (帳本 DataFrame, {"header": 第一列, "rows": 資料列數})。
+
+    跟 get_all_records 一樣把數字字串轉成數字；列號 = 該筆資料在工作表上的第幾列，同步時用來比對"""
+    header, rows = (values[0], values[1:]) if values else ([], [])
+    df = pd.DataFrame([dict(zip(header, numericise_all(row))) for row in rows])
+    if not df.empty and '代號' in df.columns:
+        df['代號'] = df['代號'].apply(normalize_code)
+        for col in SHEET_COLUMNS:
+            if col not in df.columns: df[col] = ""  # 舊的三欄工作表還沒有 類型 / 日期
+        df['列號'] = range(2, len(rows) + 2)
+    return df, {"header": header, "rows": len(rows)}
+
+def sheet_sync_batches(changes):
+    """把 plan_sheet_sync 的結果轉成 batch_update 的參數：連續的列合併成同一個 A1 範圍"""
+    last_col = chr(ord('A') + len(SHEET_COLUMNS) - 1)
+    batches, start, block = [], None, []
+    for row_no in sorted(changes):
+        if block and row_no != start + len(block):
+            batches.append({"range": f"A{start}:{last_col}{start + len(block) - 1}", "values": block})
+            block = []
+        if not block: start = row_no
+        block.append(changes[row_no])
+    if block: batches.append({"range": f"A{start}:{last_col}{start + len(block) - 1}", "values": block})
+    return batches
+
+# --- HTML 解析設定 ---
+# 預設 html.parser；裝了 lxml 可設 ETF_HTML_PARSER=lxml 換更快的後端 (容錯行為略有不同，請先比對結果)
+HTML_PARSER = os.environ.get("ETF_HTML_PARSER", "html.parser")
+# ★ 只建立需要的節點，其餘標籤直接略過不建樹 ★
+PERF_STRAINER = SoupStrainer(['h3', 'span', 'table'])  # 名稱、現價、績效表；市場別直接從原始 HTML 找，不必為它留下每個 li/td
+# 「市場別：」後面只隔著標籤就是市場：<li><span>市場別：</span>上市</li> 或 <td>市場別</td><td>上櫃</td>
+MARKET_LABEL = re.compile(r'市場別?\s*[：:]?\s*(?:<[^>]*>\s*)*(上市|上櫃)')
+# 沒有標籤時退而求其次：單獨成為一段文字的「上市」/「上櫃」(meta、script 裡的「上市櫃」不算)
+MARKET_TEXT = re.compile(r'>\s*(上市|上櫃)\s*<')
+# 除權息表格；篩選時 class 還是整串字 (例如 "tb-stock tbBasic")，要用正則比對其中一個 class，不能直接寫 class_='tb-stock'
+DIV_STRAINER = SoupStrainer('table', class_=re.compile(r'(^|\s)tb-stock(\s|$)'))
+LIST_STRAINER = SoupStrainer('tr')                                   # ETF 清單的每一列
+DIVIDEND_PAGE_NAME = "除權除息"  # 個股除權息頁的網址最後一段
+
+# --- ★ 爬蟲核心 1：排行榜專用 ★ ---
+def parse_etf_performance(html, stock_code, known=None):
+    """known 是名冊裡這檔的資料；名稱、市場別已知就不再從頁面找"""
+    soup = BeautifulSoup(html, HTML_PARSER, parse_only=PERF_STRAINER)
+    data = {'代號': stock_code, '名稱': "未知", '市場別': "未知", '現價': 0.0, '一季%': 0.0, '半年%': 0.0, '一年%': 0.0, '綜合平均%': 0.0}
+    if known and known['name']: data['名稱'] = known['name']
+    if known and known['market']: data['市場別'] = known['market']
+    
+    name_tag = soup.find('h3') if data['名稱'] == "未知" else None
+    if name_tag: data['名稱'] = name_tag.text.split('(')[0].strip()
+        
+    if data['市場別'] == "未知":
+        market = MARKET_LABEL.search(html) or MARKET_TEXT.search(html)
+        if market: data['市場別'] = market.group(1)
+
+    price_span = soup.find('span', id='Price1_lbTPrice') or soup.find('span', class_='price')
+    if price_span:
+        try: data['現價'] = float(price_span.text.replace(',', ''))
+        except: pass
+
+    table = soup.find('table', class_='tbPerform')
+    if table:
+        target_periods = {'一季': '一季%', '半年': '半年%', '一年': '一年%'}
+        periods_data = {}
+        for row in table.find_all('tr'):
+            th, td = row.find('th'), row.find('td')
+            if th and td and th.text.strip() in target_periods:
+                val_span = td.find('span')
+                if val_span:
+                    try: periods_data[th.text.strip()] = float(val_span.text.replace('%', '').replace('+', '').replace(',', '').strip())
+                    except: pass
+        
+        data['一季%'] = periods_data.get('一季', 0)
+        data['半年%'] = periods_data.get('半年', 0)
+        data['一年%'] = periods_data.get('一年', 0)
+        valid_values = [v for k, v in periods_data.items() if v is not None]
+        if valid_values: data['綜合平均%'] = round(sum(valid_values) / len(valid_values), 2)
+    return data
+
+def fetch_etf_performance(stock_code):
+    url = f"{HISTOCK_BASE}/stock/{stock_code}"
+    registry = get_etf_registry()
+    known = registry.get(stock_code)
+    try:
+        data = cached_fetch("perf", stock_code, url, lambda html: parse_etf_performance(html, stock_code, known))
+    except requests.RequestException: return None  # 斷路、逾時、重試用完仍是 429/5xx；解析錯誤照樣拋出，不要當成沒資料
+    if data and not (known and known['market']) and data['市場別'] != "未知":
+        registry.learn(stock_code, market=data['市場別'])  # 第一次從頁面認出市場別，之後就不必再找
+    return data
+
+# --- ★ 爬蟲核心 2：持股明細專用 (暴力防呆版) ★ ---
+def parse_dividend_records(html):
+    """從除權息頁抓出配息紀錄 [{year, ex_date, cash}, ...]，依頁面上的順序"""
+    div_soup = BeautifulSoup(html, HTML_PARSER, parse_only=DIV_STRAINER)
+    
+    # 尋找所有可能的表格
+    div_tables = div_soup.find_all('table', class_='tb-stock')
+    for div_table in div_tables:
+        rows = div_table.find_all('tr')
+        if len(rows) > 1:
+            ths = [th.text.strip() for th in rows[0].find_all(['th', 'td'])]
+            
+            cash_idx = -1
+            year_idx = -1
+            date_idx = -1
+            
+            # 精準定位欄位
+            for i, text in enumerate(ths):
+                # 必須是現金股利
+                if '現金' in text or '除息' in text: 
+                    if cash_idx == -1: cash_idx = i
+                # 找發放年度
+                if '發放年度' in text:
+                    year_idx = i
+                if date_idx == -1 and ('除權息日' in text or '除息日' in text):
+                    date_idx = i
+            
+            # 如果找不到發放年度，隨便找有「年度」或「日期」的
+            if year_idx == -1:
+                for i, text in enumerate(ths):
+                    if '年度' in text or '除權息日' in text or '除息日' in text:
+                        year_idx = i
+                        break
+                        
+            if cash_idx != -1 and year_idx != -1:
+                records = []
+                for row in rows[1:]:
+                    tds = row.find_all('td')
+                    if len(tds) > max(cash_idx, year_idx):
+                        y_raw = tds[year_idx].text.strip()
+                        c_str = tds[cash_idx].text.strip()
+                        
+                        # ★ 終極武器：正則表達式，強制從字串中抓出 20XX 的數字 ★
+                        match = re.search(r'(20\d{2})', y_raw)
+                        if match and c_str:
+                            y_str = match.group(1) # 取出 2024、2023 這樣的純數字
+                            try: val = float(c_str)
+                            except: continue
+                            ex_date = ""
+                            if 0 <= date_idx < len(tds):
+                                date_match = re.search(r'(\d{4})[/-](\d{1,2})[/-](\d{1,2})', tds[date_idx].text)
+                                if date_match: ex_date = "{}-{:0>2}-{:0>2}".format(*date_match.groups())
+                            records.append({"year": y_str, "ex_date": ex_date, "cash": val})
+                
+                if records: return records # 找到了就跳出迴圈
+    return []
+
+def compute_dividend_metrics(records, today=None):
+    """由配息紀錄算出衍生指標：一年配息 = 近三個年度裡總配息最高的一年；近12月配息 = 除息日落在最近 365 天內的合計"""
+    year_divs = {}
+    for rec in records:
+        year_divs[rec["year"]] = year_divs.get(rec["year"], 0.0) + rec["cash"]
+    recent_years = sorted(year_divs.keys(), reverse=True)[:3] # 取近三年
+    # 找出這三年裡面總配息最高的數字
+    best_year = round(max([year_divs[y] for y in recent_years]), 3) if recent_years else 0.0
+    
+    cutoff = pd.Timestamp(today or pd.Timestamp.now()).normalize() - pd.Timedelta(days=365)
+    trailing = sum(rec["cash"] for rec in records if rec["ex_date"] and pd.Timestamp(rec["ex_date"]) > cutoff)
+    return {'一年配息': best_year, '近12月配息': round(trailing, 3)}
+
+def sync_dividends(stock_code):
+    """配息紀錄過期才去抓除權息頁；帶 ETag / Last-Modified，沒變就只更新同步時間，有變也只合併新的配息"""
+    get_single_flight().do(("div", stock_code), lambda: _sync_dividends(stock_code))
+
+def _sync_dividends(stock_code):
+    store = get_dividend_store()
+    metrics = get_metrics()
+    state = store.sync_state(stock_code)
+    if state and time.time() - state["synced_at"] < DIVIDEND_TTL:
+        metrics.inc("cache_events", cache="dividend", event="hit")
+        return
+    
+    validators = {}
+    if state and state["etag"]: validators["If-None-Match"] = state["etag"]
+    if state and state["last_modified"]: validators["If-Modified-Since"] = state["last_modified"]
+    div_url = f"{HISTOCK_BASE}/stock/{stock_code}/{quote(DIVIDEND_PAGE_NAME)}"
+    response = http_get(div_url, validators or None)
+    if response.status_code == 304 and state:
+        metrics.inc("cache_events", cache="dividend", event="revalidated")
+        store.mark_synced(stock_code)
+        return
+    response.raise_for_status()
+    metrics.inc("cache_events", cache="dividend", event="stale" if state else "miss")
+    with metrics.timer("parse", kind="dividend"): records = parse_dividend_records(response.text)
+    store.merge(stock_code, records, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+
+def fetch_etf_details(stock_code):
+    return get_single_flight().do(("details", stock_code), lambda: _fetch_etf_details(stock_code))
+
+def _fetch_etf_details(stock_code):
+    data = fetch_etf_performance(stock_code)
+    if not data: return None
+    
+    try: sync_dividends(stock_code)
+    except requests.RequestException: pass  # 同步失敗就用資料庫裡既有的紀錄
+    data.update(compute_dividend_metrics(get_dividend_store().records(stock_code)))
+    return data
+
+# --- ★ ETF 名冊：代號 -> 名稱、市場別、是否還在清單上、排除原因，存在 SQLite 並在記憶體建索引 ★ ---
+CHINA_KEYWORDS = ['中國', '上證', '滬', '深', '恒生', 'A50', '香港', '港股']
+
+def parse_etf_universe(html):
+    """清單頁上的每一檔 (依頁面順序、同代號只留第一個)：{code, name, exclusion}；
+    exclusion 是排行榜不收的原因：leveraged (L 結尾)、inverse (R 結尾)、china (陸港相關)，空字串代表正常"""
+    soup = BeautifulSoup(html, HTML_PARSER, parse_only=LIST_STRAINER)
+    universe, seen = [], set()
+    for row in soup.find_all('tr'):
+        link = row.find('a', href=True)
+        if not link or '/stock/' not in link['href']: continue
+        href_code = link['href'].split('/')[-1]
+        if not href_code or not href_code[0].isdigit() or href_code in seen: continue
+        seen.add(href_code)
+        row_text = row.text.strip()
+        if href_code.upper().endswith('L'): exclusion = "leveraged"
+        elif href_code.upper().endswith('R'): exclusion = "inverse"
+        elif any(kw in row_text for kw in CHINA_KEYWORDS): exclusion = "china"
+        else: exclusion = ""
+        universe.append({"code": href_code, "name": link.text.strip(), "exclusion": exclusion})
+    return universe
+
+class EtfRegistry(SQLiteStore):
+    """ETF 名冊。記憶體裡是 代號 -> 資料 的 dict (O(1) 查詢) 加一份排序過的代號 (前綴搜尋用 bisect)；
+    sync 時整份索引換成新的物件，讀的一方不必上鎖。"""
+    def __init__(self, path):
+        super().__init__(path)
+        self._lock = threading.Lock()
+        self._digest = None
+        self._reload()
+
+    def _init_schema(self, conn):
+        conn.execute("""CREATE TABLE IF NOT EXISTS etf_registry (
+            code TEXT PRIMARY KEY, name TEXT NOT NULL, market TEXT NOT NULL DEFAULT '',
+            listed INTEGER NOT NULL, exclusion TEXT NOT NULL DEFAULT '', position INTEGER NOT NULL, updated_at REAL NOT NULL)""")
+
+    def _reload(self):
+        with self._conn() as conn:
+            rows = conn.execute("SELECT code, name, market, listed, exclusion, position FROM etf_registry ORDER BY position").fetchall()
+        entries = {code: {"code": code, "name": name, "market": market, "listed": bool(listed), "exclusion": exclusion, "position": position}
+                   for code, name, market, listed, exclusion, position in rows}
+        self._index = (entries, sorted(entries))
+
+    def sync(self, universe):
+        """用最新的清單頁更新名冊：清單上的標為上市中並更新名稱與順序，不在清單上的標為已下架；市場別保留"""
+        digest = hash(tuple((e["code"], e["name"], e["exclusion"]) for e in universe))
+        if digest == self._digest or not universe: return
+        now = time.time()
+        with self._lock, self._conn() as conn:
+            conn.execute("UPDATE etf_registry SET listed=0")
+            conn.executemany("""INSERT INTO etf_registry (code, name, listed, exclusion, position, updated_at) VALUES (?, ?, 1, ?, ?, ?)
+                                ON CONFLICT(code) DO UPDATE SET name=excluded.name, listed=1, exclusion=excluded.exclusion,
+                                position=excluded.position, updated_at=excluded.updated_at""",
+                             [(e["code"], e["name"], e["exclusion"], i, now) for i, e in enumerate(universe)])
+            self._digest = digest
+        self._reload()
+
+    def learn(self, code, market):
+        """補上清單頁沒有的市場別 (從個股頁認出來的)"""
+        entry = self._index[0].get(code)
+        if entry is None or entry["market"] == market: return
+        with self._conn() as conn:
+            conn.execute("UPDATE etf_registry SET market=?, updated_at=? WHERE code=?", (market, time.time(), code))
+        self._index[0][code] = {**entry, "market": market}
+
+    def get(self, code):
+        return self._index[0].get(code)
+
+    def resolve(self, code):
+        """把使用者輸入的代號 (可能少了前面的 0) 對到名冊裡真正的代號，對不到回傳 None"""
+        entries = self._index[0]
+        if code in entries: return code
+        if not code.isdigit(): return None
+        for candidate in ("00" + code, "0" + code, code.zfill(4), code.zfill(5), code.zfill(6)):
+            if candidate in entries: return candidate
+        return None
+
+    def label(self, code):
+        entry = self._index[0].get(code)
+        return f"{code} {entry['name']}" if entry else code
+
+    def listed(self, include_excluded=False):
+        """目前在清單上的 ETF，順序跟清單頁相同"""
+        return [e for e in self._index[0].values() if e["listed"] and (include_excluded or not e["exclusion"])]
+
+    def search(self, query, limit=50):
+        """完全符合的代號 (會自動補 0) 最前面，其次代號前綴 (bisect)，再來名稱包含關鍵字 (不分大小寫)；
+        只回傳清單上、沒被排除的代號"""
+        entries, codes = self._index
+        query = query.strip()
+        if not query: return []
+        exact = self.resolve(query)
+        start = bisect.bisect_left(codes, query)
+        prefix = []
+        for code in codes[start:]:
+            if not code.startswith(query): break
+            prefix.append(code)
+        hits = ([exact] if exact else []) + sorted(prefix, key=lambda c: entries[c]["position"])
+        lowered = query.lower()
+        hits += [e["code"] for e in entries.values() if lowered in e["name"].lower()]
+        seen, result = set(), []
+        for code in hits:
+            entry = entries[code]
+            if code in seen or not entry["listed"] or entry["exclusion"]: continue
+            seen.add(code)
+            result.append(code)
+            if len(result) >= limit: break
+        return result
+
+@lru_cache(maxsize=None)
+def get_etf_registry():
+    return EtfRegistry(CACHE_PATH)
+
+def refresh_etf_registry():
+    """清單頁一天最多抓一次 (走磁碟快取)，內容有變才寫進名冊；抓不到就沿用名冊裡既有的資料"""
+    registry = get_etf_registry()
+    try: registry.sync(cached_fetch("universe", "all", f"{HISTOCK_BASE}/stock/etf.aspx", parse_etf_universe))
+    except requests.RequestException: pass  # 只有網路層的錯誤沿用舊名冊；解析或資料庫的錯誤照樣拋出
+    return registry
+
+def fetch_etf_codes():
+    """排行榜要掃的 ETF 代號，順序跟清單頁相同"""
+    return [e["code"] for e in refresh_etf_registry().listed()]
+
+def fetch_etf_list():
+    """"代號 名稱" 字串清單 (舊介面)"""
+    return [f"{e['code']} {e['name']}" for e in refresh_etf_registry().listed()]
+
+# --- ★ 整批收盤行情：一次下載全市場，取代逐檔爬價格與報酬 ★ ---
+QUOTE_SOURCE = os.environ.get("ETF_QUOTE_SOURCE", "scrape")  # "bulk" = 價格與報酬改用交易所整批行情檔
+RECORD_QUOTES = os.environ.get("ETF_RECORD_QUOTES", "1") == "1"  # 不是 bulk 時，背景更新也每天記一次收盤價，先把歷史累積起來
+BULK_QUOTE_SOURCES = {  # 市場別 -> 每日全部證券收盤行情 CSV (網址或本機檔案路徑)
+    '上市': os.environ.get("ETF_TWSE_QUOTES", "https://www.twse.com.tw/exchangeReport/STOCK_DAY_ALL?response=open_data"),
+    '上櫃': os.environ.get("ETF_TPEX_QUOTES", "https://www.tpex.org.tw/web/stock/aftertrading/DAILY_CLOSE_quotes/stk_quote_result.php?l=zh-tw&o=data"),
+}
+QUOTE_PUBLISH_TIME = os.environ.get("ETF_QUOTE_PUBLISH_TIME", "14:30")  # 台北時間這個時間之後，交易所的行情檔才換成當天的
+RETURN_PERIODS = {'一季%': 3, '半年%': 6, '一年%': 12}  # 報酬期間 (月)
+RETURN_BASE_TOLERANCE = pd.Timedelta(days=10)  # 期初收盤價最多可以比目標日早幾天 (連假、停牌)，再早就當作歷史不夠
+
+class PriceHistoryStore(SQLiteStore):
+    """全市場每日收盤價歷史，由每天的整批行情檔一路累積"""
+    def _init_schema(self, conn):
+        conn.execute("""CREATE TABLE IF NOT EXISTS price_history (
+            code TEXT NOT NULL, date TEXT NOT NULL, close REAL NOT NULL, PRIMARY KEY (code, date))""")
+        conn.execute("CREATE TABLE IF NOT EXISTS quote_meta (code TEXT PRIMARY KEY, name TEXT NOT NULL, market TEXT NOT NULL)")
+
+    def append(self, quotes):
+        """quotes 欄位：代號、名稱、市場別、日期、收盤價；同一天重複匯入會覆蓋"""
+        with self._conn() as conn:
+            conn.executemany("INSERT OR REPLACE INTO price_history VALUES (?, ?, ?)",
+                             quotes[['代號', '日期', '收盤價']].itertuples(index=False, name=None))
+            conn.executemany("INSERT OR REPLACE INTO quote_meta VALUES (?, ?, ?)",
+                             quotes[['代號', '名稱', '市場別']].itertuples(index=False, name=None))
+        return len(quotes)
+
+    def latest_closes(self, market, before):
+        """這個市場在 before 之前最後一個有資料的交易日：(日期, {代號: 收盤價})，沒有就是 (None, {})"""
+        with self._conn() as conn:
+            row = conn.execute("""SELECT MAX(p.date) FROM price_history p JOIN quote_meta m ON m.code = p.code
+                                  WHERE m.market=? AND p.date < ?""", (market, before)).fetchone()
+            if row[0] is None: return None, {}
+            closes = conn.execute("""SELECT p.code, p.close FROM price_history p JOIN quote_meta m ON m.code = p.code
+                                     WHERE m.market=? AND p.date=?""", (market, row[0])).fetchall()
+        return row[0], dict(closes)
+
+    def latest_date(self):
+        with self._conn() as conn:
+            return conn.execute("SELECT MAX(date) FROM price_history").fetchone()[0] or ""
+
+    def history(self, since):
+        with self._conn() as conn:
+            return pd.read_sql_query("SELECT code, date, close FROM price_history WHERE date >= ?", conn, params=(since,), parse_dates=['date'])
+
+    def meta(self):
+        with self._conn() as conn:
+            return pd.read_sql_query("SELECT code, name, market FROM quote_meta", conn)
+
+@lru_cache(maxsize=None)
+def get_price_store():
+    return PriceHistoryStore(CACHE_PATH)
+
+def parse_quote_date(text):
+    """'2025-01-03'、'2025/1/3'、'20250103'，或民國年 '114/01/03'、'1140103' -> '2025-01-03'；認不出來回傳 None"""
+    match = re.search(r'(\d{2,4})[/-](\d{1,2})[/-](\d{1,2})', text) or re.search(r'(?<!\d)(\d{3}|\d{4})(\d{2})(\d{2})(?!\d)', text)
+    if not match: return None
+    year, month, day = map(int, match.groups())
+    if year < 1911: year += 1911
+    try: return pd.Timestamp(year=year, month=month, day=day).strftime('%Y-%m-%d')
+    except ValueError: return None
+
+def quote_trade_date(now=None):
+    """沒有日期的行情檔是哪一天的：收盤資料公布 (QUOTE_PUBLISH_TIME) 之前抓到的是前一個交易日，週末是週五"""
+    now = pd.Timestamp(now) if now is not None else pd.Timestamp.now(tz="Asia/Taipei").tz_localize(None)
+    day = now.normalize()
+    if now < day + pd.Timedelta(f"{QUOTE_PUBLISH_TIME}:00"): day -= pd.Timedelta(days=1)
+    return pd.offsets.BDay().rollback(day).strftime('%Y-%m-%d')
+
+def read_bulk_quotes(source, market, trade_date=None, guess_date=True):
+    """讀一份交易所的全部證券收盤行情 CSV (網址或本機檔)，整理成 代號/名稱/市場別/日期/收盤價。
+
+    日期依序取：檔案裡的日期欄、表格前說明文字裡的資料日期 (櫃買中心)、trade_date；都沒有時 guess_date=True
+    就用 quote_trade_date() 推算 (證交所的 open data 沒有日期)，False 則丟 ValueError (補匯舊檔時不能用猜的)。"""
+    if source.startswith(("http://", "https://")):
+        response = http_get(source)
+        response.raise_for_status()
+        raw = response.content
+    else:
+        with open(source, 'rb') as f: raw = f.read()
+    try: text = raw.decode('utf-8-sig')
+    except UnicodeDecodeError: text = raw.decode('cp950')  # 櫃買中心的檔案是 Big5
+    
+    # 檔頭前面常有說明文字，從含「代號」的那一行開始才是表格
+    lines = text.splitlines()
+    start = next((i for i, line in enumerate(lines) if '代號' in line), None)
+    if start is None: raise ValueError(f"{source} 找不到行情表格")
+    df = pd.read_csv(io.StringIO("\n".join(lines[start:])), dtype=str)
+    df.columns = [c.strip() for c in df.columns]
+    
+    pick = lambda *names: next(c for c in names if c in df.columns)
+    quotes = pd.DataFrame({
+        '代號': df[pick('證券代號', '代號')].str.strip().str.strip('="'),
+        '名稱': df[pick('證券名稱', '名稱')].str.strip(),
+        '收盤價': pd.to_numeric(df[pick('收盤價', '收盤')].str.replace(',', ''), errors='coerce'),
+    })
+    quotes['市場別'] = market
+    preamble_date = next((d for d in map(parse_quote_date, lines[:start]) if d), None)
+    if '日期' in df.columns: quotes['日期'] = df['日期'].fillna("").map(parse_quote_date)
+    elif preamble_date or trade_date: quotes['日期'] = preamble_date or pd.Timestamp(trade_date).strftime('%Y-%m-%d')
+    elif guess_date: quotes['日期'] = quote_trade_date()
+    else: raise ValueError(f"{source} 沒有資料日期，請指定交易日")
+    return quotes.dropna(subset=['收盤價', '日期'])
+
+def ingest_daily_quotes(source, market, trade_date=None, guess_date=True):
+    """把一份行情檔存進價格歷史，回傳寫入筆數。
+
+    收盤價跟資料庫裡這個市場前一個交易日完全相同的檔，是假日或收盤資料公布前抓到的舊檔，
+    不能記成新的一天 (否則報酬會被算成 0)，直接跳過回傳 0。"""
+    quotes = read_bulk_quotes(source, market, trade_date, guess_date)
+    if quotes.empty: return 0
+    store = get_price_store()
+    _, previous = store.latest_closes(market, quotes['日期'].max())
+    same = [previous[code] == close for code, close in zip(quotes['代號'], quotes['收盤價']) if code in previous]
+    if len(same) >= len(quotes) / 2 and all(same): return 0
+    return store.append(quotes)
+
+def ingest_all_markets(trade_date=None):
+    """每個市場抓一份當日行情存進價格歷史，回傳 {市場別: 寫入筆數或例外}；某個市場抓不到不影響其他市場"""
+    results = {}
+    for market, source in BULK_QUOTE_SOURCES.items():
+        try: results[market] = ingest_daily_quotes(source, market, trade_date)
+        except Exception as e: results[market] = e
+    return results
+
+def record_daily_quotes():
+    """背景更新用：不論 QUOTE_SOURCE，價格歷史還沒有最近一個交易日的收盤價才去抓，一天頂多幾次請求"""
+    if not RECORD_QUOTES or get_price_store().latest_date() >= quote_trade_date(): return None
+    return ingest_all_markets()
+
+def compute_period_returns(history, meta, complete_only=False):
+    """一次向量化算出每檔的 現價 / 一季% / 半年% / 一年% / 綜合平均%。
+
+    歷史不夠長的期間不列入平均，顯示為 0；complete_only=True 則直接丟掉任何一個期間歷史不夠的 ETF。"""
+    history = history.sort_values('date')
+    ranking = history.groupby('code', as_index=False).tail(1).rename(columns={'date': 'as_of', 'close': '現價'})
+    periods = list(RETURN_PERIODS)
+    for label, months in RETURN_PERIODS.items():
+        # 每檔各自找「最新日期往回 N 個月」當天或之前最後一筆收盤價 (太早的不算)
+        probe = ranking[['code', 'as_of']].assign(target=ranking['as_of'] - pd.DateOffset(months=months)).sort_values('target')
+        base = pd.merge_asof(probe, history, left_on='target', right_on='date', by='code', direction='backward',
+                             tolerance=RETURN_BASE_TOLERANCE)
+        ranking = ranking.merge(base[['code', 'close']].rename(columns={'close': label}), on='code', how='left')
+        ranking[label] = (ranking['現價'] / ranking[label] - 1) * 100
+    if complete_only: ranking = ranking[ranking[periods].notna().all(axis=1)]
+    ranking['綜合平均%'] = ranking[periods].mean(axis=1).round(2).fillna(0.0)
+    ranking[periods] = ranking[periods].round(2).fillna(0.0)
+    ranking = ranking.merge(meta, on='code', how='left').rename(columns={'code': '代號', 'name': '名稱', 'market': '市場別'})
+    return ranking[['代號', '名稱', '市場別', '現價', *periods, '綜合平均%']]
+
+def build_ranking_from_bulk(codes, trade_date=None):
+    """匯入今天的整批行情 (每個市場一個請求)，再從本機價格歷史算出這些 ETF 的排行資料。
+
+    只回傳每個報酬期間都有歷史的 ETF；剛開始累積歷史或剛上市的，交給逐檔爬蟲。"""
+    ingest_all_markets(trade_date)  # 某個市場今天抓不到，仍用既有歷史計算
+    store = get_price_store()
+    since = (pd.Timestamp.now().normalize() - pd.DateOffset(months=max(RETURN_PERIODS.values()) + 1)).strftime('%Y-%m-%d')
+    ranking = compute_period_returns(store.history(since), store.meta(), complete_only=True)
+    return ranking[ranking['代號'].isin(codes)]
+
+def scan_market(codes, fetch, on_progress=None):
+    """★ 多執行緒併發掃描：速率由 RateLimiter 控制，回傳順序與 codes 相同 (失敗的位置是 None) ★"""
+    results = [None] * len(codes)
+    pool = ThreadPoolExecutor(max_workers=SCAN_WORKERS)
+    try:
+        futures = {pool.submit(fetch, code): i for i, code in enumerate(codes)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            results[i] = future.result()
+            if on_progress: on_progress(done, len(codes), codes[i])
+    finally: pool.shutdown(wait=False, cancel_futures=True)  # on_progress 或 fetch 拋出例外時，還沒開始的請求不用再跑
+    return results
+
+def collect_market_rows(codes, fetch, on_progress=None):
+    """回傳跟 codes 對齊的排行資料列；整批行情模式下，只有整批檔裡沒有的 ETF 才逐檔去爬"""
+    bulk_rows = {}
+    if QUOTE_SOURCE == "bulk":
+        try: bulk_rows = {row['代號']: row for row in build_ranking_from_bulk(codes).to_dict("records")}
+        except Exception: pass
+    missing = [code for code in codes if code not in bulk_rows]
+    scanned = dict(zip(missing, scan_market(missing, fetch, on_progress)))
+    return [bulk_rows.get(code) or scanned.get(code) for code in codes]
+
+def iter_market_scan(codes, fetch, batch_size=20):
+    """邊掃邊吐出排行資料列：快取裡 (或整批行情檔裡) 已經有的先一次吐出，其餘每完成 batch_size 檔吐一批"""
+    ready = {}
+    if QUOTE_SOURCE == "bulk":
+        try: ready = {row['代號']: row for row in build_ranking_from_bulk(codes).to_dict("records")}
+        except Exception: pass
+    cached = get_scrape_cache().fresh_values("perf", [code for code in codes if code not in ready])
+    ready.update((code, value) for code, value in cached.items() if value)
+    if ready: yield list(ready.values())
+    
+    batch = []
+    pool = ThreadPoolExecutor(max_workers=SCAN_WORKERS)
+    try:
+        futures = [pool.submit(fetch, code) for code in codes if code not in ready]
+        for future in as_completed(futures):
+            data = future.result()
+            if data: batch.append(data)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch: yield batch
+    finally:
+        # 呼叫端中途不讀了 (rerun、換頁、例外) 會關掉這個 generator：還沒開始的請求直接取消，不必等它們跑完
+        pool.shutdown(wait=False, cancel_futures=True)
+
+def stream_market_ranking(codes, fetch):
+    """iter_market_scan 的結果累積成排行表：每收到一批就吐出目前為止的整張表 (依 codes 的順序)，最後一張就是完整結果"""
+    rows = {}
+    for batch in iter_market_scan(codes, fetch):
+        rows.update((data['代號'], data) for data in batch)
+        yield pd.DataFrame([rows[code] for code in codes if code in rows])
+
+def build_market_ranking(on_progress=None):
+    """不經過 Streamlit 的完整排行榜掃描 (批次排程用)"""
+    codes = fetch_etf_codes()
+    return pd.DataFrame([data for data in collect_market_rows(codes, fetch_etf_performance, on_progress) if data])
+
+# --- ★ 持股估值 ★ ---
+def load_holdings_file(path):
+    """讀本機的持股 CSV (欄位：代號、成交均價 或 成本、股數，可再加 類型、日期)，格式跟個人試算表相同"""
+    df = pd.read_csv(path, dtype={'代號': str, '類型': str, '日期': str}, encoding='utf-8-sig').rename(columns={'成本': '成交均價'})
+    df['代號'] = df['代號'].apply(normalize_code)
+    return df
+
+# --- ★ 交易帳本：由買進 / 賣出 / 配息紀錄算出部位，全部用 groupby 與累積運算 ★ ---
+def _map_unique(values, func):
+    """代號、類型的種類很少，每種只轉換一次再展開回去"""
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    return np.array([func(u) for u in uniques], dtype=object)[codes]
+
+def prepare_ledger(ledger):
+    """整理成計算用的帳本，依 代號 → 日期 → 原本順序 排好 (沒填日期的舊資料視為最早的買進)"""
+    ledger = ledger.reset_index(drop=True)
+    df = pd.DataFrame({
+        '代號': _map_unique(ledger['代號'], normalize_code),
+        '類型': _map_unique(ledger['類型'], ledger_kind) if '類型' in ledger.columns else "買進",
+        '日期': _ledger_dates(ledger['日期']) if '日期' in ledger.columns else pd.NaT,
+        '價格': pd.to_numeric(ledger['成交均價'], errors='coerce').fillna(0.0),
+        '股數': pd.to_numeric(ledger['股數'], errors='coerce').fillna(0.0),
+        '順序': np.arange(len(ledger)),
+    })
+    return df.sort_values(['代號', '日期', '順序'], na_position='first').reset_index(drop=True)
+
+AVERAGE_COST_BLOCK = 300.0  # 段內 log P 每往下掉這麼多就重新起算一小段；exp(±300) 離 float64 的上下限都還很遠
+
+def _average_cost_sold(code, held, prev_held, buy_amount, sell):
+    """移動平均成本法 (台灣券商對帳單的算法)：賣出時按當下平均成本沖銷。
+
+    持有成本 C 的遞迴是 C_t = a_t * C_(t-1) + b_t (買進 a=1、b=金額；賣出 a=剩餘/原本股數、b=0)，
+    以「從零股開始到再度歸零」為一段，段內 C = P * cumsum(b / P)，P = cumprod(a)。
+    一直部分賣出又買回時 P 會小到變成 0 (b / P 變成無限大)，所以 P 改在 log 空間累加，
+    再把段切成 log P 範圍不超過 AVERAGE_COST_BLOCK 的小段：小段內 P 從 1 起算，
+    前一小段結束時的成本當成帶進來的 C_(t-1)。小段之間的遞迴只要照「段內第幾小段」跑幾輪，通常一輪都不用。"""
+    a = np.where(sell & (prev_held > 0), held / np.where(prev_held > 0, prev_held, 1), 1.0)
+    segment = (np.abs(prev_held) < 1e-9).cumsum()  # 每段從持股為零的那一筆開始 (每檔第一筆一定是)
+    log_a = np.log(np.where(a > 0, a, 1.0))  # 全部賣光 (a=0) 的下一筆一定是新的一段，這裡的值不會再被用到
+    log_p = pd.Series(log_a).groupby(segment).cumsum().to_numpy()
+    level = np.floor(-log_p / AVERAGE_COST_BLOCK)
+    starts = np.ones(len(a), dtype=bool)
+    starts[1:] = (segment[1:] != segment[:-1]) | (level[1:] != level[:-1])
+    block = starts.cumsum() - 1
+    
+    base = (log_p - log_a)[starts][block]  # 每一小段開始前一筆的 log P
+    p = np.exp(log_p - base)
+    local = p * pd.Series(buy_amount / p).groupby(block).cumsum().to_numpy()
+    
+    # 每一小段帶進來的成本 = 前一小段最後一筆的成本 (段的第一小段是 0)
+    ends = np.r_[starts[1:], True]
+    end_p, end_local = p[ends], local[ends]
+    rank = pd.Series(np.ones(len(end_p))).groupby(segment[starts]).cumsum().to_numpy() - 1
+    carry = np.zeros(len(end_p))
+    for r in range(1, int(rank.max()) + 1 if len(rank) else 0):
+        i = np.flatnonzero(rank == r)
+        carry[i] = end_p[i - 1] * carry[i - 1] + end_local[i - 1]
+    cost = p * carry[block] + local
+    
+    prev_cost = pd.Series(cost).groupby(code).shift(fill_value=0.0).to_numpy()
+    return np.where(sell & (prev_held > 0), (prev_held - held) * prev_cost / np.where(prev_held > 0, prev_held, 1), 0.0)
+
+def _fifo_cost_sold(code, qty, buy_amount, buy, sell):
+    """先進先出：把每檔的買進依序攤成一條「累積股數 → 累積成本」折線，
+    第 t 筆賣出的成本 = F(累積賣出股數) - F(上一筆為止的累積賣出股數)。
+    各檔的折線接在同一條全域座標上，整個帳本只需要一次 np.interp。"""
+    buy_qty = np.where(buy, qty, 0.0)
+    total_qty, total_cost = np.cumsum(buy_qty), np.cumsum(buy_amount)
+    code_qty = pd.Series(buy_qty).groupby(code).cumsum().to_numpy()
+    offset = total_qty - code_qty  # 這一檔之前所有檔的買進股數
+    sold = pd.Series(np.where(sell, qty, 0.0)).groupby(code).cumsum().to_numpy()
+    
+    knots = buy & (qty > 0)
+    xp = np.concatenate([[0.0], total_qty[knots]])
+    fp = np.concatenate([[0.0], total_cost[knots]])
+    cost_to = np.interp(offset + sold, xp, fp)
+    cost_from = np.interp(offset + sold - np.where(sell, qty, 0.0), xp, fp)
+    return np.where(sell, cost_to - cost_from, 0.0)
+
+def build_positions(ledger, method="average"):
+    """帳本 → 每檔一列的部位：股數、成交均價 (持有部位的單位成本)、總成本、已實現損益、已領股息。
+
+    method 是 "average" (移動平均成本) 或 "fifo" (先進先出)；賣超過持有股數會丟 ValueError。"""
+    df = prepare_ledger(ledger)
+    code = df['代號'].to_numpy()
+    qty, price = df['股數'].to_numpy(), df['價格'].to_numpy()
+    buy, sell, dividend = ((df['類型'] == kind).to_numpy() for kind in LEDGER_TYPES)
+    amount = price * qty
+    buy_amount = np.where(buy, amount, 0.0)
+    
+    signed = np.where(buy, qty, np.where(sell, -qty, 0.0))
+    held = pd.Series(signed).groupby(code).cumsum().to_numpy()
+    if (held < -1e-9).any():
+        raise ValueError(f"賣出股數超過持有：{', '.join(sorted(set(code[held < -1e-9])))}")
+    prev_held = held - signed
+    
+    if method == "average": cost_sold = _average_cost_sold(code, held, prev_held, buy_amount, sell)
+    elif method == "fifo": cost_sold = _fifo_cost_sold(code, qty, buy_amount, buy, sell)
+    else: raise ValueError(f"不支援的成本計算方式：{method}")
+    
+    rows = pd.DataFrame({
+        '代號': code, '股數': signed, '總成本': buy_amount - cost_sold,
+        '已實現損益': np.where(sell, amount - cost_sold, 0.0), '已領股息': np.where(dividend, amount, 0.0),
+    })
+    positions = rows.groupby('代號', as_index=False, sort=True).sum()
+    positions.loc[positions['股數'].abs() < 1e-9, ['股數', '總成本']] = 0.0  # 出清的部位不留浮點尾數
+    positions['成交均價'] = np.divide(positions['總成本'], positions['股數'],
+                                      out=np.zeros(len(positions)), where=positions['股數'] > 0)
+    return positions[['代號', '股數', '成交均價', '總成本', '已實現損益', '已領股息']]
+
+def value_portfolio(user_df, details):
+    """把持股跟最新報價 / 配息合併，算出現值、損益、年領息與成本殖利率；details 是 fetch_etf_details 的結果清單"""
+    current_prices_df = pd.DataFrame(details)
+    merged_df = pd.merge(user_df, current_prices_df, on='代號', how='left')
+    
+    merged_df['現價'] = pd.to_numeric(merged_df['現價'], errors='coerce').fillna(0)
+    merged_df['股數'] = pd.to_numeric(merged_df['股數'], errors='coerce').fillna(0)
+    merged_df['現值'] = merged_df['現價'] * merged_df['股數']
+    merged_df['總成本'] = merged_df['成交均價'] * merged_df['股數']
+    merged_df['預估損益'] = merged_df['現值'] - merged_df['總成本']
+    merged_df['報酬率%'] = 0.0
+    mask = merged_df['總成本'] > 0
+    merged_df.loc[mask, '報酬率%'] = (merged_df.loc[mask, '預估損益'] / merged_df.loc[mask, '總成本']) * 100
+    
+    merged_df['年領息'] = merged_df['一年配息'] * merged_df['股數']
+    merged_df['成本殖利率%'] = 0.0
+    mask_cost = merged_df['成交均價'] > 0
+    merged_df.loc[mask_cost, '成本殖利率%'] = (merged_df.loc[mask_cost, '一年配息'] / merged_df.loc[mask_cost, '成交均價']) * 100
+    
+    return merged_df.sort_values(by='代號', ascending=True).reset_index(drop=True)
+
+def portfolio_summary(merged_df, positions=None):
+    """positions 是 build_positions 的結果 (含已出清的部位)，有給才會算已實現損益與已領股息"""
+    total_cost = merged_df['總成本'].sum()
+    total_pnl = merged_df['預估損益'].sum()
+    total_div = merged_df['年領息'].sum()
+    summary = {
+        '總市值': merged_df['現值'].sum(),
+        '總成本': total_cost,
+        '總損益': total_pnl,
+        '總報酬率%': (total_pnl / total_cost * 100) if total_cost > 0 else 0,
+        '預估年領息': total_div,
+        '每月被動收入': total_div / 12,
+    }
+    if positions is not None:
+        summary['已實現損益'] = positions['已實現損益'].sum()
+        summary['已領股息'] = positions['已領股息'].sum()
+    return summary
+
+def value_holdings(positions, fetch):
+    """持有中的部位逐檔取行情 (fetch = 代號 -> fetch_etf_details 的結果) 再估值；一檔報價都沒有就回傳 None"""
+    open_positions = positions[positions['股數'] > 0]
+    with get_metrics().timer("quotes"): details = [data for data in map(fetch, open_positions['代號']) if data]
+    if not details: return None
+    with get_metrics().timer("merge"): return value_portfolio(open_positions[['代號', '成交均價', '股數']], details)
+
+# --- ★ 頁面上的表格：欄位、格式與上色，網頁跟壓力測試用同一份 ★ ---
+RANKING_VIEW_COLUMNS = ['代號', '名稱', '市場別', '現價', '一季%', '半年%', '一年%', '綜合平均%']
+HOLDINGS_VIEW_FORMAT = {
+    '代號': None, '名稱': None, '股數': None, '成交均價': "{:.2f}", '現價': "{:.2f}", '現值': "{:,.0f}", '預估損益': "{:,.0f}",
+    '一年配息': "{:.2f}", '近12月配息': "{:.2f}", '年領息': "{:,.0f}", '成本殖利率%': "{:.2f}%",
+}  # 持股明細的欄位 (依顯示順序) -> 數字格式
+
+def style_pl_color(val):
+    if isinstance(val, numbers.Real):  # 共用市場表的數字是 numpy.float32
+        color = '#d63031' if val > 0 else '#00b894' if val < 0 else 'black'
+        return f'color: {color}; font-weight: bold;'
+    return ''
+
+def ranking_view(df_final):
+    """排行榜表格：依綜合平均排序、名次從 1 開始、報酬率紅綠上色"""
+    existing_cols = [c for c in RANKING_VIEW_COLUMNS if c in df_final.columns]
+    df_show = df_final[existing_cols].sort_values(by='綜合平均%', ascending=False).reset_index(drop=True)
+    df_show.index += 1
+    return df_show.style.map(style_pl_color, subset=['一季%', '半年%', '一年%', '綜合平均%']) \
+                        .format("{:.2f}", subset=['現價', '一季%', '半年%', '一年%', '綜合平均%'])
+
+def holdings_view(merged_df):
+    """持股明細表格：value_portfolio 的結果只留要顯示的欄位，損益與殖利率紅綠上色"""
+    formats = {col: fmt for col, fmt in HOLDINGS_VIEW_FORMAT.items() if fmt}
+    return merged_df[list(HOLDINGS_VIEW_FORMAT)].style.format(formats).map(style_pl_color, subset=['預估損益', '成本殖利率%'])
+
+# --- ★ 歷史快照 (分區 Parquet 欄式儲存) ★ ---
+HISTORY_PATH = os.environ.get("ETF_HISTORY_PATH", "etf_history")
+
+RANKING_SCHEMA = pa.schema([
+    ('代號', pa.string()), ('名稱', pa.string()), ('市場別', pa.string()), ('現價', pa.float64()),
+    ('一季%', pa.float64()), ('半年%', pa.float64()), ('一年%', pa.float64()), ('綜合平均%', pa.float64()),
+    ('快照時間', pa.timestamp('s')),
+])
+PORTFOLIO_SCHEMA = pa.schema([
+    ('代號', pa.string()), ('名稱', pa.string()), ('股數', pa.float64()), ('成交均價', pa.float64()), ('現價', pa.float64()),
+    ('現值', pa.float64()), ('總成本', pa.float64()), ('預估損益', pa.float64()), ('年領息', pa.float64()),
+    ('快照時間', pa.timestamp('s')),
+])
+
+class HistoryStore:
+    """排行榜與持股估值的歷史快照。
+
+    目錄結構：ranking/date=YYYY-MM-DD/*.parquet、portfolio/user=<雜湊>/date=YYYY-MM-DD/valuation.parquet。
+    換日時把之前的分區合併：這個月的每天併成一個檔，更早的整個月併成 month=YYYY-MM 一個檔，
+    所以就算累積好幾年，查詢時要打開的檔案也只有幾十個，而且只讀用得到的分區與欄位。
+    """
+    def __init__(self, root):
+        self.root = root
+        self._recorded = {}  # 使用者 -> (日期, 內容雜湊)，畫面重跑時同樣的估值不重寫
+
+    @staticmethod
+    def _user_key(user):
+        return hashlib.sha1(str(user).encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def _day(value):
+        return pd.Timestamp(value).strftime('%Y-%m-%d') if value is not None else None
+
+    def _partitions(self, base, prefix):
+        if not os.path.isdir(base): return []
+        return sorted(d for d in os.listdir(base) if d.startswith(prefix))
+
+    def _files(self, base, part):
+        folder = os.path.join(base, part)
+        return [os.path.join(folder, f) for f in sorted(os.listdir(folder)) if f.endswith(".parquet")]
+
+    def _write_table(self, folder, name, table):
+        os.makedirs(folder, exist_ok=True)
+        tmp = os.path.join(folder, f".{name}.tmp")
+        pq.write_table(table, tmp, compression="zstd")
+        os.replace(tmp, os.path.join(folder, name))  # 換名是原子動作，讀的一方不會看到寫一半的檔
+
+    def _append(self, base, df, schema, as_of, name):
+        taken_at = pd.Timestamp.fromtimestamp(int(as_of))
+        day = taken_at.strftime('%Y-%m-%d')
+        frame = df.reindex(columns=schema.names[:-1])
+        for field in schema:
+            if pa.types.is_floating(field.type): frame[field.name] = pd.to_numeric(frame[field.name], errors='coerce')
+            elif pa.types.is_string(field.type): frame[field.name] = frame[field.name].astype('string')
+        frame['快照時間'] = taken_at
+        folder = os.path.join(base, f"date={day}")
+        new_day = not os.path.isdir(folder)
+        self._write_table(folder, name, pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+        if new_day: self.compact(base, day)
+
+    def compact(self, base, today):
+        """合併 today 以前的分區 (多個行程同時換日時，只讓拿到租約的那個做)"""
+        cache = get_scrape_cache()
+        lease = f"history:{base}"
+        if not cache.acquire_lease(lease, ttl=600): return
+        try:
+            groups = {}
+            for part in self._partitions(base, "date="):
+                day = part[5:]
+                if day >= today: continue
+                groups.setdefault(f"month={day[:7]}" if day[:7] < today[:7] else part, []).append(part)
+            for target, parts in groups.items():
+                files = [f for part in parts for f in self._files(base, part)]
+                if target == parts[0] and len(files) <= 1: continue  # 已經是一天一個檔
+                if target.startswith("month=") and os.path.isdir(os.path.join(base, target)):
+                    files = self._files(base, target) + files  # 補寫進已經合併過的月份
+                table = ds.dataset(files, format="parquet").to_table().sort_by([('快照時間', 'ascending'), ('代號', 'ascending')])
+                self._write_table(os.path.join(base, target), "part.parquet", table)
+                for part in parts:
+                    if part == target:
+                        for f in files:
+                            if os.path.basename(f) != "part.parquet": os.remove(f)
+                    else: shutil.rmtree(os.path.join(base, part), ignore_errors=True)
+        finally: cache.release_lease(lease)
+
+    def _read(self, base, schema, start, end, columns, extra_filter=None):
+        """只列出跟 [start, end] 重疊的分區，再交給 pyarrow 做欄位裁剪與列過濾"""
+        start, end = self._day(start), self._day(end)
+        parts = []
+        for part in self._partitions(base, "month=") + self._partitions(base, "date="):
+            first = last = part.split("=", 1)[1]
+            if part.startswith("month="): first, last = f"{first}-01", f"{first}-31"
+            if (start is None or last >= start) and (end is None or first <= end): parts.append(part)
+        wanted = ['快照時間'] + [c for c in (columns or schema.names) if c != '快照時間']
+        files = [f for part in parts for f in self._files(base, part)]
+        if not files: return pd.DataFrame(columns=wanted)
+        
+        filters = [] if extra_filter is None else [extra_filter]
+        if start is not None: filters.append(ds.field('快照時間') >= pd.Timestamp(start))
+        if end is not None: filters.append(ds.field('快照時間') < pd.Timestamp(end) + pd.Timedelta(days=1))
+        row_filter = None
+        for f in filters: row_filter = f if row_filter is None else row_filter & f
+        table = ds.dataset(files, schema=schema, format="parquet").to_table(columns=wanted, filter=row_filter)
+        return table.to_pandas().sort_values(['快照時間'] + (['代號'] if '代號' in wanted else [])).reset_index(drop=True)
+
+    def append_ranking(self, df, as_of):
+        self._append(os.path.join(self.root, "ranking"), df, RANKING_SCHEMA, as_of,
+                     f"{time.strftime('%H%M%S', time.localtime(as_of))}-{os.getpid()}.parquet")
+
+    def append_portfolio(self, user, merged_df, as_of=None):
+        """同一位使用者一天只留最後一份估值；內容跟上次寫的一樣就直接跳過"""
+        as_of = as_of or time.time()
+        day = time.strftime('%Y-%m-%d', time.localtime(as_of))
+        digest = int(pd.util.hash_pandas_object(merged_df.reindex(columns=PORTFOLIO_SCHEMA.names[:-1]), index=False).sum())
+        if self._recorded.get(user) == (day, digest): return False
+        self._append(os.path.join(self.root, "portfolio", f"user={self._user_key(user)}"), merged_df, PORTFOLIO_SCHEMA, as_of, "valuation.parquet")
+        self._recorded[user] = (day, digest)
+        return True
+
+    def ranking_history(self, start=None, end=None, codes=None, columns=None):
+        """某段期間內每一次排行榜快照；codes / columns 只讀需要的 ETF 與欄位"""
+        code_filter = ds.field('代號').isin(list(codes)) if codes else None
+        cols = None if columns is None else ['代號'] + [c for c in columns if c != '代號']
+        return self._read(os.path.join(self.root, "ranking"), RANKING_SCHEMA, start, end, cols, code_filter)
+
+    def code_history(self, code, start=None, end=None, columns=('現價', '綜合平均%')):
+        """單一 ETF 的歷史走勢，一天取最後一次快照"""
+        df = self.ranking_history(start, end, codes=[code], columns=list(columns))
+        if df.empty: return df
+        df['日期'] = df['快照時間'].dt.normalize()
+        return df.groupby('日期', as_index=False).last().drop(columns=['快照時間'])
+
+    def portfolio_history(self, user, start=None, end=None):
+        """使用者的資產走勢：每天一列 總市值 / 總成本 / 總損益 / 預估年領息"""
+        df = self._read(os.path.join(self.root, "portfolio", f"user={self._user_key(user)}"), PORTFOLIO_SCHEMA, start, end,
+                        ['現值', '總成本', '預估損益', '年領息'])
+        if df.empty: return pd.DataFrame(columns=['日期', '總市值', '總成本', '總損益', '預估年領息'])
+        df['日期'] = df['快照時間'].dt.normalize()
+        out = df.groupby('日期', as_index=False)[['現值', '總成本', '預估損益', '年領息']].sum()
+        return out.rename(columns={'現值': '總市值', '預估損益': '總損益', '年領息': '預估年領息'})
+
+@lru_cache(maxsize=None)
+def get_history_store():
+    return HistoryStore(HISTORY_PATH)
+
+def record_portfolio_snapshot(user, merged_df):
+    """頁面算完估值後呼叫；寫歷史失敗不影響畫面"""
+    try: return get_history_store().append_portfolio(user, merged_df)
+    except Exception: return False
+
+def load_portfolio_history(user, before):
+    """before 這天以前的資產走勢 (過去的快照不會再變，可以放心快取)；讀歷史失敗回傳 None，不影響畫面"""
+    try: return get_history_store().portfolio_history(user, end=pd.Timestamp(before) - pd.Timedelta(days=1))
+    except Exception: return None
+
+def portfolio_trend(history, summary, today=None):
+    """走勢圖的資料：history 是 load_portfolio_history 的結果 (None = 讀不到)，今天這一點直接用剛算好的 summary"""
+    today = pd.Timestamp(today or time.strftime('%Y-%m-%d'))
+    point = pd.DataFrame([{'日期': today, **{col: summary[col] for col in ('總市值', '總成本', '總損益', '預估年領息')}}])
+    if history is None or history.empty: return point
+    return pd.concat([history[history['日期'] < today], point], ignore_index=True)
+
+# --- ★ 共用市場資料：每個行程只放一份精簡型別的表，所有 session 直接讀同一份 ★ ---
+MARKET_CATEGORIES = ['名稱', '市場別']  # 重複值多的文字欄位
+
+def compact_market_frame(df):
+    """名稱 / 市場別轉 category、數字欄轉 float32、其他文字欄轉 string。
+
+    回傳的表是所有 session 共用的，呼叫端不可原地修改 (排序、篩選都會產生新的表，不受影響)。"""
+    columns = {}
+    for col in df.columns:
+        if col in MARKET_CATEGORIES: columns[col] = df[col].astype('category')
+        elif pd.api.types.is_numeric_dtype(df[col]): columns[col] = df[col].astype('float32')
+        else: columns[col] = df[col].astype('string')
+    return pd.DataFrame(columns)
+
+# --- ★ 背景排行榜更新 (stale-while-revalidate) ★ ---
+def save_ranking_snapshot(df, as_of=None):
+    """把一份完整排行榜寫進共用快取，所有行程的頁面都會改讀這一份 (排程批次也可以直接呼叫)；同時留一份進歷史"""
+    as_of = as_of or time.time()
+    get_scrape_cache().put("ranking", "all", {"as_of": as_of, "rows": df.to_dict("records")})
+    try: get_history_store().append_ranking(df, as_of)
+    except Exception: pass  # 歷史只是附帶的，寫不進去也不能擋住發布
+    return as_of
+
+class _LeaseLost(Exception):
+    """重建途中續約失敗：租約已經過期被別的行程拿走，這一輪不能再發布"""
+
+class MarketRefresher:
+    """頁面永遠讀最後一份完整快照；背景執行緒在快照過期前就重建好再整份換上去。
+
+    記憶體裡的快照是 compact_market_frame 過的唯讀表，每個行程一份，所有 session 拿到的都是同一個物件。
+    重建失敗記在 refresh_failures 計數器，最後一次的錯誤留在 last_error 給管理面板看。"""
+    def __init__(self, cache, interval):
+        self.cache = cache
+        self.interval = interval
+        self.busy = False
+        self.last_error = None  # (epoch 秒, 錯誤訊息)
+        self._force = False
+        self._wake = threading.Event()
+        self._snapshot = self._load()  # 重啟後先拿磁碟上的上一份，馬上就有東西可以顯示
+        threading.Thread(target=self._loop, name="market-refresher", daemon=True).start()
+
+    def _load(self):
+        entry = self.cache.get("ranking", "all")
+        if entry is None: return None
+        return compact_market_frame(pd.DataFrame(entry["value"]["rows"])), entry["value"]["as_of"]
+
+    def snapshot(self):
+        """回傳 (共用的唯讀 DataFrame, 資料時間 epoch 秒)，還沒有任何快照時是 None"""
+        return self._snapshot
+
+    def publish(self, df, as_of=None):
+        as_of = save_ranking_snapshot(df, as_of)  # 磁碟與歷史存原始數值
+        self._snapshot = (compact_market_frame(df), as_of)  # 單一參考指派，讀的一方不會看到半套資料
+
+    def trigger(self):
+        """手動要求重建，不會卡住呼叫端"""
+        self._force = True
+        self._wake.set()
+
+    def _loop(self):
+        while True:
+            self._wake.wait(timeout=min(self.interval, 60))
+            self._wake.clear()
+            latest = self._load()  # 其他行程可能已經重建好了
+            if latest and (self._snapshot is None or latest[1] > self._snapshot[1]): self._snapshot = latest
+            if self._snapshot is None: continue  # 冷啟動由第一位訪客在前景掃描
+            if not self._force and time.time() - self._snapshot[1] < self.interval: continue
+            if not self.cache.acquire_lease("ranking", ttl=REFRESH_LEASE_TTL): continue
+            try:
+                self._force = False
+                self._rebuild()
+            except _LeaseLost: get_metrics().inc("refresh_failures", reason="lease_lost")  # 別的行程接手了，下一輪讀它的結果
+            except Exception as e:
+                get_metrics().inc("refresh_failures", reason=type(e).__name__)
+                self.last_error = (time.time(), f"{type(e).__name__}: {e}")
+            finally: self.cache.release_lease("ranking")
+
+    def _rebuild(self):
+        self.busy = True
+        try:
+            codes = fetch_etf_codes()
+            if not codes: return  # 連清單都拿不到，保留舊快照
+            if QUOTE_SOURCE != "bulk": record_daily_quotes()  # 還在逐檔爬的時候也先把收盤價歷史累積起來
+            self.cache.expire("perf")  # 全部走條件式請求重新驗證
+            entry = self.cache.get("ranking", "all")  # 沿用舊數字時拿磁碟上的原始值，不是記憶體裡的 float32
+            previous = {row['代號']: row for row in entry["value"]["rows"]} if entry else {}
+            renewed_at = time.monotonic()
+            def keep_lease(done, total, code):
+                nonlocal renewed_at
+                if time.monotonic() - renewed_at < REFRESH_LEASE_TTL / 3: return
+                if not self.cache.renew_lease("ranking", REFRESH_LEASE_TTL): raise _LeaseLost()
+                renewed_at = time.monotonic()
+            def fetch(code):
+                # 單一頁面解析失敗只影響那一檔 (下面沿用上一版)，不能讓整輪重建作廢
+                try: return fetch_etf_performance(code)
+                except Exception:
+                    get_metrics().inc("refresh_failures", reason="code")
+                    return None
+            rows = []
+            for code, data in zip(codes, collect_market_rows(codes, fetch, keep_lease)):
+                # 部分失敗就沿用上一版的數字，而不是寫入 0
+                if data: rows.append(data)
+                elif code in previous: rows.append(previous[code])
+            self.publish(pd.DataFrame(rows))
+            self.cache.bump("market")  # 讓各頁面的 st.cache_data 改讀剛更新的磁碟快取
+        finally: self.busy = False
+
+@lru_cache(maxsize=None)
+def get_market_refresher():
+    return MarketRefresher(get_scrape_cache(), REFRESH_INTERVAL)
+
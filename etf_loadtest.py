@@ -0,0 +1,544 @@
+"""離線壓力測試：本機伺服器重播錄好的 histock 頁面、記憶體裡的假 gspread 取代 Google 試算表，
+模擬 N 位使用者同時操作「我的持股」與「市場排行榜」，回報吞吐量、延遲百分位、上游請求數與記憶體高峰。
+
+    python etf_loadtest.py synth fixtures/ --etfs 300                  # 產生一份假的 histock 頁面
+    python etf_loadtest.py record fixtures/ --limit 100                # 或從 histock 錄真的頁面 (需要網路)
+    python etf_loadtest.py run fixtures/ --users 50 --holdings 10 -o report.json
+    python etf_loadtest.py run fixtures/ --users 50 --baseline report.json   # 跟上一次比，變慢就回傳 1
+    python etf_loadtest.py run fixtures/ --users 50 --error-rate 0.1 --slow-rate 0.05   # 上游不穩時的 p50/p95/p99
+    python etf_loadtest.py smoke fixtures/ --users 3                   # 用 AppTest 實際跑 etf_ana.py 的兩個頁面
+    python etf_loadtest.py bench-scan fixtures/ --scan-interval 0      # 全市場掃描：逐檔 vs 併發的牆鐘時間
+
+每次 run 都用全新的暫存快取目錄、固定的亂數種子，結果可以重複比較。
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import unquote, urlsplit
+from unittest import mock
+import numpy as np
+import pandas as pd
+import requests
+from gspread.utils import numericise_all, a1_range_to_grid_range
+import etf_core
+
+DIVIDEND_PAGE = etf_core.DIVIDEND_PAGE_NAME
+
+# --- 上游頁面：錄製或產生，檔案路徑就是網址路徑 ---
+def fixture_path(root, path):
+    return os.path.join(root, unquote(path).lstrip("/") + ".html")
+
+def _write_fixture(root, path, html):
+    target = fixture_path(root, path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    with open(target, "w", encoding="utf-8") as f: f.write(html)
+
+def record_fixtures(root, limit):
+    """從 histock 錄清單頁，以及前 limit 檔 ETF 的個股頁與除權息頁"""
+    def get(path):
+        response = requests.get(f"https://histock.tw{path}", headers=etf_core.headers, timeout=etf_core.HTTP_TIMEOUT)
+        response.raise_for_status()
+        _write_fixture(root, path, response.text)
+        return response.text
+    universe = etf_core.parse_etf_universe(get("/stock/etf.aspx"))
+    codes = [e["code"] for e in universe if not e["exclusion"]][:limit]
+    for i, code in enumerate(codes, start=1):
+        get(f"/stock/{code}")
+        get(f"/stock/{code}/{DIVIDEND_PAGE}")
+        print(f"\r錄製 [{i}/{len(codes)}] {code}", end="" if i < len(codes) else "\n", file=sys.stderr)
+        time.sleep(etf_core.SCAN_INTERVAL)
+    return codes
+
+def synth_fixtures(root, etfs, seed=0):
+    """產生 parse_etf_universe / parse_etf_performance / parse_dividend_records 認得的假頁面"""
+    rng = random.Random(seed)
+    issuers = ["元大", "國泰", "富邦", "群益", "復華", "中信", "永豐", "統一", "凱基", "大華"]
+    themes = ["台灣50", "高股息", "科技優息", "美國20年債", "半導體", "ESG永續", "特選Nasdaq", "投資級公司債", "臺灣中小", "5G通訊"]
+    codes = [f"00{600 + i}" for i in range(etfs)]
+    rows = []
+    for code in codes:
+        name = f"{rng.choice(issuers)}{rng.choice(themes)}"
+        rows.append(f'<tr><td><a href="/stock/{code}">{name}</a></td><td>{code}</td><td>{rng.uniform(10, 100):.2f}</td></tr>')
+        price = rng.uniform(8, 200)
+        returns = {period: rng.gauss(5, 15) for period in ("一季", "半年", "一年")}
+        perform = "".join(f'<tr><th>{period}</th><td><span>{value:+.2f}%</span></td></tr>' for period, value in returns.items())
+        _write_fixture(root, f"/stock/{code}", f"""<html><body><h3>{name}({code})</h3>
+            <ul><li>市場別：{rng.choice(["上市", "上櫃"])}</li><li>產業：ETF</li></ul>
+            <span id="Price1_lbTPrice">{price:,.2f}</span>
+            <table class="tbPerform">{perform}</table>
+            <table><tr><td>成交量</td><td>{rng.randint(100, 50000)}</td></tr></table></body></html>""")
+        dividends = []
+        for year in range(2026, 2019, -1):
+            for month in sorted(rng.sample(range(1, 13), rng.choice([1, 2, 4]))):
+                dividends.append(f"<tr><td>{year}</td><td>{rng.uniform(0.1, 1.5):.3f}</td><td>{year}/{month:02d}/{rng.randint(1, 28):02d}</td></tr>")
+        _write_fixture(root, f"/stock/{code}/{DIVIDEND_PAGE}", f"""<html><body>
+            <table class="tb-stock"><tr><th>發放年度</th><th>現金股利</th><th>除息日</th></tr>{"".join(dividends)}</table></body></html>""")
+    _write_fixture(root, "/stock/etf.aspx", f"<html><body><table>{''.join(rows)}</table></body></html>")
+    return codes
+
+# --- 重播伺服器：照網址路徑回傳錄好的頁面，支援 ETag / 304，並記錄每種頁面被要了幾次 ---
+class ReplayServer:
+    """error_rate 比例的請求回 429 / 503 (模擬 histock 限流或掛掉)，slow_rate 比例的請求再多等 slow_latency 秒；
+    故障用固定種子的亂數決定，同樣的請求順序每次結果都一樣"""
+    def __init__(self, root, latency=0.0, error_rate=0.0, slow_rate=0.0, slow_latency=1.0, seed=0):
+        self.root = root
+        self.latency = latency
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = urlsplit(self.path).path
+                kind = "list" if path.endswith("etf.aspx") else "dividend" if unquote(path).endswith(DIVIDEND_PAGE) else "perf"
+                if server.latency: time.sleep(server.latency)
+                status, delay = server._fault()
+                if delay: time.sleep(delay)
+                if status:
+                    server._count(kind, status)
+                    self.send_response(status)
+                    if status == 429: self.send_header("Retry-After", "1")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                try:
+                    with open(fixture_path(server.root, path), "rb") as f: body = f.read()
+                except OSError:
+                    server._count(kind, 404)
+                    self.send_error(404)
+                    return
+                etag = '"' + hashlib.md5(body).hexdigest() + '"'
+                if self.headers.get("If-None-Match") == etag:
+                    server._count(kind, 304)
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+                server._count(kind, 200)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args): pass
+
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}"
+
+    def _fault(self):
+        """這個請求要回的錯誤狀態碼 (沒有就是 None) 與額外延遲秒數"""
+        with self._lock:
+            status = self._rng.choice((429, 503)) if self._rng.random() < self.error_rate else None
+            delay = self.slow_latency if self._rng.random() < self.slow_rate else 0.0
+        return status, delay
+
+    def _count(self, kind, status):
+        with self._lock: self.counts[f"{kind}_{status}"] = self.counts.get(f"{kind}_{status}", 0) + 1
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, name="replay-server", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+# --- 假的 gspread：只實作 etf_ana.py 用到的部分，每個呼叫都記次數 (= Sheets API 請求) ---
+class FakeWorksheet:
+    def __init__(self, client, values=None):
+        self.client = client
+        self.values = [list(row) for row in values or []]
+        self._lock = threading.Lock()
+
+    def get_all_values(self):
+        self.client.count("get_all_values")
+        with self._lock: return [[str(v) for v in row] for row in self.values]
+
+    def get_all_records(self):
+        self.client.count("get_all_records")
+        with self._lock:
+            if not self.values: return []
+            header = self.values[0]
+            return [dict(zip(header, numericise_all([str(v) for v in row]))) for row in self.values[1:]]
+
+    def row_values(self, row):
+        self.client.count("row_values")
+        with self._lock: return [str(v) for v in self.values[row - 1]] if row <= len(self.values) else []
+
+    def append_row(self, row):
+        self.client.count("append_row")
+        with self._lock: self.values.append(list(row))
+
+    def append_rows(self, rows):
+        self.client.count("append_rows")
+        with self._lock: self.values.extend(list(row) for row in rows)
+
+    def batch_update(self, data):
+        self.client.count("batch_update")
+        with self._lock:
+            for item in data:
+                grid = a1_range_to_grid_range(item["range"])
+                for r, row in enumerate(item["values"]):
+                    row_no = grid["startRowIndex"] + r
+                    while len(self.values) <= row_no: self.values.append([])
+                    target = self.values[row_no]
+                    for c, value in enumerate(row):
+                        col = grid.get("startColumnIndex", 0) + c
+                        while len(target) <= col: target.append("")
+                        target[col] = value
+            while self.values and not any(str(v) for v in self.values[-1]): self.values.pop()  # 清成空白的尾端列
+
+class FakeSpreadsheet:
+    def __init__(self, client, worksheets):
+        self.client = client
+        self._worksheets = worksheets
+        self.sheet1 = next(iter(worksheets.values()))
+
+    def worksheet(self, name):
+        self.client.count("worksheet")
+        return self._worksheets[name]
+
+class FakeSheetsClient:
+    """users 資料庫加上每位使用者自己的試算表，全部放在記憶體裡"""
+    def __init__(self):
+        self.calls = {}
+        self._lock = threading.Lock()
+        self.users = FakeWorksheet(self, [["username", "password", "sheet_url"]])
+        self.database = FakeSpreadsheet(self, {"users": self.users})
+        self.personal = {}
+
+    def count(self, method):
+        with self._lock: self.calls[method] = self.calls.get(method, 0) + 1
+
+    def open(self, name):
+        self.count("open")
+        return self.database
+
+    def open_by_url(self, url):
+        self.count("open_by_url")
+        return self.personal[url]
+
+    def add_user(self, username, ledger_rows):
+        url = f"https://docs.google.com/spreadsheets/d/{username}"
+        self.personal[url] = FakeSpreadsheet(self, {"sheet1": FakeWorksheet(self, [etf_core.SHEET_COLUMNS, *ledger_rows])})
+        self.users.values.append([username, "pw", url])
+        return url
+
+def random_portfolio(rng, codes, holdings, lots):
+    """holdings 檔 ETF、每檔 lots 筆買進，偶爾穿插賣出與配息 (不會賣超)"""
+    rows = []
+    for code in rng.sample(codes, min(holdings, len(codes))):
+        held = 0
+        day = pd.Timestamp("2022-01-03")
+        for _ in range(lots):
+            qty = rng.randint(1, 20) * 100
+            rows.append([code, round(rng.uniform(10, 100), 2), qty, "買進", day.strftime('%Y-%m-%d')])
+            held += qty
+            day += pd.Timedelta(days=rng.randint(7, 60))
+            if rng.random() < 0.2:
+                sold = rng.randint(1, held // 100) * 100
+                rows.append([code, round(rng.uniform(10, 100), 2), sold, "賣出", day.strftime('%Y-%m-%d')])
+                held -= sold
+            if held and rng.random() < 0.3:
+                rows.append([code, round(rng.uniform(0.1, 1.5), 3), held, "配息", day.strftime('%Y-%m-%d')])
+    return rows
+
+# --- 模擬的頁面流程：資料路徑跟表格都呼叫 etf_ana.py 用的同一組 etf_core 函式 (快取、single-flight、共用快照) ---
+def read_ledger(sheet):
+    return etf_core.parse_sheet_values(sheet.get_all_values())[0]
+
+def holdings_flow(sheets, user, url, rng, write_ratio):
+    sheet = sheets.open_by_url(url).sheet1
+    if rng.random() < write_ratio:
+        # 新增一筆交易，跟 save_to_personal_sheet 一樣一次 append_rows
+        code = rng.choice(etf_core.fetch_etf_codes())
+        sheet.append_rows([[code, round(rng.uniform(10, 100), 2), rng.randint(1, 10) * 100, "買進", time.strftime('%Y-%m-%d')]])
+    positions = etf_core.build_positions(read_ledger(sheet))
+    merged_df = etf_core.value_holdings(positions, etf_core.fetch_etf_details)
+    if merged_df is None: return
+    summary = etf_core.portfolio_summary(merged_df, positions)
+    etf_core.record_portfolio_snapshot(user, merged_df)
+    etf_core.holdings_view(merged_df).to_html()  # 近似 st.dataframe 的 Styler 成本
+    etf_core.portfolio_trend(etf_core.load_portfolio_history(user, time.strftime('%Y-%m-%d')), summary)
+
+def ranking_flow(refresher):
+    snapshot = refresher.snapshot()
+    if snapshot is None:
+        codes = etf_core.fetch_etf_codes()
+        df_final = pd.DataFrame()
+        for df_final in etf_core.stream_market_ranking(codes, etf_core.fetch_etf_performance):
+            etf_core.ranking_view(df_final).to_html()  # 跟頁面一樣每收到一批就重畫一次
+        if not df_final.empty: refresher.publish(df_final)
+    else: df_final = snapshot[0]
+    if not df_final.empty: etf_core.ranking_view(df_final).to_html()
+
+def _percentiles(samples):
+    if not samples: return {}
+    ms = np.array(samples) * 1000
+    return {"count": len(samples), "mean_ms": round(float(ms.mean()), 2),
+            **{f"p{p}_ms": round(float(np.percentile(ms, p)), 2) for p in (50, 90, 95, 99)}, "max_ms": round(float(ms.max()), 2)}
+
+CORE_SINGLETONS = ("get_scrape_cache", "get_dividend_store", "get_etf_registry", "get_price_store", "get_history_store",
+                   "get_single_flight", "get_fetch_stats", "get_rate_limiter", "get_http_session", "get_market_refresher")
+
+def configure_core(server_url, workdir, scan_interval):
+    """把 etf_core 指到重播伺服器與全新的暫存快取，並丟掉行程裡既有的快取物件，確保每次結果可以重複"""
+    etf_core.HISTOCK_BASE = server_url
+    etf_core.CACHE_PATH = os.path.join(workdir, "etf_cache.db")
+    etf_core.HISTORY_PATH = os.path.join(workdir, "etf_history")
+    if scan_interval is not None: etf_core.SCAN_INTERVAL = scan_interval
+    for name in CORE_SINGLETONS: getattr(etf_core, name).cache_clear()
+    with etf_core._breakers_lock: etf_core._breakers.clear()
+
+def run_load(args):
+    workdir = tempfile.mkdtemp(prefix="etf_loadtest_")
+    server = ReplayServer(args.fixtures, args.upstream_latency / 1000).start()
+    try:
+        configure_core(server.url, workdir, args.scan_interval)
+        codes = etf_core.fetch_etf_codes()
+        if not codes: raise SystemExit(f"{args.fixtures} 裡沒有 ETF 清單頁，先跑 synth 或 record")
+        # 清單頁拿到之後才開始製造故障，模擬跑到一半上游開始不穩
+        server.error_rate, server.slow_rate, server.slow_latency = args.error_rate, args.slow_rate, args.slow_latency / 1000
+        rng = random.Random(args.seed)
+        sheets = FakeSheetsClient()
+        users = [(f"user{i}", sheets.add_user(f"user{i}", random_portfolio(rng, codes, args.holdings, args.lots)))
+                 for i in range(args.users)]
+        refresher = etf_core.get_market_refresher()
+
+        latencies = {"holdings": [], "ranking": []}
+        errors = []
+        lock = threading.Lock()
+        def simulate(index):
+            user, url = users[index]
+            user_rng = random.Random(args.seed * 100003 + index)
+            for _ in range(args.iterations):
+                flow = "holdings" if user_rng.random() < args.holdings_ratio else "ranking"
+                start = time.perf_counter()
+                try:
+                    if flow == "holdings": holdings_flow(sheets, user, url, user_rng, args.write_ratio)
+                    else: ranking_flow(refresher)
+                except Exception as e:
+                    with lock: errors.append(f"{flow}: {e!r}")
+                    continue
+                with lock: latencies[flow].append(time.perf_counter() - start)
+                if args.think_time: time.sleep(user_rng.uniform(0, 2 * args.think_time / 1000))
+
+        if args.tracemalloc: tracemalloc.start()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.users) as pool: list(pool.map(simulate, range(args.users)))
+        elapsed = time.perf_counter() - start
+        python_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+        if args.tracemalloc: tracemalloc.stop()
+        rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        completed = sum(len(v) for v in latencies.values())
+        upstream = etf_core.fetch_stats()
+        return {
+            "config": {key: getattr(args, key) for key in ("users", "iterations", "holdings", "lots", "holdings_ratio", "write_ratio",
+                                                          "think_time", "upstream_latency", "error_rate", "slow_rate", "slow_latency",
+                                                          "scan_interval", "seed")} | {"etfs": len(codes)},
+            "elapsed_s": round(elapsed, 3),
+            "throughput_per_s": round(completed / elapsed, 2) if elapsed else 0.0,
+            "flows": {flow: _percentiles(samples) for flow, samples in latencies.items()},
+            "errors": len(errors), "error_samples": errors[:5],
+            "upstream": {"replay_server": dict(sorted(server.counts.items())), "total": sum(server.counts.values()),
+                         "client": {key: upstream[key] for key in ("requests", "retries", "failures", "short_circuited",
+                                                                   "p50_ms", "p95_ms", "p99_ms")}},
+            "sheets_api": dict(sorted(sheets.calls.items())),
+            "singleflight": etf_core.get_single_flight().stats(),
+            "memory": {"rss_peak_mb": round(rss_peak / 1024, 1), "rss_growth_mb": round((rss_peak - rss_before) / 1024, 1),
+                       "python_peak_mb": round(python_peak / 1024 / 1024, 1) if python_peak is not None else None},
+        }
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def compare_reports(report, baseline, tolerance):
+    """跟基準報告比：延遲 p95、吞吐量、上游請求數，超過容許範圍的項目列出來"""
+    regressions = []
+    for flow, stats in report["flows"].items():
+        old = baseline.get("flows", {}).get(flow, {}).get("p95_ms")
+        if old and stats.get("p95_ms", 0) > old * (1 + tolerance):
+            regressions.append(f"{flow} p95 {old:.1f} → {stats['p95_ms']:.1f} ms")
+    old = baseline.get("throughput_per_s")
+    if old and report["throughput_per_s"] < old * (1 - tolerance):
+        regressions.append(f"吞吐量 {old:.1f} → {report['throughput_per_s']:.1f} 次/秒")
+    old = baseline.get("upstream", {}).get("total")
+    if old and report["upstream"]["total"] > old * (1 + tolerance):
+        regressions.append(f"上游請求 {old} → {report['upstream']['total']} 次")
+    if report["errors"] > baseline.get("errors", 0):
+        regressions.append(f"錯誤 {baseline.get('errors', 0)} → {report['errors']} 次")
+    return regressions
+
+def print_report(report):
+    out = sys.stderr
+    print(f"{report['config']['users']} 位使用者 × {report['config']['iterations']} 次，{report['config']['etfs']} 檔 ETF，"
+          f"耗時 {report['elapsed_s']:.1f} 秒，吞吐量 {report['throughput_per_s']:.1f} 次/秒，錯誤 {report['errors']} 次", file=out)
+    for flow, stats in report["flows"].items():
+        if stats: print(f"  {flow:>8}: {stats['count']} 次，p50 {stats['p50_ms']:.1f} / p95 {stats['p95_ms']:.1f} / "
+                        f"p99 {stats['p99_ms']:.1f} / 最慢 {stats['max_ms']:.1f} ms", file=out)
+    client = report["upstream"]["client"]
+    print(f"  上游：{report['upstream']['total']} 次 {report['upstream']['replay_server']}", file=out)
+    print(f"    用戶端：重試 {client['retries']} 次，失敗 {client['failures']} 次，斷路擋下 {client['short_circuited']} 次，"
+          f"單一請求 p50 {client['p50_ms']:.1f} / p95 {client['p95_ms']:.1f} / p99 {client['p99_ms']:.1f} ms", file=out)
+    print(f"  Sheets API：{sum(report['sheets_api'].values())} 次 {report['sheets_api']}", file=out)
+    memory = report["memory"]
+    print(f"  記憶體：RSS 高峰 {memory['rss_peak_mb']} MB (增加 {memory['rss_growth_mb']} MB)" +
+          (f"，Python 配置高峰 {memory['python_peak_mb']} MB" if memory["python_peak_mb"] is not None else ""), file=out)
+
+def cmd_run(args):
+    report = run_load(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f: baseline = json.load(f)
+        regressions = compare_reports(report, baseline, args.tolerance)
+        for line in regressions: print(f"⚠️ 退步：{line}", file=sys.stderr)
+        if regressions: raise SystemExit(1)
+        print("✅ 沒有超過容許範圍的退步", file=sys.stderr)
+
+def bench_scan(args):
+    """同一份重播頁面，先用 1 個連線逐檔掃、再用 N 個連線併發掃，比較掃完整個市場的牆鐘時間；兩次的結果必須一模一樣"""
+    server = ReplayServer(args.fixtures, args.upstream_latency / 1000).start()
+    workers_before = etf_core.SCAN_WORKERS
+    runs = {}
+    try:
+        for workers in dict.fromkeys((1, args.workers)):
+            workdir = tempfile.mkdtemp(prefix="etf_benchscan_")
+            try:
+                etf_core.SCAN_WORKERS = workers
+                configure_core(server.url, workdir, args.scan_interval)  # 每一輪都是冷快取
+                codes = etf_core.fetch_etf_codes()  # 清單頁不計時
+                if not codes: raise SystemExit(f"{args.fixtures} 裡沒有 ETF 清單頁，先跑 synth 或 record")
+                start = time.perf_counter()
+                rows = etf_core.scan_market(codes, etf_core.fetch_etf_performance)
+                runs[workers] = (time.perf_counter() - start, pd.DataFrame([row for row in rows if row]))
+            finally: shutil.rmtree(workdir, ignore_errors=True)
+    finally:
+        etf_core.SCAN_WORKERS = workers_before
+        server.stop()
+    return runs
+
+def cmd_bench_scan(args):
+    runs = bench_scan(args)
+    (serial, serial_df), (concurrent, concurrent_df) = runs[1], runs[args.workers]
+    cap = f"{1 / etf_core.SCAN_INTERVAL:.0f} 次/秒" if etf_core.SCAN_INTERVAL > 0 else "不限"
+    print(f"{len(serial_df)} 檔 ETF，上游延遲 {args.upstream_latency:.0f} ms，速率上限 {cap}", file=sys.stderr)
+    print(f"  逐檔 (1 個連線)：{serial:.2f} 秒", file=sys.stderr)
+    print(f"  併發 ({args.workers} 個連線)：{concurrent:.2f} 秒，快 {serial / concurrent:.1f} 倍", file=sys.stderr)
+    if not serial_df.equals(concurrent_df): raise SystemExit("⚠️ 併發掃描的結果跟逐檔掃描不一樣")
+    print("✅ 兩種掃法的排行資料完全相同", file=sys.stderr)
+
+def cmd_smoke(args):
+    """用 Streamlit 的 AppTest 實際執行 etf_ana.py：AppTest 不能多個同時跑，所以使用者是一個接一個"""
+    from streamlit.testing.v1 import AppTest
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+    workdir = tempfile.mkdtemp(prefix="etf_smoke_")
+    server = ReplayServer(args.fixtures).start()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "etf_ana.py")
+    try:
+        configure_core(server.url, workdir, args.scan_interval)
+        codes = etf_core.fetch_etf_codes()
+        rng = random.Random(0)
+        sheets = FakeSheetsClient()
+        for i in range(args.users): sheets.add_user(f"user{i}", random_portfolio(rng, codes, args.holdings, 3))
+        timings = {"holdings": [], "ranking": []}
+        with mock.patch.object(gspread, "authorize", return_value=sheets), \
+             mock.patch.object(ServiceAccountCredentials, "from_json_keyfile_dict", return_value=None):
+            for i in range(args.users):
+                at = AppTest.from_file(script, default_timeout=args.timeout)
+                at.secrets["gcp_service_account"] = {"client_email": "loadtest@example.com"}
+                at.query_params["user"] = f"user{i}"
+                start = time.perf_counter()
+                at.run()
+                timings["holdings"].append(time.perf_counter() - start)
+                if at.exception: raise SystemExit(f"我的持股 頁面發生例外：{at.exception[0].value}")
+                start = time.perf_counter()
+                at.sidebar.radio[0].set_value("📊 市場排行榜").run()
+                timings["ranking"].append(time.perf_counter() - start)
+                if at.exception: raise SystemExit(f"市場排行榜 頁面發生例外：{at.exception[0].value}")
+        for flow, samples in timings.items():
+            stats = _percentiles(samples)
+            print(f"  {flow:>8}: {stats['count']} 次，p50 {stats['p50_ms']:.1f} / 最慢 {stats['max_ms']:.1f} ms", file=sys.stderr)
+        print(f"  上游：{dict(sorted(server.counts.items()))}，Sheets API：{dict(sorted(sheets.calls.items()))}", file=sys.stderr)
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="台股 ETF 資產管家 - 離線壓力測試")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("synth", help="產生假的 histock 頁面")
+    p.add_argument("fixtures", help="輸出目錄")
+    p.add_argument("--etfs", type=int, default=300, help="ETF 檔數 (預設 300)")
+    p.add_argument("--seed", type=int, default=0)
+    p.set_defaults(func=lambda args: print(f"已產生 {len(synth_fixtures(args.fixtures, args.etfs, args.seed))} 檔 ETF 的頁面", file=sys.stderr))
+
+    p = sub.add_parser("record", help="從 histock 錄製真實頁面 (需要網路)")
+    p.add_argument("fixtures", help="輸出目錄")
+    p.add_argument("--limit", type=int, default=100, help="最多錄幾檔 ETF (預設 100)")
+    p.set_defaults(func=lambda args: print(f"已錄製 {len(record_fixtures(args.fixtures, args.limit))} 檔 ETF", file=sys.stderr))
+
+    p = sub.add_parser("run", help="模擬多位使用者同時操作")
+    p.add_argument("fixtures", help="synth / record 產生的目錄")
+    p.add_argument("--users", type=int, default=20, help="同時在線的使用者數 (預設 20)")
+    p.add_argument("--iterations", type=int, default=10, help="每位使用者開幾次頁面 (預設 10)")
+    p.add_argument("--holdings", type=int, default=10, help="每位使用者持有幾檔 ETF (預設 10)")
+    p.add_argument("--lots", type=int, default=3, help="每檔 ETF 買進幾次 (預設 3)")
+    p.add_argument("--holdings-ratio", type=float, default=0.5, help="開「我的持股」的比例，其餘是排行榜 (預設 0.5)")
+    p.add_argument("--write-ratio", type=float, default=0.05, help="開持股頁時順便新增一筆交易的比例 (預設 0.05)")
+    p.add_argument("--think-time", type=float, default=0, help="兩次操作之間的平均間隔 (毫秒，預設 0)")
+    p.add_argument("--upstream-latency", type=float, default=0, help="重播伺服器每個請求額外延遲 (毫秒，模擬真實網路)")
+    p.add_argument("--error-rate", type=float, default=0, help="重播伺服器回 429 / 503 的比例 (預設 0)")
+    p.add_argument("--slow-rate", type=float, default=0, help="重播伺服器特別慢的請求比例 (預設 0)")
+    p.add_argument("--slow-latency", type=float, default=2000, help="特別慢的請求再多等幾毫秒 (預設 2000)")
+    p.add_argument("--scan-interval", type=float, default=None, help="覆寫 ETF_SCAN_INTERVAL (預設沿用設定)")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--tracemalloc", action="store_true", help="另外追蹤 Python 配置的記憶體高峰 (會變慢)")
+    p.add_argument("-o", "--output", help="把報告寫成 JSON")
+    p.add_argument("--baseline", help="跟這份 JSON 報告比較，退步超過容許範圍就回傳 1")
+    p.add_argument("--tolerance", type=float, default=0.2, help="容許退步的比例 (預設 0.2)")
+    p.set_defaults(func=cmd_run)
+
+    p = sub.add_parser("bench-scan", help="全市場掃描的牆鐘時間：逐檔 vs 併發")
+    p.add_argument("fixtures", help="synth / record 產生的目錄")
+    p.add_argument("--workers", type=int, default=etf_core.SCAN_WORKERS, help="併發時的連線數 (預設 ETF_SCAN_WORKERS)")
+    p.add_argument("--upstream-latency", type=float, default=50, help="重播伺服器每個請求額外延遲 (毫秒，預設 50)")
+    p.add_argument("--scan-interval", type=float, default=None, help="覆寫 ETF_SCAN_INTERVAL；速率上限也會限制併發的效果")
+    p.set_defaults(func=cmd_bench_scan)
+
+    p = sub.add_parser("smoke", help="用 AppTest 實際跑 etf_ana.py 的兩個頁面")
+    p.add_argument("fixtures", help="synth / record 產生的目錄")
+    p.add_argument("--users", type=int, default=3, help="依序模擬幾位使用者 (預設 3)")
+    p.add_argument("--holdings", type=int, default=10, help="每位使用者持有幾檔 ETF (預設 10)")
+    p.add_argument("--scan-interval", type=float, default=None, help="覆寫 ETF_SCAN_INTERVAL (預設沿用設定)")
+    p.add_argument("--timeout", type=float, default=300, help="每次頁面執行的逾時秒數 (預設 300)")
+    p.set_defaults(func=cmd_smoke)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
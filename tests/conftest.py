@@ -0,0 +1,52 @@
+import os
+from unittest import mock
+import gspread
+import pytest
+import streamlit as st
+from streamlit.testing.v1 import AppTest
+from oauth2client.service_account import ServiceAccountCredentials
+import etf_core
+import etf_loadtest
+
+@pytest.fixture(autouse=True)
+def isolated_core(tmp_path):
+    """每個測試一份全新的 etf_core：暫存目錄裡的快取、沒有速率限制、上游指到不會有人回應的位址。
+    所有測試都套用，不會讀寫到工作目錄裡的 etf_cache.db (或上一個測試留下的名冊)"""
+    etf_loadtest.configure_core("http://127.0.0.1:9", str(tmp_path), 0)
+
+@pytest.fixture
+def core():
+    return etf_core
+
+HISTOCK_FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "histock")
+
+@pytest.fixture
+def replay(tmp_path):
+    """本機重播 fixtures/histock 的頁面，etf_core 指向它 (其他跟 core 一樣)"""
+    server = etf_loadtest.ReplayServer(HISTOCK_FIXTURES).start()
+    etf_loadtest.configure_core(server.url, str(tmp_path), 0)
+    yield server
+    server.stop()
+
+@pytest.fixture
+def sheets(replay):
+    """給 AppTest 用：gspread 換成 FakeSheetsClient (已經有 alice 這位會員)，Streamlit 快取清空"""
+    fake = etf_loadtest.FakeSheetsClient()
+    fake.add_user("alice", [["0050", 150, 1000, "買進", "2024-01-02"]])
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    with mock.patch.object(gspread, "authorize", return_value=fake), \
+         mock.patch.object(ServiceAccountCredentials, "from_json_keyfile_dict", return_value=None):
+        yield fake
+
+APP_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "etf_ana.py")
+
+@pytest.fixture
+def app(sheets):
+    """建立還沒執行的 etf_ana.py AppTest：app() 是未登入的訪客，app("alice") 用網址參數自動登入"""
+    def open_app(user=None):
+        at = AppTest.from_file(APP_SCRIPT, default_timeout=60)
+        at.secrets["gcp_service_account"] = {"client_email": "bot@example.com"}
+        if user: at.query_params["user"] = user
+        return at
+    return open_app
@@ -0,0 +1,63 @@
+"""會員系統與個人試算表：用 AppTest 實際執行 etf_ana.py，Google Sheets 換成 etf_loadtest 的 FakeSheetsClient"""
+from unittest import mock
+import gspread
+import etf_loadtest
+
+def login(app, username, password):
+    at = app().run()
+    at.sidebar.text_input[0].input(username)
+    at.sidebar.text_input[1].input(password)
+    return at.sidebar.button[0].click().run()
+
+def register(app, username, password, sheet_url):
+    at = app().run()
+    at.sidebar.radio[0].set_value("註冊新帳號").run()
+    at.sidebar.text_input[0].input(username)
+    at.sidebar.text_input[1].input(password)
+    at.sidebar.text_input[2].input(sheet_url)
+    return at.sidebar.button[0].click().run()
+
+def test_login_reads_the_users_index_once(app, sheets):
+    assert login(app, "alice", "pw").session_state["logged_in"]
+    at = login(app, "alice", "wrong")
+    assert not at.session_state["logged_in"]
+    assert [e.value for e in at.sidebar.error] == ["帳號或密碼錯誤"]
+    assert not login(app, "nobody", "pw").session_state["logged_in"]
+    assert sheets.calls["get_all_records"] == 1  # 之後都查記憶體裡的索引
+    assert sheets.calls["open"] == 1
+
+def test_register_invalidates_the_index(app, sheets):
+    assert not login(app, "bob", "secret").session_state["logged_in"]  # 索引已經讀進快取，裡面沒有 bob
+    url = "https://docs.google.com/spreadsheets/d/bob"
+    sheets.personal[url] = etf_loadtest.FakeSpreadsheet(sheets, {"sheet1": etf_loadtest.FakeWorksheet(sheets)})
+    assert register(app, "bob", "secret", url).sidebar.success[0].value.startswith("註冊成功")
+    assert sheets.users.values[-1] == ["bob", "secret", url]
+    assert login(app, "bob", "secret").session_state["logged_in"]  # 不必等索引的 TTL
+    assert register(app, "bob", "other", url).sidebar.warning[0].value == "帳號已存在。"
+
+def test_failed_read_drops_the_worksheet_handle(app, sheets):
+    with mock.patch.object(sheets.users, "get_all_records", side_effect=gspread.exceptions.GSpreadException("連線中斷")):
+        at = login(app, "alice", "pw")
+    assert at.sidebar.error[0].value.startswith("資料庫讀取失敗")
+    assert login(app, "alice", "pw").session_state["logged_in"]
+    assert sheets.calls["open"] == 2  # 失敗後重新 open 一次，不是一直用壞掉的連線
+
+def test_failed_sheet_read_is_not_cached_as_an_empty_portfolio(app, sheets):
+    ledger = sheets.personal["https://docs.google.com/spreadsheets/d/alice"].sheet1
+    at = app("alice")
+    with mock.patch.object(ledger, "get_all_values", side_effect=gspread.exceptions.APIError(mock.Mock(json=lambda: {}, text="503"))):
+        at.run()
+    assert at.error[0].value.startswith("讀取持股試算表失敗")
+    assert not [i for i in at.info if "尚未建立任何持股" in i.value]
+    at.run()  # 試算表恢復了：不必等 10 分鐘的快取過期
+    assert not at.error
+    assert [m for m in at.metric if m.label == "總市值"]
+
+def test_refresh_button_resyncs_quotes_and_dividends(app, sheets, replay):
+    at = app("alice").run()
+    assert replay.counts == {"list_200": 1, "perf_200": 1, "dividend_200": 1}
+    next(b for b in at.button if b.label == "🔄 更新報價與配息").click().run()
+    assert not at.exception
+    # 兩個都帶 ETag 重新驗證，內容沒變所以是 304，配息不必等 7 天的同步週期
+    assert replay.counts.get("perf_304") == 1
+    assert replay.counts.get("dividend_304") == 1
@@ -0,0 +1,10 @@
+import streamlit as st
+import etf_cli
+import etf_core
+
+def test_shared_frame_is_not_copied_per_session():
+    df = etf_cli.random_ranking(300)
+    copied = etf_cli.measure_sessions(st.cache_data(lambda: df.copy()), 20)[1]
+    shared = etf_cli.measure_sessions(st.cache_resource(lambda: etf_core.compact_market_frame(df)), 20)[1]
+    assert copied > 20 * df.memory_usage(deep=True).sum() * 0.5  # cache_data 真的每次都還原一份
+    assert shared < 64 * 1024
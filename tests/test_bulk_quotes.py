@@ -0,0 +1,76 @@
+import os
+import shutil
+import pandas as pd
+import pytest
+import etf_cli
+
+QUOTES = os.path.join(os.path.dirname(__file__), "fixtures", "quotes")
+TWSE = os.path.join(QUOTES, "STOCK_DAY_ALL_20250103.csv")  # 證交所 open data：UTF-8、沒有日期欄
+TPEX = os.path.join(QUOTES, "tpex_quotes.csv")               # 櫃買中心：Big5、日期在表格前的說明文字 (民國年)
+
+@pytest.mark.parametrize("now, expected", [
+    ("2025-01-03 10:00", "2025-01-02"),  # 週五盤中：檔案還是週四的
+    ("2025-01-03 15:00", "2025-01-03"),
+    ("2025-01-04 11:00", "2025-01-03"),  # 週六
+    ("2025-01-06 09:00", "2025-01-03"),  # 週一開盤前
+])
+def test_trade_date_of_undated_files(core, now, expected):
+    assert core.quote_trade_date(now) == expected
+
+def test_parse_quote_date(core):
+    assert core.parse_quote_date("資料日期:114/01/03") == "2025-01-03"
+    assert core.parse_quote_date("1140103") == "2025-01-03"
+    assert core.parse_quote_date("STOCK_DAY_ALL_20250103.csv") == "2025-01-03"
+    assert core.parse_quote_date("2025/1/3") == "2025-01-03"
+    assert core.parse_quote_date("上櫃股票行情") is None
+
+def test_read_twse_file(core, monkeypatch):
+    monkeypatch.setattr(core, "quote_trade_date", lambda now=None: "2025-01-03")
+    quotes = core.read_bulk_quotes(TWSE, "上市")
+    assert list(quotes['代號']) == ["0050", "0056", "00878", "00919", "2330"]  # 沒成交的 00632R 不收
+    assert quotes.set_index('代號').loc["2330", '收盤價'] == 1070.0
+    assert set(quotes['日期']) == {"2025-01-03"}
+    with pytest.raises(ValueError): core.read_bulk_quotes(TWSE, "上市", guess_date=False)
+
+def test_read_tpex_file(core):
+    quotes = core.read_bulk_quotes(TPEX, "上櫃", guess_date=False)
+    assert list(quotes['代號']) == ["00679B", "00687B", "00720B"]
+    assert set(quotes['日期']) == {"2025-01-03"}
+    assert set(quotes['市場別']) == {"上櫃"}
+
+def test_stale_file_is_not_recorded_as_a_new_day(core):
+    assert core.ingest_daily_quotes(TWSE, "上市", "2025-01-02") == 5
+    assert core.ingest_daily_quotes(TWSE, "上市", "2025-01-03") == 0  # 收盤前抓到的還是前一天的行情
+    assert core.get_price_store().latest_date() == "2025-01-02"
+    assert core.ingest_daily_quotes(TPEX, "上櫃") == 3  # 不同市場各自比對
+
+def test_cli_backfill_takes_the_date_from_the_file_name(core, tmp_path):
+    etf_cli.main(["ingest", "--market", "上市", TWSE])
+    assert core.get_price_store().latest_date() == "2025-01-03"
+    undated = tmp_path / "twse.csv"
+    shutil.copy(TWSE, undated)
+    with pytest.raises(SystemExit): etf_cli.main(["ingest", "--market", "上市", str(undated)])
+    etf_cli.main(["ingest", "--market", "上市", "--date", "2025-01-06", str(undated)])
+    assert core.get_price_store().latest_date() == "2025-01-03"  # 收盤價跟 01-03 完全一樣，不記成新的一天
+
+def daily_history(code, name, start, end, first, last):
+    days = pd.bdate_range(start, end)
+    closes = pd.Series(range(len(days)), dtype=float) / max(len(days) - 1, 1) * (last - first) + first
+    return pd.DataFrame({'代號': code, '名稱': name, '市場別': "上市", '日期': days.strftime('%Y-%m-%d'), '收盤價': closes.round(2)})
+
+def test_bulk_rows_need_history_for_every_period(core, monkeypatch):
+    store = core.get_price_store()
+    store.append(daily_history("0050", "元大台灣50", "2024-01-02", "2025-01-03", 100.0, 150.0))
+    store.append(daily_history("00919", "群益台灣精選高息", "2024-11-01", "2025-01-03", 20.0, 22.0))  # 歷史只有兩個月
+    monkeypatch.setattr(core, "QUOTE_SOURCE", "bulk")
+    monkeypatch.setattr(core, "BULK_QUOTE_SOURCES", {})
+    monkeypatch.setattr(pd.Timestamp, "now", classmethod(lambda cls, tz=None: pd.Timestamp("2025-01-03 16:00")))
+    scraped = []
+    def scrape(code):
+        scraped.append(code)
+        return {'代號': code, '名稱': "爬蟲", '市場別': "上市", '現價': 22.0, '一季%': 1.0, '半年%': 2.0, '一年%': 3.0, '綜合平均%': 2.0}
+    rows = core.collect_market_rows(["0050", "00919"], scrape)
+    assert scraped == ["00919"]
+    assert rows[0]['名稱'] == "元大台灣50"
+    assert 0 < rows[0]['一季%'] < rows[0]['半年%'] < rows[0]['一年%'] < 50  # 從整批歷史算的，不是 0
+    assert rows[1]['名稱'] == "爬蟲"
@@ -0,0 +1,22 @@
+def rec(year, cash, ex_date=""):
+    return {"year": year, "ex_date": ex_date, "cash": cash}
+
+def test_new_distribution_without_ex_dates(core):
+    """沒有除息日的頁面新的在前：新的一筆進來，舊的不能被擠掉也不能重複"""
+    store = core.get_dividend_store()
+    store.merge("00679B", [rec("2024", 0.3), rec("2024", 0.2), rec("2024", 0.1)])
+    assert store.merge("00679B", [rec("2024", 0.4), rec("2024", 0.3), rec("2024", 0.2), rec("2024", 0.1)]) == 1
+    assert [r["cash"] for r in store.records("00679B")] == [0.4, 0.3, 0.2, 0.1]
+
+def test_corrected_amount_replaces_old_one(core):
+    store = core.get_dividend_store()
+    store.merge("0050", [rec("2025", 1.0, "2025-07-18"), rec("2025", 2.7, "2025-01-17")])
+    assert store.merge("0050", [rec("2025", 1.05, "2025-07-18"), rec("2025", 2.7, "2025-01-17")]) == 1
+    assert store.records("0050") == [rec("2025", 1.05, "2025-07-18"), rec("2025", 2.7, "2025-01-17")]
+
+def test_years_no_longer_listed_are_kept(core):
+    store = core.get_dividend_store()
+    store.merge("0056", [rec("2024", 1.0, "2024-07-15"), rec("2015", 1.3, "2015-10-26")])
+    assert store.merge("0056", [rec("2025", 1.1, "2025-07-15"), rec("2024", 1.0, "2024-07-15")]) == 1
+    assert [r["year"] for r in store.records("0056")] == ["2025", "2024", "2015"]
+    assert store.merge("0056", [rec("2025", 1.1, "2025-07-15"), rec("2024", 1.0, "2024-07-15")]) == 0
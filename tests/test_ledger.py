@@ -0,0 +1,61 @@
+"""向量化的成本計算要跟逐筆照著券商規則算的結果一樣"""
+import numpy as np
+import pandas as pd
+import pytest
+import etf_cli
+import etf_core
+
+def reference_positions(ledger, method):
+    df = etf_core.prepare_ledger(ledger)
+    state = {}
+    for r in df.itertuples(index=False):
+        pos = state.setdefault(r.代號, {'股數': 0.0, '總成本': 0.0, '已實現損益': 0.0, '已領股息': 0.0, 'lots': []})
+        amount = r.價格 * r.股數
+        if r.類型 == "買進":
+            pos['股數'] += r.股數
+            pos['總成本'] += amount
+            pos['lots'].append([r.股數, r.價格])
+        elif r.類型 == "賣出":
+            if method == "average": cost = pos['總成本'] * r.股數 / pos['股數']
+            else:
+                cost, left = 0.0, r.股數
+                while left > 1e-9:
+                    take = min(left, pos['lots'][0][0])
+                    cost += take * pos['lots'][0][1]
+                    left -= take
+                    pos['lots'][0][0] -= take
+                    if pos['lots'][0][0] < 1e-9: pos['lots'].pop(0)
+            pos['股數'] -= r.股數
+            pos['總成本'] = 0.0 if pos['股數'] < 1e-9 else pos['總成本'] - cost
+            pos['已實現損益'] += amount - cost
+        else: pos['已領股息'] += amount
+    return pd.DataFrame([{'代號': code, **{k: v for k, v in pos.items() if k != 'lots'}} for code, pos in sorted(state.items())])
+
+def check(ledger, method):
+    got = etf_core.build_positions(ledger, method).set_index('代號')
+    want = reference_positions(ledger, method).set_index('代號')
+    for col in ('股數', '總成本', '已實現損益', '已領股息'):
+        np.testing.assert_allclose(got[col], want[col], rtol=1e-9, atol=1e-6, err_msg=col)
+    return got
+
+@pytest.mark.parametrize("method", ["average", "fifo"])
+def test_random_ledger_matches_reference(method):
+    check(etf_cli.random_ledger(3000, [f"00{900 + i}" for i in range(7)], seed=1), method)
+
+def test_many_partial_sells_keep_the_cost_basis():
+    """買回再賣一半、重複上千次：P = 0.5^n 早就小於 float64 能表示的範圍，以前成本會整個變成 0"""
+    rows = [["0050", 100.0, 1000, "買進"]]
+    for i in range(1500):
+        rows.append(["0050", 110.0, 500, "賣出"])
+        rows.append(["0050", 100.0 + i % 7, 500, "買進"])
+    ledger = pd.DataFrame(rows, columns=['代號', '成交均價', '股數', '類型'])
+    got = check(ledger, "average")
+    assert got.loc["0050", '股數'] == 1000
+    assert 100.0 < got.loc["0050", '成交均價'] < 107.0
+
+def test_deep_partial_sells_then_flat_then_again():
+    rows = [["00878", 20.0, 2 ** 20, "買進"]]
+    for _ in range(3):
+        rows += [["00878", 21.0, 2 ** (19 - i), "賣出"] for i in range(19)] + [["00878", 21.0, 1, "賣出"]]  # 一路減半再出清
+        rows += [["00878", 22.0, 2 ** 20, "買進"]]
+    check(pd.DataFrame(rows, columns=['代號', '成交均價', '股數', '類型']), "average")
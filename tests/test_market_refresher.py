@@ -0,0 +1,65 @@
+"""背景重建排行榜：一檔壞掉只影響那一檔、租約被拿走就停、整輪失敗要留下紀錄"""
+import threading
+import time
+import pandas as pd
+import pytest
+
+def row(code, price):
+    return {'代號': code, '名稱': code, '市場別': "上市", '現價': price, '一季%': 1.0, '半年%': 2.0, '一年%': 3.0, '綜合平均%': 2.0}
+
+def failures(core):
+    """計數器是整個行程共用的，測試看前後差多少"""
+    return {labels["reason"]: n for name, labels, n in core.get_metrics().snapshot()["counters"] if name == "refresh_failures"}
+
+@pytest.fixture
+def refresher(core, monkeypatch):
+    monkeypatch.setattr(core, "record_daily_quotes", lambda: None)
+    refresher = core.MarketRefresher(core.get_scrape_cache(), 3600)
+    refresher.publish(pd.DataFrame([row("0050", 150.0), row("0056", 35.0)]))
+    return refresher
+
+def test_bad_page_keeps_the_previous_row(core, refresher, monkeypatch):
+    def fetch(code):
+        if code == "0056": raise ValueError("版面改了")
+        return row(code, 160.0)
+    monkeypatch.setattr(core, "fetch_etf_codes", lambda: ["0050", "0056"])
+    monkeypatch.setattr(core, "fetch_etf_performance", fetch)
+    before = failures(core)
+    refresher._rebuild()
+    df, _ = refresher.snapshot()
+    assert dict(zip(df['代號'], df['現價'])) == {"0050": 160.0, "0056": 35.0}
+    assert failures(core).get("code", 0) - before.get("code", 0) == 1
+
+def test_lost_lease_stops_the_rebuild(core, refresher, monkeypatch):
+    codes = [f"00{900 + i}" for i in range(100)]
+    fetched = []
+    def fetch(code):
+        fetched.append(code)
+        time.sleep(0.01)
+        return row(code, 20.0)
+    monkeypatch.setattr(core, "REFRESH_LEASE_TTL", 0)  # 每完成一檔就續約
+    monkeypatch.setattr(core, "fetch_etf_codes", lambda: codes)
+    monkeypatch.setattr(core, "fetch_etf_performance", fetch)
+    _, as_of = refresher.snapshot()
+    with pytest.raises(core._LeaseLost): refresher._rebuild()  # 沒拿到租約，第一次續約就失敗
+    assert len(fetched) < len(codes)
+    assert refresher.snapshot()[1] == as_of
+    assert not refresher.busy
+
+def test_failed_rebuild_is_counted_and_kept(core, refresher, monkeypatch):
+    done = threading.Event()
+    def broken():
+        done.set()
+        raise RuntimeError("清單頁壞了")
+    monkeypatch.setattr(core, "fetch_etf_codes", broken)
+    before = failures(core)
+    refresher.trigger()
+    assert done.wait(10)
+    released = False
+    for _ in range(100):
+        released = core.get_scrape_cache().acquire_lease("ranking", ttl=60)  # 失敗後租約有放掉
+        if released: break
+        time.sleep(0.05)
+    assert released
+    assert failures(core).get("RuntimeError", 0) - before.get("RuntimeError", 0) == 1
+    assert refresher.last_error[1] == "RuntimeError: 清單頁壞了"
@@ -0,0 +1,152 @@
+"""只建需要節點的解析器 (SoupStrainer) 必須跟原本完整解析的版本得到一樣的結果。
+
+baseline_* 是改寫前 etf_ana.py 裡 get_etf_performance / get_etf_details / get_fast_etf_list 的解析邏輯，
+原封不動搬過來 (只拿掉 requests 與 st.cache_data)。fixtures/histock/ 的檔案路徑就是網址路徑，
+也可以直接給 etf_loadtest.py 的重播伺服器或 etf_cli.py bench-parse 使用。
+"""
+import os
+import re
+from unittest import mock
+import pytest
+from bs4 import BeautifulSoup
+import etf_core
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "histock")
+
+def baseline_performance(html, stock_code):
+    soup = BeautifulSoup(html, 'html.parser')
+    data = {'代號': stock_code, '名稱': "未知", '市場別': "未知", '現價': 0.0, '一季%': 0.0, '半年%': 0.0, '一年%': 0.0, '綜合平均%': 0.0}
+
+    name_tag = soup.find('h3')
+    if name_tag: data['名稱'] = name_tag.text.split('(')[0].strip()
+
+    for tag in soup.find_all(['li', 'td']):
+        text = tag.text.strip()
+        if '市場' in text:
+            if '上市' in text: data['市場別'] = '上市'; break
+            elif '上櫃' in text: data['市場別'] = '上櫃'; break
+    if data['市場別'] == "未知":
+        if soup.find(string="上市"): data['市場別'] = '上市'
+        elif soup.find(string="上櫃"): data['市場別'] = '上櫃'
+
+    price_span = soup.find('span', id='Price1_lbTPrice') or soup.find('span', class_='price')
+    if price_span:
+        try: data['現價'] = float(price_span.text.replace(',', ''))
+        except: pass
+
+    table = soup.find('table', class_='tbPerform')
+    if table:
+        target_periods = {'一季': '一季%', '半年': '半年%', '一年': '一年%'}
+        periods_data = {}
+        for row in table.find_all('tr'):
+            th, td = row.find('th'), row.find('td')
+            if th and td and th.text.strip() in target_periods:
+                val_span = td.find('span')
+                if val_span:
+                    try: periods_data[th.text.strip()] = float(val_span.text.replace('%', '').replace('+', '').replace(',', '').strip())
+                    except: pass
+
+        data['一季%'] = periods_data.get('一季', 0)
+        data['半年%'] = periods_data.get('半年', 0)
+        data['一年%'] = periods_data.get('一年', 0)
+        valid_values = [v for k, v in periods_data.items() if v is not None]
+        if valid_values: data['綜合平均%'] = round(sum(valid_values) / len(valid_values), 2)
+    return data
+
+def baseline_dividend_per_year(html):
+    div_soup = BeautifulSoup(html, 'html.parser')
+    for div_table in div_soup.find_all('table', class_='tb-stock'):
+        rows = div_table.find_all('tr')
+        if len(rows) > 1:
+            ths = [th.text.strip() for th in rows[0].find_all(['th', 'td'])]
+            cash_idx = -1
+            year_idx = -1
+            for i, text in enumerate(ths):
+                if '現金' in text or '除息' in text:
+                    if cash_idx == -1: cash_idx = i
+                if '發放年度' in text:
+                    year_idx = i
+            if year_idx == -1:
+                for i, text in enumerate(ths):
+                    if '年度' in text or '除權息日' in text or '除息日' in text:
+                        year_idx = i
+                        break
+            if cash_idx != -1 and year_idx != -1:
+                year_divs = {}
+                for row in rows[1:]:
+                    tds = row.find_all('td')
+                    if len(tds) > max(cash_idx, year_idx):
+                        y_raw = tds[year_idx].text.strip()
+                        c_str = tds[cash_idx].text.strip()
+                        match = re.search(r'(20\d{2})', y_raw)
+                        if match and c_str:
+                            y_str = match.group(1)
+                            try:
+                                val = float(c_str)
+                                year_divs[y_str] = year_divs.get(y_str, 0.0) + val
+                            except: pass
+                if year_divs:
+                    recent_years = sorted(year_divs.keys(), reverse=True)[:3]
+                    return round(max([year_divs[y] for y in recent_years]), 3)
+    return 0.0
+
+def baseline_etf_list(html):
+    soup = BeautifulSoup(html, 'html.parser')
+    etf_options = []
+    china_keywords = ['中國', '上證', '滬', '深', '恒生', 'A50', '香港', '港股']
+    for row in soup.find_all('tr'):
+        link = row.find('a', href=True)
+        if not link or '/stock/' not in link['href']: continue
+        href_code = link['href'].split('/')[-1]
+        row_text = row.text.strip()
+        if not href_code[0].isdigit() or href_code.upper().endswith(('L', 'R')) or any(kw in row_text for kw in china_keywords): continue
+        option_str = f"{href_code} {link.text.strip()}"
+        if option_str not in etf_options: etf_options.append(option_str)
+    return etf_options
+
+def fixture_pages(kind):
+    pages = []
+    for folder, _, files in os.walk(FIXTURES):
+        for name in sorted(files):
+            path = os.path.join(folder, name)
+            is_dividend = name == "除權除息.html"
+            is_list = name == "etf.aspx.html"
+            if {"perf": not is_dividend and not is_list, "dividend": is_dividend, "list": is_list}[kind]:
+                pages.append(pytest.param(path, id=os.path.relpath(path, FIXTURES)))
+    return pages
+
+def read(path):
+    with open(path, encoding="utf-8") as f: return f.read()
+
+@pytest.mark.parametrize("path", fixture_pages("perf"))
+def test_performance_matches_baseline(core, path):
+    code = os.path.basename(path)[:-len(".html")]
+    assert etf_core.parse_etf_performance(read(path), code) == baseline_performance(read(path), code)
+
+@pytest.mark.parametrize("path", fixture_pages("dividend"))
+def test_dividends_match_baseline(core, path):
+    records = etf_core.parse_dividend_records(read(path))
+    assert etf_core.compute_dividend_metrics(records)['一年配息'] == baseline_dividend_per_year(read(path))
+
+@pytest.mark.parametrize("path", fixture_pages("list"))
+def test_universe_matches_baseline(core, path):
+    universe = etf_core.parse_etf_universe(read(path))
+    assert [f"{e['code']} {e['name']}" for e in universe if not e["exclusion"]] == baseline_etf_list(read(path))
+
+def test_corpus_exercises_every_branch(core):
+    """語料要真的涵蓋各種版面，不然上面的比對沒有意義"""
+    pages = {os.path.relpath(p.values[0], FIXTURES): read(p.values[0]) for kind in ("perf", "dividend") for p in fixture_pages(kind)}
+    markets = {code: etf_core.parse_etf_performance(pages[f"stock/{code}.html"], code)['市場別'] for code in ("0050", "00679B", "00919", "00981A")}
+    assert markets == {"0050": "上市", "00679B": "上櫃", "00919": "上市", "00981A": "未知"}  # li、td 兩格一組、單獨的文字、找不到
+    assert baseline_dividend_per_year(pages["stock/0050/除權除息.html"]) == 4.5       # 多個 class 的表格，前面還有一張不相關的
+    assert baseline_dividend_per_year(pages["stock/00679B/除權除息.html"]) == 1.38    # 沒有發放年度欄，年度從除息日來
+    assert baseline_dividend_per_year(pages["stock/00981A/除權除息.html"]) == 0.0
+
+def test_market_is_not_read_from_meta_or_script(core):
+    """每一頁的 meta 與 script 都有「上市櫃」，不能因此認成上市；也不會為了找市場別再完整解析一次"""
+    html = read(os.path.join(FIXTURES, "stock", "0050.html")).replace("<li><span>市場別：</span>上市</li>", "")
+    assert "上市櫃" in html
+    with mock.patch.object(etf_core, "BeautifulSoup", wraps=etf_core.BeautifulSoup) as soup:
+        assert etf_core.parse_etf_performance(html, "0050")['市場別'] == "未知"
+    assert soup.call_count == 1
+
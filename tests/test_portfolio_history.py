@@ -0,0 +1,47 @@
+import time
+from unittest import mock
+import pandas as pd
+import etf_core
+
+def valuation(value, cost):
+    return pd.DataFrame([{'代號': "0050", '名稱': "元大台灣50", '股數': 1000, '成交均價': cost / 1000, '現價': value / 1000,
+                          '現值': value, '總成本': cost, '預估損益': value - cost, '年領息': 4500.0}])
+
+def summary(value, cost):
+    return {'總市值': value, '總成本': cost, '總損益': value - cost, '預估年領息': 4500.0}
+
+def test_trend_reads_past_days_and_adds_today(core):
+    store = core.get_history_store()
+    for day, value in (("2025-01-02", 150000.0), ("2025-01-03", 152000.0), ("2025-01-06", 149000.0)):
+        store.append_portfolio("alice", valuation(value, 140000.0), as_of=pd.Timestamp(f"{day} 15:00").timestamp())
+    history = core.load_portfolio_history("alice", "2025-01-06")
+    assert list(history['總市值']) == [150000.0, 152000.0]  # 今天寫過的不算，用畫面上剛算的
+    trend = core.portfolio_trend(history, summary(155000.0, 140000.0), today="2025-01-06")
+    assert list(trend['日期'].dt.strftime('%Y-%m-%d')) == ["2025-01-02", "2025-01-03", "2025-01-06"]
+    assert list(trend['總市值']) == [150000.0, 152000.0, 155000.0]
+    assert trend.iloc[-1]['總損益'] == 15000.0
+
+def test_unreadable_history_only_shows_today(core, monkeypatch):
+    monkeypatch.setattr(core.HistoryStore, "portfolio_history", mock.Mock(side_effect=OSError("Parquet 壞了")))
+    assert core.load_portfolio_history("alice", "2025-01-06") is None
+    trend = core.portfolio_trend(None, summary(155000.0, 140000.0), today="2025-01-06")
+    assert list(trend['總市值']) == [155000.0]
+
+def test_page_reads_history_once_per_user_and_day(app, monkeypatch):
+    yesterday = time.time() - 86400
+    etf_core.get_history_store().append_portfolio("alice", valuation(150000.0, 150000.0), as_of=yesterday)
+    reads = mock.Mock(wraps=etf_core.get_history_store().portfolio_history)
+    monkeypatch.setattr(etf_core.get_history_store(), "portfolio_history", reads)
+    at = app("alice")
+    at.run()
+    at.run()
+    assert not at.exception
+    assert [m for m in at.markdown if "資產走勢" in m.value]
+    assert reads.call_count == 1
+
+def test_page_survives_a_broken_history_store(app, monkeypatch):
+    monkeypatch.setattr(etf_core.get_history_store(), "portfolio_history", mock.Mock(side_effect=OSError("Parquet 壞了")))
+    at = app("alice")
+    at.run()
+    assert not at.exception
+    assert [m for m in at.metric if m.label == "總市值"]
@@ -0,0 +1,79 @@
+import time
+import etf_core
+
+def test_hits_do_not_write(core):
+    cache = core.get_scrape_cache()
+    cache.put("perf", "0050", {"現價": 150.0})
+    conn = cache._conn()
+    before = conn.total_changes
+    for _ in range(5): assert cache.get("perf", "0050")["value"] == {"現價": 150.0}
+    assert conn.total_changes == before
+    assert not conn.in_transaction
+
+def test_old_access_time_is_refreshed(core):
+    cache = core.get_scrape_cache()
+    cache.put("perf", "0050", {"現價": 150.0})
+    with cache._conn() as conn: conn.execute("UPDATE scrape_cache SET accessed_at=0")
+    cache.get("perf", "0050")
+    accessed = cache._conn().execute("SELECT accessed_at FROM scrape_cache").fetchone()[0]
+    assert accessed > time.time() - 60
+
+def test_lease_is_short_and_renewable(core):
+    cache = core.get_scrape_cache()
+    assert cache.acquire_lease("ranking", ttl=60)
+    assert not cache.acquire_lease("ranking", ttl=60)
+    assert cache.renew_lease("ranking", 600)
+    expires = cache._conn().execute("SELECT expires_at FROM leases WHERE name='ranking'").fetchone()[0]
+    assert expires > time.time() + 500
+    with cache._conn() as conn: conn.execute("UPDATE leases SET expires_at=0, holder='other'")
+    assert not cache.renew_lease("ranking", 600)  # 過期後被別的行程拿走就不能再續
+    assert cache.acquire_lease("ranking", ttl=60)
+
+def perf_events(core):
+    return {labels["event"]: n for name, labels, n in core.get_metrics().snapshot()["counters"]
+            if name == "cache_events" and labels.get("cache") == "perf"}
+
+def delta(after, before):
+    return {event: n - before.get(event, 0) for event, n in after.items() if n != before.get(event, 0)}
+
+def test_fresh_values_only_counts_hits(core):
+    cache = core.get_scrape_cache()
+    cache.put("perf", "0050", {"現價": 150.0})
+    cache.put("perf", "0056", {"現價": 35.0})
+    cache.expire("perf", ["0056"])
+    before = perf_events(core)
+    assert cache.fresh_values("perf", ["0050", "0056", "00878"]) == {"0050": {"現價": 150.0}}
+    assert delta(perf_events(core), before) == {"hit": 1}
+
+def test_scan_counts_each_cache_event_once(replay):
+    core = etf_core
+    core.fetch_etf_performance("0050")
+    core.get_scrape_cache().put("perf", "00919", {"代號": "00919"})
+    core.get_scrape_cache().expire("perf", ["00919"])
+    before = perf_events(core)
+    rows = [row for batch in core.iter_market_scan(["0050", "00679B", "00919"], core.fetch_etf_performance) for row in batch]
+    assert sorted(row['代號'] for row in rows) == ["0050", "00679B", "00919"]
+    assert delta(perf_events(core), before) == {"hit": 1, "miss": 1, "stale": 1}  # 以前預查一次、真的抓又一次
+
+def test_closing_the_scan_cancels_pending_fetches(core, monkeypatch):
+    monkeypatch.setattr(core, "SCAN_WORKERS", 1)
+    started = []
+    def slow(code):
+        started.append(code)
+        time.sleep(0.05)
+        return {"代號": code}
+    scan = core.iter_market_scan([f"00{600 + i}" for i in range(20)], slow, batch_size=1)
+    assert next(scan) == [{"代號": "00600"}]
+    scan.close()
+    time.sleep(0.2)
+    assert len(started) <= 2  # 只有已經在跑的那一個會做完
+
+def test_streamed_ranking_keeps_list_order(core):
+    rows = {code: {"代號": code, "名稱": code, "市場別": "上市", "現價": 10.0, "一季%": 1.0, "半年%": 1.0, "一年%": 1.0, "綜合平均%": avg}
+            for code, avg in (("0050", 5.0), ("0056", 9.0), ("00878", -2.0))}
+    core.get_scrape_cache().put("perf", "0056", rows["0056"])
+    tables = list(core.stream_market_ranking(["0050", "0056", "00878"], rows.get))
+    assert list(tables[0]['代號']) == ["0056"]  # 快取裡有的先出來
+    assert list(tables[-1]['代號']) == ["0050", "0056", "00878"]
+    assert list(core.ranking_view(tables[-1]).data['代號']) == ["0056", "0050", "00878"]
+    assert list(core.ranking_view(tables[-1]).data.index) == [1, 2, 3]
@@ -0,0 +1,93 @@
+import pandas as pd
+import etf_core
+import etf_loadtest
+
+HEADER = etf_core.SHEET_COLUMNS
+ROWS = [
+    ["0050", 150.0, 1000, "買進", "2024-01-05"],
+    ["0056", 35.5, 2000, "買進", "2024-02-01"],
+    ["00878", 21.0, 3000, "買進", "2024-03-01"],
+    ["0050", 180.0, 500, "賣出", "2024-06-03"],
+]
+
+def sheet_of(rows, header=HEADER):
+    return etf_loadtest.FakeWorksheet(etf_loadtest.FakeSheetsClient(), [header, *rows])
+
+def loaded(rows, header=HEADER):
+    """跟 read_personal_sheet 一樣從工作表內容讀成帳本：每筆資料帶著它在工作表上的列號"""
+    return etf_core.parse_sheet_values([header, *[[str(v) for v in row] for row in rows]])[0]
+
+def sync(sheet, original_df, new_df):
+    layout = {"header": sheet.values[0], "rows": len(sheet.values) - 1}
+    changes = etf_core.plan_sheet_sync(layout, original_df, new_df)
+    batches = etf_core.sheet_sync_batches(changes)
+    if batches: sheet.batch_update(batches)
+    return changes, batches
+
+def test_unchanged_table_writes_nothing():
+    sheet = sheet_of(ROWS)
+    assert sync(sheet, loaded(ROWS), loaded(ROWS)) == ({}, [])
+    assert sheet.client.calls == {}
+
+def test_update_touches_only_that_row():
+    sheet = sheet_of(ROWS)
+    edited = loaded(ROWS)
+    edited.loc[1, '股數'] = 2500
+    changes, batches = sync(sheet, loaded(ROWS), edited)
+    assert list(changes) == [3]
+    assert batches == [{"range": "A3:E3", "values": [["0056", 35.5, 2500, "買進", "2024-02-01"]]}]
+    assert sheet.values[1:] == [ROWS[0], ["0056", 35.5, 2500, "買進", "2024-02-01"], *ROWS[2:]]
+
+def test_insert_appends_after_the_last_row():
+    sheet = sheet_of(ROWS)
+    new_row = pd.DataFrame([["006208", 100.0, 10, "買進", "2024-07-01"]], columns=HEADER)
+    changes, _ = sync(sheet, loaded(ROWS), pd.concat([loaded(ROWS), new_row], ignore_index=True))
+    assert list(changes) == [6]
+    assert sheet.values[1:] == [*ROWS, ["006208", 100.0, 10, "買進", "2024-07-01"]]
+
+def test_delete_moves_the_last_row_into_the_gap_and_blanks_the_tail():
+    sheet = sheet_of(ROWS)
+    changes, batches = sync(sheet, loaded(ROWS), loaded(ROWS).drop(index=[0]))
+    assert sorted(changes) == [2, 5]  # 最後一筆補到第 2 列，第 5 列清空；中間兩列不動
+    assert [b["range"] for b in batches] == ["A2:E2", "A5:E5"]
+    assert sheet.values[1:] == [ROWS[3], ROWS[1], ROWS[2]]
+
+def test_deleting_everything_blanks_every_data_row():
+    sheet = sheet_of(ROWS)
+    changes, batches = sync(sheet, loaded(ROWS), loaded(ROWS).iloc[0:0])
+    assert batches == [{"range": "A2:E5", "values": [[''] * len(HEADER)] * 4}]  # 連續的列合併成一個範圍
+    assert sheet.values == [HEADER]
+
+def test_mixed_edit_matches_the_edited_table():
+    sheet = sheet_of(ROWS)
+    edited = loaded(ROWS).drop(index=[1, 2])
+    edited.loc[3, '成交均價'] = 181.0
+    new_rows = pd.DataFrame([["00919", 22.0, 1000, "買進", "2024-08-01"], ["0050", 1.0, 1000, "配息", "2024-10-18"]], columns=HEADER)
+    sync(sheet, loaded(ROWS), pd.concat([edited, new_rows], ignore_index=True))
+    assert sorted(map(tuple, sheet.values[1:])) == sorted([
+        tuple(ROWS[0]), ("0050", 181.0, 500, "賣出", "2024-06-03"),
+        ("00919", 22.0, 1000, "買進", "2024-08-01"), ("0050", 1.0, 1000, "配息", "2024-10-18")])
+
+def test_legacy_three_column_sheet_gets_the_new_header():
+    legacy = [["0050", 150, 1000], ["0056", 35.5, 2000]]
+    sheet = sheet_of(legacy, header=["代號", "成交均價", "股數"])
+    original = loaded(legacy, header=["代號", "成交均價", "股數"])
+    changes, _ = sync(sheet, original, original.drop(columns="列號"))
+    assert changes[1] == HEADER
+    assert sheet.values[0] == HEADER
+    assert sheet.values[1][:4] == ["0050", 150.0, 1000, "買進"]  # 沒有類型的舊資料當成買進
+
+def test_sheet_values_become_a_ledger():
+    df, layout = etf_core.parse_sheet_values([HEADER, ["50", "150.5", "1000", "買進", "2024-01-05"], ["00878", "21", "3,000", "", ""]])
+    assert layout == {"header": HEADER, "rows": 2}
+    assert list(df['代號']) == ["0050", "00878"]
+    assert list(df['成交均價']) == [150.5, 21]
+    assert list(df['列號']) == [2, 3]
+    assert etf_core.parse_sheet_values([])[1] == {"header": [], "rows": 0}
+
+def test_codes_use_the_registry_only_once_it_is_loaded(core):
+    assert core.normalize_code("0878") == "0878"  # 規則只會補到 4 碼
+    assert not core.get_etf_registry.cache_info().currsize  # 光是正規化代號不會去開資料庫
+    core.get_etf_registry().sync([{"code": "00878", "name": "國泰永續高股息", "exclusion": ""}])
+    assert core.normalize_code("0878") == "00878"
+    assert core.normalize_code("878") == "00878"
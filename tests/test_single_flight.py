@@ -0,0 +1,63 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import etf_core
+
+N = 16
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "等太久"
+        time.sleep(0.001)
+
+def run_together(flight, key, fn):
+    """N 個執行緒同時呼叫 do；等所有人都登記進同一個 flight 之後才放行 fn"""
+    release = threading.Event()
+    def slow():
+        release.wait(5)
+        return fn()
+    with ThreadPoolExecutor(max_workers=N) as pool:
+        futures = [pool.submit(flight.do, key, slow) for _ in range(N)]
+        counts = lambda: flight.stats().get(key[0], {"executed": 0, "coalesced": 0})
+        wait_for(lambda: counts()["executed"] + counts()["coalesced"] == N)
+        release.set()
+        return futures
+
+def test_concurrent_callers_share_one_execution():
+    flight = etf_core.SingleFlight()
+    calls = []
+    def stub():
+        calls.append(threading.get_ident())
+        time.sleep(0.05)
+        return {"現價": 150.0}
+    results = [f.result() for f in run_together(flight, ("perf", "0050"), stub)]
+    assert len(calls) == 1
+    assert flight.stats() == {"perf": {"executed": 1, "coalesced": N - 1}}
+    assert all(r == {"現價": 150.0} for r in results)
+    results[1]["現價"] = 0.0  # 跟隨者拿到的是拷貝
+    assert results[2]["現價"] == 150.0
+
+def test_followers_get_the_leaders_error():
+    flight = etf_core.SingleFlight()
+    def stub(): raise etf_core.CircuitOpenError("histock.tw 暫停中")
+    for future in run_together(flight, ("perf", "0050"), stub):
+        with pytest.raises(etf_core.CircuitOpenError): future.result()
+    assert flight.stats() == {"perf": {"executed": 1, "coalesced": N - 1}}
+
+def test_finished_flights_are_not_reused():
+    flight = etf_core.SingleFlight()
+    assert flight.do(("perf", "0050"), lambda: 1) == 1
+    assert flight.do(("perf", "0050"), lambda: 2) == 2
+    assert flight.do(("perf", "0056"), lambda: 3) == 3
+    assert flight.stats() == {"perf": {"executed": 3, "coalesced": 0}}
+
+def test_cached_fetch_hits_upstream_once(replay):
+    replay.latency = 0.1  # 讓所有執行緒都趕得上同一趟請求
+    with ThreadPoolExecutor(max_workers=N) as pool:
+        results = list(pool.map(lambda _: etf_core.fetch_etf_performance("0050"), range(N)))
+    assert all(r == results[0] and r['現價'] > 0 for r in results)
+    assert replay.counts == {"perf_200": 1}
+    stats = etf_core.get_single_flight().stats()["perf"]
+    assert stats["executed"] + stats["coalesced"] == N
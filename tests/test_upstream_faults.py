@@ -0,0 +1,46 @@
+"""上游出錯時：只吞掉網路層的錯誤 (requests.RequestException)，而且失敗的結果不能被快取"""
+import pytest
+import etf_core
+
+@pytest.fixture
+def flaky(replay, monkeypatch):
+    monkeypatch.setattr(etf_core, "HTTP_RETRIES", 0)  # 不重試，一次 429/503 就算失敗
+    replay.error_rate = 1.0
+    return replay
+
+def test_upstream_errors_are_not_remembered(flaky):
+    assert etf_core.fetch_etf_performance("0050") is None
+    assert etf_core.fetch_etf_details("0050") is None
+    assert sum(v for k, v in flaky.counts.items() if k.startswith("perf_")) == 2
+    flaky.error_rate = 0.0
+    assert etf_core.fetch_etf_performance("0050")['現價'] > 0
+    assert etf_core.fetch_etf_details("0050")['一年配息'] > 0
+
+def test_open_circuit_is_a_miss_not_a_crash(flaky, monkeypatch):
+    monkeypatch.setattr(etf_core, "BREAKER_THRESHOLD", 1)
+    assert etf_core.fetch_etf_performance("0050") is None
+    assert etf_core.fetch_etf_performance("0056") is None
+    assert etf_core.fetch_stats()["short_circuited"] == 1
+
+def test_dividend_sync_failure_keeps_stored_records(replay, monkeypatch):
+    first = etf_core.fetch_etf_details("0050")
+    monkeypatch.setattr(etf_core, "HTTP_RETRIES", 0)
+    monkeypatch.setattr(etf_core, "DIVIDEND_TTL", 0)  # 每次都要重新同步
+    etf_core.get_scrape_cache().put("perf", "0050", first)  # 價格還在快取裡，只有除權息頁會打上游
+    replay.error_rate = 1.0
+    assert etf_core.fetch_etf_details("0050")['一年配息'] == first['一年配息']
+
+def test_parse_errors_are_not_swallowed(replay, monkeypatch):
+    def broken(html, code, known=None): raise ValueError("版面改了")
+    monkeypatch.setattr(etf_core, "parse_etf_performance", broken)
+    with pytest.raises(ValueError): etf_core.fetch_etf_performance("0050")
+
+def test_page_retries_after_an_upstream_error(app, flaky):
+    at = app("alice")
+    at.run()
+    assert not at.exception
+    assert not [m for m in at.metric if m.label == "總市值"]
+    flaky.error_rate = 0.0
+    at.run()  # 一小時的 st.cache_resource 裡不能留著上一次的 None
+    assert [m for m in at.metric if m.label == "總市值"]
+    assert flaky.counts.get("perf_200") == 1